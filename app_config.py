@@ -0,0 +1,108 @@
+import json
+import os
+
+ENV_PREFIX = "QQSUM_"  # 环境变量 QQSUM_<配置名> 覆盖同名配置，例如 QQSUM_TARGET_GROUP_ID=123456
+CONFIG_PATH_ENV = "QQSUM_CONFIG"  # 未用 --config 指定时读取的配置文件路径
+# 常见的标准环境变量，优先级低于 QQSUM_ 前缀的同名配置
+ENV_ALIASES = {"GEMINI_API_KEY": "GEMINI_API_KEY_VALUE", "GOOGLE_API_KEY": "GEMINI_API_KEY_VALUE"}
+
+
+class ConfigError(Exception):
+    pass
+
+
+def read_config_file(path):
+    """读取 JSON 或 TOML 配置文件，返回 dict。TOML 需要 Python 3.11+ (tomllib) 或已安装 tomli。"""
+    if path.lower().endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ConfigError("读取 TOML 配置需要 Python 3.11+ 或 tomli，也可以改用 JSON 配置文件")
+        try:
+            with open(path, "rb") as f:
+                return tomllib.load(f)
+        except (OSError, tomllib.TOMLDecodeError) as e:
+            raise ConfigError(f"读取配置文件 {path} 失败: {e}")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            values = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ConfigError(f"读取配置文件 {path} 失败: {e}")
+    if not isinstance(values, dict):
+        raise ConfigError(f"配置文件 {path} 的顶层必须是对象")
+    return values
+
+
+def parse_value(raw, current):
+    # 命令行/环境变量中的值按 JSON 解析 (数字、true/false/null、列表、对象)；原值为字符串时保持原样，避免 Key 被解析成数字
+    if isinstance(current, str):
+        return raw
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return raw
+
+
+def _find_owner(modules, name):
+    # 只有全大写的模块常量算作配置项
+    if not name.isupper():
+        return None
+    for module in modules:
+        if hasattr(module, name):
+            return module
+    return None
+
+
+def apply_values(modules, values, source):
+    """把 {配置名: 值} 写入第一个定义了该配置的模块；与模块同名的表只作用于该模块。返回已应用的配置名列表。"""
+    # 按文件名识别模块，直接运行的脚本 (__main__) 也能匹配到同名的表
+    by_name = {os.path.splitext(os.path.basename(module.__file__))[0]: module for module in modules}
+    applied = []
+    for name, value in values.items():
+        if name in by_name and isinstance(value, dict):
+            applied.extend(apply_values([by_name[name]], value, f"{source} [{name}]"))
+            continue
+        owner = _find_owner(modules, name)
+        if owner is None:
+            print(f"  [配置] 忽略{source}中的未知配置项: {name}")
+            continue
+        setattr(owner, name, value)
+        applied.append(name)
+    return applied
+
+
+def env_values(modules, environ=None):
+    environ = os.environ if environ is None else environ
+    values = {}
+    for env_name, target in ENV_ALIASES.items():
+        if environ.get(env_name) and _find_owner(modules, target):
+            values[target] = environ[env_name]
+    for env_name, raw in environ.items():
+        name = env_name[len(ENV_PREFIX):]
+        if not env_name.startswith(ENV_PREFIX) or env_name == CONFIG_PATH_ENV:
+            continue
+        owner = _find_owner(modules, name)
+        if owner is not None:
+            values[name] = parse_value(raw, getattr(owner, name))
+    return values
+
+
+def load_config(modules, path=None, overrides=(), environ=None):
+    """按 配置文件 -> 环境变量 -> 命令行 NAME=VALUE 的顺序覆盖各模块的配置常量，后者优先。返回实际使用的配置文件路径。"""
+    environ = os.environ if environ is None else environ
+    path = path or environ.get(CONFIG_PATH_ENV)
+    if path:
+        apply_values(modules, read_config_file(path), f"配置文件 {path} ")
+    apply_values(modules, env_values(modules, environ), "环境变量")
+    values = {}
+    for item in overrides:
+        name, sep, raw = item.partition("=")
+        owner = _find_owner(modules, name.strip())
+        if not sep or owner is None:
+            raise ConfigError(f"无法识别的配置覆盖: {item} (格式为 配置名=值)")
+        values[name.strip()] = parse_value(raw, getattr(owner, name.strip()))
+    apply_values(modules, values, "命令行")
+    return path
@@ -0,0 +1,180 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import gemini_test
+from fake_services import FakeFilesBackend, FakeGeminiClient, FakeOneBotServer
+from run_metrics import RunMetrics, peak_rss_mb
+from upload_cache import UploadCache
+
+BENCHMARK_GROUP_ID = 10000
+
+
+def configure_pipeline(workdir, server, gemini_client, args):
+    # 把 gemini_test 的全局配置指向本地假服务与临时目录，并清空上一轮留下的共享对象
+    gemini_test.LLONEBOT_API_URL = server.base_url
+    gemini_test.GEMINI_API_KEY_VALUE = "benchmark"
+    gemini_test.IMAGE_DOWNLOAD_DIR = os.path.join(workdir, "images")
+    gemini_test.MESSAGE_STORE_PATH = os.path.join(workdir, "messages.sqlite3")
+    gemini_test.USE_MESSAGE_STORE = not args.no_store
+    gemini_test.USE_MEDIA_PROCESS_POOL = not args.no_media_pool
+    gemini_test.INCREMENTAL_SUMMARY = False
+    gemini_test.METRICS_JSONL_PATH = None
+    gemini_test.METRICS_PROMETHEUS_PATH = None
+    gemini_test.VERBOSE_PAYLOAD_DUMP = False
+    if gemini_test._message_store is not None:
+        gemini_test._message_store.close()
+    gemini_test._message_store = None
+    gemini_test._image_cache = None
+    gemini_test._onebot_client = None
+    gemini_test._gemini_client = gemini_client
+    gemini_test._gemini_pool = None
+    gemini_test._upload_cache = UploadCache(os.path.join(workdir, "upload_cache.json"), FakeFilesBackend())
+    gemini_test.run_metrics = RunMetrics()
+
+
+def run_once(server, gemini_client, workdir, args):
+    configure_pipeline(workdir, server, gemini_client, args)
+    image_calls_before = server.image_calls
+    output = io.StringIO()
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(output))
+        started = time.perf_counter()
+        transcript = gemini_test.fetch_and_prepare_transcript(BENCHMARK_GROUP_ID, args.fetch_hours, args.max_messages)
+        prepared_at = time.perf_counter()
+        reply_text = gemini_test.summarize_transcript(transcript, echo=False) if transcript else None
+        finished = time.perf_counter()
+    if transcript is None or reply_text is None:
+        print(output.getvalue()[-3000:])
+        raise RuntimeError("基准流程未能完成，以上为最后的输出。")
+
+    prepare_seconds = prepared_at - started
+    snapshot = gemini_test.run_metrics.snapshot()
+    # 吞吐按拉取到的原始消息数计算；记录压缩后的行数 (合并重复、丢弃空消息) 单独列出
+    message_count = snapshot["counters"].get("window_messages", 0)
+    return {
+        "messages": message_count,
+        "transcript_lines": len(transcript.lines),
+        "images_attached": len(transcript.image_paths),
+        "images_downloaded": server.image_calls - image_calls_before,
+        "prepare_seconds": prepare_seconds,
+        "summarize_seconds": finished - prepared_at,
+        "total_seconds": finished - started,
+        "messages_per_second": message_count / prepare_seconds if prepare_seconds else 0.0,
+        "images_per_second": (server.image_calls - image_calls_before) / prepare_seconds if prepare_seconds else 0.0,
+        "stages": {name: {"count": stats["count"], "avg_ms": stats["seconds"] / stats["count"] * 1000,
+                          "max_ms": stats["max_seconds"] * 1000}
+                   for name, stats in snapshot["stages"].items() if stats["count"]},
+        "counters": snapshot["counters"],
+    }
+
+
+def summarize_runs(runs):
+    keys = ["messages_per_second", "images_per_second", "prepare_seconds", "summarize_seconds", "total_seconds"]
+    result = {key: statistics.median(run[key] for run in runs) for key in keys}
+    stage_names = sorted({name for run in runs for name in run["stages"]})
+    result["stages"] = {
+        name: {"avg_ms": statistics.median(run["stages"][name]["avg_ms"] for run in runs if name in run["stages"]),
+               "max_ms": max(run["stages"][name]["max_ms"] for run in runs if name in run["stages"]),
+               "count": runs[-1]["stages"].get(name, {}).get("count", 0)}
+        for name in stage_names}
+    result["messages"] = runs[-1]["messages"]
+    result["transcript_lines"] = runs[-1]["transcript_lines"]
+    result["images_attached"] = runs[-1]["images_attached"]
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def print_result(result, baseline=None):
+    def delta(key, higher_is_better):
+        if not baseline or key not in baseline or not baseline[key]:
+            return ""
+        change = (result[key] - baseline[key]) / baseline[key] * 100
+        better = change > 0 if higher_is_better else change < 0
+        return f"  ({change:+.1f}% {'更好' if better else '更差'})"
+
+    print("\n===== 基准结果 (多轮取中位数) =====")
+    print(f"消息数 {result['messages']} (压缩后 {result.get('transcript_lines', result['messages'])} 行)，"
+          f"附带图片 {result['images_attached']} 张")
+    print(f"消息吞吐    {result['messages_per_second']:>10.1f} 条/s{delta('messages_per_second', True)}")
+    print(f"图片吞吐    {result['images_per_second']:>10.1f} 张/s{delta('images_per_second', True)}")
+    print(f"拉取+准备   {result['prepare_seconds']:>10.2f} s{delta('prepare_seconds', False)}")
+    print(f"总结        {result['summarize_seconds']:>10.2f} s{delta('summarize_seconds', False)}")
+    print(f"端到端      {result['total_seconds']:>10.2f} s{delta('total_seconds', False)}")
+    if result.get("peak_rss_mb") is not None:
+        print(f"峰值 RSS    {result['peak_rss_mb']:>10.1f} MB (主进程){delta('peak_rss_mb', False)}")
+    if result.get("peak_rss_children_mb"):
+        print(f"峰值 RSS    {result['peak_rss_children_mb']:>10.1f} MB (媒体进程中最大者)")
+    print(f"\n{'阶段':<26}{'次数':>8}{'平均ms':>10}{'最长ms':>10}")
+    for name, stats in sorted(result["stages"].items(), key=lambda item: -item[1]["avg_ms"] * item[1]["count"]):
+        print(f"{name:<26}{stats['count']:>8}{stats['avg_ms']:>10.2f}{stats['max_ms']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线基准测试: 本地假 OneBot/图片服务 + 假 Gemini 流式客户端")
+    parser.add_argument("--messages", type=int, default=5000, help="合成的历史消息总数")
+    parser.add_argument("--span-hours", type=float, default=30, help="消息分布的时间跨度 (小时)")
+    parser.add_argument("--fetch-hours", type=int, default=24, help="统计窗口 (小时)")
+    parser.add_argument("--max-messages", type=int, default=None)
+    parser.add_argument("--image-ratio", type=float, default=0.2, help="带图片的消息比例")
+    parser.add_argument("--gif-ratio", type=float, default=0.1, help="图片中 GIF 的比例")
+    parser.add_argument("--distinct-images", type=int, default=None, help="不同图片的数量 (默认每张都不同)")
+    parser.add_argument("--api-latency", type=float, default=0.005, help="假 OneBot 每次请求的延迟 (秒)")
+    parser.add_argument("--image-latency", type=float, default=0.05, help="假图片服务器每次请求的延迟 (秒)")
+    parser.add_argument("--first-chunk-latency", type=float, default=0.5, help="假 Gemini 的首块延迟 (秒)")
+    parser.add_argument("--repeat", type=int, default=3, help="重复轮数，结果取中位数")
+    parser.add_argument("--warm", action="store_true", help="各轮共用缓存目录 (测量缓存命中时的性能)")
+    parser.add_argument("--no-store", action="store_true", help="不使用本地消息库 (纯 API 拉取)")
+    parser.add_argument("--no-media-pool", action="store_true", help="媒体处理在线程内执行而不是进程池")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json-out", help="把结果写入 JSON 文件，供之后 --compare 使用")
+    parser.add_argument("--compare", help="与之前 --json-out 保存的结果对比")
+    parser.add_argument("--verbose", action="store_true", help="显示流水线自身的输出")
+    args = parser.parse_args()
+
+    server = FakeOneBotServer(args.messages, args.span_hours, args.image_ratio, args.gif_ratio, args.distinct_images,
+                              api_latency=args.api_latency, image_latency=args.image_latency, seed=args.seed,
+                              group_id=BENCHMARK_GROUP_ID)
+    server.start()
+    print(f"已生成 {len(server.messages)} 条合成消息与 {server.prerender_images()} 张图片。")
+    gemini_client = FakeGeminiClient(first_chunk_latency=args.first_chunk_latency)
+    workdir = tempfile.mkdtemp(prefix="qq_summary_bench_")
+    runs = []
+    try:
+        for i in range(args.repeat):
+            run_dir = workdir if args.warm else os.path.join(workdir, f"run{i}")
+            run = run_once(server, gemini_client, run_dir, args)
+            runs.append(run)
+            print(f"第 {i + 1}/{args.repeat} 轮: {run['messages']} 条消息，准备 {run['prepare_seconds']:.2f}s，"
+                  f"总结 {run['summarize_seconds']:.2f}s")
+    finally:
+        if gemini_test._media_pool is not None:
+            gemini_test._media_pool.shutdown()
+        if gemini_test._message_store is not None:
+            gemini_test._message_store.close()
+            gemini_test._message_store = None
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = summarize_runs(runs)
+    result["peak_rss_children_mb"] = peak_rss_mb(children=True)
+    result["params"] = vars(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_result(result, baseline)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
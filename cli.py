@@ -0,0 +1,139 @@
+import time
+
+_cli_started = time.perf_counter()
+
+import argparse
+import sys
+
+import app_config
+import gemini_test
+import scheduler
+
+
+def add_common_arguments(parser):
+    parser.add_argument("--config", help=f"JSON/TOML 配置文件 (默认读取环境变量 {app_config.CONFIG_PATH_ENV})")
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="NAME=VALUE",
+                        help="覆盖单个配置项，值按 JSON 解析，可重复使用")
+    parser.add_argument("-g", "--group", type=int, default=None, help="群号 (默认 TARGET_GROUP_ID)")
+    parser.add_argument("--hours", type=int, default=None, help="统计的小时数 (默认 FETCH_HOURS_AGO)")
+    parser.add_argument("--max-messages", type=int, default=None)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="QQ 群聊记录拉取与 Gemini 总结")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    fetch_parser = subparsers.add_parser("fetch", help="只把消息同步到本地消息库，不下载图片、不调用 Gemini")
+    add_common_arguments(fetch_parser)
+    dry_run_parser = subparsers.add_parser("dry-run", help="拉取消息并构建提示词，打印估算规模但不调用 Gemini")
+    add_common_arguments(dry_run_parser)
+    dry_run_parser.add_argument("-o", "--output", help="把完整提示词写入该文件")
+    summarize_parser = subparsers.add_parser("summarize", help="拉取、总结并打印报告")
+    add_common_arguments(summarize_parser)
+    publish_parser = subparsers.add_parser("publish", help="拉取、总结并把报告按主题发回群里")
+    add_common_arguments(publish_parser)
+    publish_parser.add_argument("--to", type=int, action="append", default=None, metavar="GROUP_ID",
+                                help="发布到的群号，可重复使用 (默认 PUBLISH_GROUP_IDS)")
+    return parser
+
+
+def check_gemini_ready():
+    if not gemini_test.GEMINI_API_KEY_VALUE or "YOUR_GEMINI_API_KEY_HERE" in gemini_test.GEMINI_API_KEY_VALUE:
+        print("错误：Gemini API Key 未配置或仍为占位符。请在配置文件中设置 GEMINI_API_KEY_VALUE，"
+              "或设置环境变量 GEMINI_API_KEY。")
+        return False
+    if not gemini_test.load_genai():
+        print("错误: google-generativeai 库导入失败。请确保已正确安装。")
+        return False
+    return True
+
+
+def run_fetch(args, group_id):
+    start_ts, end_ts = gemini_test.get_target_time_range_timestamps(args.hours)
+    with gemini_test.run_metrics.stage("window_fetch"):
+        if gemini_test.USE_MESSAGE_STORE:
+            store = gemini_test.get_message_store()
+            gemini_test.sync_message_store(store, group_id, start_ts)
+            message_count = sum(1 for _ in store.iter_messages_in_range(group_id, start_ts, end_ts, args.max_messages))
+        else:
+            # 没有消息库时拉取结果无处保存，只统计窗口内的消息数
+            counter = []
+            gemini_test.collect_window_via_api(group_id, start_ts, end_ts, counter.append, args.max_messages)
+            message_count = len(counter)
+    print(f"群 {group_id} 过去 {args.hours or gemini_test.FETCH_HOURS_AGO} 小时共有 {message_count} 条消息。")
+    return 0
+
+
+def run_dry_run(args, group_id):
+    transcript = gemini_test.fetch_and_prepare_transcript(group_id, args.hours, args.max_messages)
+    if transcript is None:
+        print("未能准备好发送给Gemini的内容。")
+        return 1
+    prompt_text = transcript.prompt_text()
+    prefix_tokens = gemini_test.estimate_text_tokens(transcript.prompt_prefix() + transcript.body_header())
+    total_tokens = prefix_tokens + gemini_test.estimate_transcript_tokens(transcript.lines, transcript.line_image_counts)
+    if total_tokens <= gemini_test.SINGLE_REQUEST_TOKEN_BUDGET:
+        plan = "单次请求"
+    else:
+        chunks = gemini_test.plan_chunks(transcript.lines, transcript.line_image_counts,
+                                         max(1, gemini_test.CHUNK_TOKEN_BUDGET - prefix_tokens))
+        plan = f"分 {len(chunks)} 段总结后合并"
+    print(f"\n[试运行] {len(transcript.lines)} 行记录，{len(transcript.image_paths)} 张图片，"
+          f"估算 {total_tokens} tokens，提示词 {len(prompt_text)} 字符，{plan}。")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(prompt_text)
+        print(f"[试运行] 提示词已写入 {args.output}")
+    return 0
+
+
+def run_summarize(args, group_id, publish_to=None):
+    if not check_gemini_ready():
+        return 1
+    transcript = gemini_test.fetch_and_prepare_transcript(group_id, args.hours, args.max_messages)
+    if transcript is None:
+        print("未能准备好发送给Gemini的内容或准备过程中出错。")
+        return 1
+    publisher = gemini_test.create_publisher(transcript, publish_to) if publish_to else None
+    reply_text, topics = gemini_test.summarize_transcript_topics(
+        transcript, on_topic=publisher.publish_topic if publisher else None,
+        on_overview=publisher.publish_overview if publisher else None)
+    published = publisher.close(reply_text) if publisher else True
+    gemini_test.save_summary_for_incremental(transcript, reply_text, topics)
+    gemini_test.report_upload_caches()
+    if gemini_test._gemini_pool is not None: gemini_test._gemini_pool.report()
+    return 0 if reply_text is not None and published else 1
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        config_path = app_config.load_config([gemini_test, scheduler], args.config, args.overrides)
+    except app_config.ConfigError as e:
+        print(f"错误: {e}")
+        return 2
+    # 依赖统计小时数的派生配置在覆盖后重新生成
+    gemini_test.GEMINI_PROMPT_PREFIX = gemini_test.build_gemini_prompt_prefix(gemini_test.FETCH_HOURS_AGO)
+    group_id = args.group or gemini_test.TARGET_GROUP_ID
+    startup_seconds = time.perf_counter() - _cli_started
+    gemini_test.run_metrics.observe("startup", startup_seconds)
+    print(f"[启动] {args.command}: 导入与加载配置耗时 {startup_seconds * 1000:.0f} ms"
+          + (f" (配置文件 {config_path})" if config_path else ""))
+
+    if args.command == "fetch":
+        status = run_fetch(args, group_id)
+    elif args.command == "dry-run":
+        status = run_dry_run(args, group_id)
+    elif args.command == "publish":
+        publish_to = args.to or gemini_test.PUBLISH_GROUP_IDS
+        if not publish_to:
+            print("错误: 请用 --to 指定发布的群，或在配置中设置 PUBLISH_GROUP_IDS。")
+            return 2
+        status = run_summarize(args, group_id, publish_to)
+    else:
+        status = run_summarize(args, group_id)
+    gemini_test.write_run_metrics(group_id=group_id, command=args.command, startup_ms=round(startup_seconds * 1000))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,531 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import http.server
+import json
+import os
+import queue
+import re
+import socket
+import struct
+import threading
+import time
+from urllib.parse import urlsplit
+
+import gemini_test
+from image_pool import ImageDownloadPool
+
+# --- 用户配置 ---
+# 在 LLOneBot 中把 HTTP 上报地址设为 http://<本机>:EVENT_PORT/ ，或把反向 WebSocket 地址设为 ws://<本机>:EVENT_PORT/onebot/v11/ws
+EVENT_HOST = "127.0.0.1"
+EVENT_PORT = 5701
+EVENT_ACCESS_TOKEN = None  # 反向 WebSocket 的 access_token (Authorization: Bearer ...)，None 表示不校验
+EVENT_SECRET = None  # HTTP 上报的签名密钥 (X-Signature: sha1=...)，None 表示不校验
+LIVE_INGEST_GROUPS = []  # 只接收这些群的消息；为空表示接收所有群
+EVENT_QUEUE_SIZE = 5000  # 待写入的事件队列上限，满了之后 HTTP 上报会等待/返回 503，WebSocket 会停止读取 (背压)
+EVENT_ENQUEUE_TIMEOUT = 5  # HTTP 上报在队列满时最多等待的秒数
+EVENT_BATCH_SIZE = 200  # 每次写入消息库的最大事件数
+EVENT_STALE_SECONDS = 90  # 超过该秒数没有收到任何事件或心跳，视为连接中断，恢复后重新补齐历史
+IMAGE_PREFETCH_MAX_PENDING = 200  # 预下载图片的未完成任务上限
+EVENT_ARCHIVE_PATH = None  # 把收到的原始事件追加写入该 JSONL 文件，可用 replay 子命令回放；None 表示不保存
+# --- 用户配置结束 ---
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WEBSOCKET_MAX_MESSAGE_BYTES = 16 * 1024 * 1024
+_CQ_CODE_PATTERN = re.compile(r"\[CQ:([a-zA-Z_]+)((?:,[^,\]]*)*)\]")
+
+
+def _cq_unescape(text):
+    return text.replace("&#44;", ",").replace("&#91;", "[").replace("&#93;", "]").replace("&amp;", "&")
+
+
+def parse_cq_message(text):
+    # 上报格式为字符串 (CQ 码) 时转换成消息段数组
+    segments = []
+    position = 0
+    for match in _CQ_CODE_PATTERN.finditer(text):
+        if match.start() > position:
+            segments.append({"type": "text", "data": {"text": _cq_unescape(text[position:match.start()])}})
+        data = {}
+        for item in match.group(2).split(",")[1:]:
+            key, _, value = item.partition("=")
+            data[key] = _cq_unescape(value)
+        segments.append({"type": match.group(1), "data": data})
+        position = match.end()
+    if position < len(text):
+        segments.append({"type": "text", "data": {"text": _cq_unescape(text[position:])}})
+    return segments
+
+
+def normalize_group_message_event(event):
+    """把 OneBot 群消息事件转换成与 get_group_msg_history 返回的消息相同的结构；不是群消息时返回 None。"""
+    if event.get("post_type") not in ("message", "message_sent") or event.get("message_type") != "group":
+        return None
+    message = event.get("message", [])
+    if isinstance(message, str):
+        message = parse_cq_message(message)
+    return {
+        "group_id": event.get("group_id"),
+        "message_id": event.get("message_id"),
+        "message_seq": event.get("message_seq"),
+        "time": event.get("time", int(time.time())),
+        "user_id": event.get("user_id"),
+        "sender": event.get("sender", {}),
+        "message": message,
+    }
+
+
+# --- 最小的 WebSocket 实现 (RFC 6455)，只覆盖 OneBot 反向 WebSocket 与回放客户端需要的部分 ---
+def _read_exact(rfile, size):
+    data = b""
+    while len(data) < size:
+        chunk = rfile.read(size - len(data))
+        if not chunk:
+            raise ConnectionError("连接已关闭")
+        data += chunk
+    return data
+
+
+def _apply_mask(payload, mask):
+    if not payload:
+        return payload
+    repeated_mask = (mask * (len(payload) // 4 + 1))[:len(payload)]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(repeated_mask, "big")).to_bytes(len(payload), "big")
+
+
+def read_websocket_frame(rfile):
+    first, second = _read_exact(rfile, 2)
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack(">H", _read_exact(rfile, 2))[0]
+    elif length == 127:
+        length = struct.unpack(">Q", _read_exact(rfile, 8))[0]
+    if length > WEBSOCKET_MAX_MESSAGE_BYTES:
+        raise ConnectionError(f"WebSocket 帧过大: {length} 字节")
+    mask = _read_exact(rfile, 4) if second & 0x80 else None
+    payload = _read_exact(rfile, length)
+    return bool(first & 0x80), first & 0x0F, _apply_mask(payload, mask) if mask else payload
+
+
+def write_websocket_frame(wfile, opcode, payload, masked=False):
+    header = bytes([0x80 | opcode])
+    mask_bit = 0x80 if masked else 0
+    if len(payload) < 126:
+        header += bytes([mask_bit | len(payload)])
+    elif len(payload) < 65536:
+        header += bytes([mask_bit | 126]) + struct.pack(">H", len(payload))
+    else:
+        header += bytes([mask_bit | 127]) + struct.pack(">Q", len(payload))
+    if masked:
+        mask = os.urandom(4)
+        header += mask
+        payload = _apply_mask(payload, mask)
+    wfile.write(header + payload)
+    wfile.flush()
+
+
+def iter_websocket_messages(rfile, wfile, masked_replies=False):
+    # 逐条产出文本/二进制消息；自动回复 ping，收到 close 时结束
+    fragments = []
+    while True:
+        fin, opcode, payload = read_websocket_frame(rfile)
+        if opcode == 0x8:
+            try:
+                write_websocket_frame(wfile, 0x8, payload[:2], masked_replies)
+            except OSError:
+                pass
+            return
+        if opcode == 0x9:
+            write_websocket_frame(wfile, 0xA, payload, masked_replies)
+            continue
+        if opcode == 0xA:
+            continue
+        fragments.append(payload)
+        if sum(len(f) for f in fragments) > WEBSOCKET_MAX_MESSAGE_BYTES:
+            raise ConnectionError("WebSocket 消息过大")
+        if fin:
+            yield b"".join(fragments)
+            fragments = []
+
+
+class EventIngestDaemon:
+    """接收 OneBot 推送的群消息事件，写入本地消息库并预下载图片，使总结时不必再拉取历史与下载图片。
+
+    事件先进入有界队列，由单独的写入线程按批写库；队列满时接收端阻塞或拒绝 (背压)。
+    每个群在确认没有漏收 (seq 连续) 时标记为 contiguous，总结流程据此跳过历史拉取；
+    出现 seq 跳跃或连接中断后，由补齐线程调用 sync_message_store 补上缺口。
+    """
+
+    def __init__(self, store, groups=None, queue_size=None, prefetch_images=True):
+        self.store = store
+        self.groups = set(int(g) for g in groups or [])
+        self.events = queue.Queue(maxsize=EVENT_QUEUE_SIZE if queue_size is None else queue_size)
+        self.image_pool = ImageDownloadPool(
+            gemini_test.download_and_process_image_for_gemini, gemini_test.IMAGE_DOWNLOAD_MAX_WORKERS,
+            gemini_test.IMAGE_DOWNLOAD_PER_HOST_LIMIT, keep_results=False,
+            max_pending=IMAGE_PREFETCH_MAX_PENDING) if prefetch_images else None
+        if prefetch_images:
+            # 常驻进程不固定访问过的图片，否则缓存永远不会淘汰
+            gemini_test.get_image_cache().pin_accessed = False
+        self._seen_groups = set()
+        self._resync_pending = set()
+        self._resyncing = None
+        self._resync_lock = threading.Condition()
+        self._last_event_at = None
+        self._stopping = threading.Event()
+        self._threads = []
+        self._archive_lock = threading.Lock()
+        self.received_count = 0
+        self.stored_count = 0
+        self.dropped_count = 0
+        self.resync_count = 0
+
+    # --- 接收端 ---
+    def submit_event(self, event, timeout=None):
+        """放入事件队列；timeout 为 None 时一直等待 (WebSocket)，否则超时返回 False (HTTP 返回 503)。"""
+        try:
+            self.events.put(event, timeout=timeout)
+        except queue.Full:
+            self.dropped_count += 1
+            return False
+        return True
+
+    def _mark_alive(self):
+        now = time.time()
+        if self._last_event_at is not None and now - self._last_event_at > EVENT_STALE_SECONDS:
+            self._on_connection_gap("长时间未收到事件")
+        self._last_event_at = now
+
+    def on_connected(self):
+        # 新的反向 WebSocket 连接: 断开期间可能漏收，重新补齐所有已知的群
+        self._on_connection_gap("连接已重新建立")
+        self._last_event_at = time.time()
+
+    def _on_connection_gap(self, reason):
+        groups = self._known_groups()
+        if groups:
+            print(f"[守护进程] {reason}，将重新补齐 {len(groups)} 个群的消息。")
+        for group_id in groups:
+            self.store.set_live_status(group_id, False, time.time())
+            self.request_resync(group_id)
+
+    def _known_groups(self):
+        return set(self.groups) | set(self._seen_groups)
+
+    # --- 写入线程 ---
+    def _writer_loop(self):
+        while not self._stopping.is_set():
+            try:
+                batch = [self.events.get(timeout=1)]
+            except queue.Empty:
+                continue
+            while len(batch) < EVENT_BATCH_SIZE:
+                try:
+                    batch.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._process_batch(batch)
+            except Exception as e:
+                print(f"[守护进程] 处理事件失败: {e}")
+            finally:
+                for _ in batch:
+                    self.events.task_done()
+
+    def _process_batch(self, batch):
+        self._mark_alive()
+        if EVENT_ARCHIVE_PATH:
+            with self._archive_lock, open(EVENT_ARCHIVE_PATH, "a", encoding="utf-8") as f:
+                for event in batch:
+                    f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        by_group = {}
+        for event in batch:
+            self.received_count += 1
+            msg_obj = normalize_group_message_event(event)
+            if msg_obj is None or msg_obj["group_id"] is None:
+                continue
+            group_id = int(msg_obj["group_id"])
+            if self.groups and group_id not in self.groups:
+                continue
+            by_group.setdefault(group_id, []).append(msg_obj)
+
+        for group_id, messages in by_group.items():
+            self._seen_groups.add(group_id)
+            self.stored_count += self.store.add_messages(group_id, messages)
+            self._extend_coverage(group_id, messages)
+            if self.image_pool:
+                for msg_obj in messages:
+                    # 与总结时相同的解析流程，图片随即提交预下载，结果留在图片缓存中
+                    gemini_test.prepare_display_message_for_gemini(msg_obj, group_id, self.image_pool)
+
+    def _extend_coverage(self, group_id, messages):
+        seqs = sorted(int(m["message_seq"]) for m in messages if m.get("message_seq") is not None)
+        if len(seqs) < len(messages):
+            # 没有 message_seq 的事件不会写入消息库，也不参与连续性判断
+            print(f"[守护进程] 群 {group_id} 有 {len(messages) - len(seqs)} 条事件缺少 message_seq，已跳过。")
+        if not seqs:
+            return
+        coverage = self.store.get_coverage(group_id)
+        status = self.store.get_live_status(group_id)
+        if coverage is None or not status or not status[0]:
+            with self._resync_lock:
+                waiting = group_id in self._resync_pending or group_id == self._resyncing
+            if not waiting: self.request_resync(group_id)
+            return
+        newest_seq = coverage[2]
+        for seq in seqs:
+            if seq == newest_seq + 1:
+                newest_seq = seq
+            elif seq > newest_seq:
+                # seq 跳跃 (断线期间或撤回导致)，补齐后才能确认没有漏收
+                self.store.merge_coverage(group_id, coverage[0], coverage[1], newest_seq)
+                self.store.set_live_status(group_id, False, time.time())
+                self.request_resync(group_id)
+                return
+        # 补齐线程可能同时更新覆盖范围，只并入本批确认连续的部分
+        self.store.merge_coverage(group_id, coverage[0], coverage[1], newest_seq)
+        self.store.set_live_status(group_id, True, time.time())
+
+    # --- 补齐线程 ---
+    def request_resync(self, group_id):
+        with self._resync_lock:
+            self._resync_pending.add(int(group_id))
+            self._resync_lock.notify()
+
+    def _resync_loop(self):
+        while not self._stopping.is_set():
+            with self._resync_lock:
+                while not self._resync_pending and not self._stopping.is_set():
+                    self._resync_lock.wait(timeout=1)
+                if self._stopping.is_set():
+                    return
+                group_id = self._resync_pending.pop()
+                self._resyncing = group_id
+            start_ts = int(time.time() - gemini_test.FETCH_HOURS_AGO * 3600)
+            try:
+                gemini_test.sync_message_store(self.store, group_id, start_ts)
+                self.store.set_live_status(group_id, True, time.time())
+                self.resync_count += 1
+            except Exception as e:
+                print(f"[守护进程] 群 {group_id} 补齐失败，稍后重试: {e}")
+                time.sleep(5)
+                self.request_resync(group_id)
+            finally:
+                with self._resync_lock:
+                    self._resyncing = None
+
+    def _heartbeat_loop(self):
+        # 连接正常时定期刷新心跳，总结流程据此判断本地库是否可直接使用；顺带保存预下载图片的缓存索引
+        while not self._stopping.wait(10):
+            if self._last_event_at is not None and time.time() - self._last_event_at <= EVENT_STALE_SECONDS:
+                self.store.touch_live_groups(time.time())
+            self._save_image_cache()
+
+    def _save_image_cache(self):
+        if not self.image_pool:
+            return
+        try:
+            gemini_test.get_image_cache().save()
+        except OSError as e:
+            print(f"[守护进程] 保存图片缓存索引失败: {e}")
+
+    def start(self):
+        for target in (self._writer_loop, self._resync_loop, self._heartbeat_loop):
+            thread = threading.Thread(target=target, daemon=True, name=target.__name__.strip("_"))
+            thread.start()
+            self._threads.append(thread)
+        # 上次退出后可能漏收，启动时先补齐
+        for group_id in self.groups:
+            self.store.set_live_status(group_id, False, time.time())
+            self.request_resync(group_id)
+
+    def stop(self):
+        self.events.join()
+        self._stopping.set()
+        with self._resync_lock:
+            self._resync_lock.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        if self.image_pool:
+            self.image_pool.shutdown()
+            self._save_image_cache()
+
+    def report(self):
+        print(f"[守护进程] 收到事件 {self.received_count} 个，写入消息 {self.stored_count} 条，"
+              f"因队列已满拒绝 {self.dropped_count} 个，补齐 {self.resync_count} 次。")
+
+
+def make_event_handler(daemon):
+    class EventHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status, body=b""):
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            # HTTP 上报: 每个请求一个事件
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if EVENT_SECRET:
+                expected = "sha1=" + hmac.new(EVENT_SECRET.encode(), body, hashlib.sha1).hexdigest()
+                if not hmac.compare_digest(expected, self.headers.get("X-Signature", "")):
+                    self._reply(403)
+                    return
+            try:
+                event = json.loads(body)
+            except ValueError:
+                self._reply(400)
+                return
+            if event.get("post_type") == "meta_event":
+                daemon._mark_alive()
+                self._reply(204)
+                return
+            self._reply(204 if daemon.submit_event(event, timeout=EVENT_ENQUEUE_TIMEOUT) else 503)
+
+        def do_GET(self):
+            # 反向 WebSocket
+            if self.headers.get("Upgrade", "").lower() != "websocket":
+                self._reply(200, b"qq summary event daemon\n")
+                return
+            if EVENT_ACCESS_TOKEN:
+                token = self.headers.get("Authorization", "").replace("Bearer ", "").replace("Token ", "").strip()
+                if token != EVENT_ACCESS_TOKEN:
+                    self._reply(401)
+                    return
+            accept = base64.b64encode(hashlib.sha1(
+                (self.headers.get("Sec-WebSocket-Key", "") + WEBSOCKET_GUID).encode()).digest()).decode()
+            self.send_response(101)
+            self.send_header("Upgrade", "websocket")
+            self.send_header("Connection", "Upgrade")
+            self.send_header("Sec-WebSocket-Accept", accept)
+            self.end_headers()
+            self.wfile.flush()
+            self.close_connection = True
+            print(f"[守护进程] WebSocket 已连接: {self.client_address[0]} (X-Self-ID: {self.headers.get('X-Self-ID')})")
+            daemon.on_connected()
+            try:
+                for payload in iter_websocket_messages(self.rfile, self.wfile):
+                    try:
+                        event = json.loads(payload)
+                    except ValueError:
+                        continue
+                    if event.get("post_type") == "meta_event":
+                        daemon._mark_alive()
+                    elif "post_type" in event:
+                        daemon.submit_event(event)  # 队列满时阻塞，不再读取 socket，由 TCP 把背压传给 OneBot
+            except (ConnectionError, OSError) as e:
+                print(f"[守护进程] WebSocket 断开: {e}")
+            else:
+                print("[守护进程] WebSocket 已关闭。")
+
+        def log_message(self, *args):
+            pass
+
+    return EventHandler
+
+
+def serve(host=None, port=None, groups=None):
+    # 默认值在调用时读取，配置文件/环境变量覆盖的 EVENT_HOST 等才会生效
+    host = host or EVENT_HOST
+    port = port or EVENT_PORT
+    store = gemini_test.get_message_store()
+    daemon = EventIngestDaemon(store, groups if groups is not None else LIVE_INGEST_GROUPS)
+    daemon.start()
+    server = http.server.ThreadingHTTPServer((host, port), make_event_handler(daemon))
+    server.daemon_threads = True
+    print(f"[守护进程] 正在监听 http://{host}:{port}/ (HTTP 上报) 与 ws://{host}:{port}/onebot/v11/ws (反向 WebSocket)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n[守护进程] 正在退出，等待队列中的事件写入...")
+    finally:
+        server.server_close()
+        daemon.stop()
+        daemon.report()
+
+
+# --- 回放客户端: 把保存的事件 (JSONL) 重新推送给守护进程，用于本地测试 ---
+def _websocket_connect(url, access_token=None):
+    parts = urlsplit(url)
+    sock = socket.create_connection((parts.hostname, parts.port or 80), timeout=30)
+    key = base64.b64encode(os.urandom(16)).decode()
+    request = (f"GET {parts.path or '/'} HTTP/1.1\r\nHost: {parts.netloc}\r\nUpgrade: websocket\r\n"
+               f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n")
+    if access_token:
+        request += f"Authorization: Bearer {access_token}\r\n"
+    sock.sendall((request + "\r\n").encode())
+    rfile = sock.makefile("rb")
+    status_line = rfile.readline().decode(errors="replace")
+    while rfile.readline() not in (b"\r\n", b""):
+        pass
+    if " 101 " not in status_line:
+        sock.close()
+        raise ConnectionError(f"WebSocket 握手失败: {status_line.strip()}")
+    return sock, rfile, sock.makefile("wb")
+
+
+def replay_events(events_path, url, rate=None, access_token=None, secret=None):
+    """按顺序回放 JSONL 事件文件；url 为 ws:// 时走反向 WebSocket，否则走 HTTP 上报。rate 为每秒事件数。"""
+    with open(events_path, "r", encoding="utf-8") as f:
+        events = [line.strip() for line in f if line.strip()]
+    interval = 1.0 / rate if rate else 0
+    started = time.perf_counter()
+    rejected = 0
+    if url.startswith("ws"):
+        sock, _, wfile = _websocket_connect(url, access_token)
+        try:
+            for i, line in enumerate(events):
+                write_websocket_frame(wfile, 0x1, line.encode("utf-8"), masked=True)
+                if interval: time.sleep(max(0.0, started + (i + 1) * interval - time.perf_counter()))
+            write_websocket_frame(wfile, 0x8, struct.pack(">H", 1000), masked=True)
+        finally:
+            sock.close()
+    else:
+        import requests
+
+        session = requests.Session()
+        for i, line in enumerate(events):
+            body = line.encode("utf-8")
+            headers = {"Content-Type": "application/json"}
+            if secret:
+                headers["X-Signature"] = "sha1=" + hmac.new(secret.encode(), body, hashlib.sha1).hexdigest()
+            if session.post(url, data=body, headers=headers, timeout=30).status_code == 503:
+                rejected += 1
+            if interval: time.sleep(max(0.0, started + (i + 1) * interval - time.perf_counter()))
+    elapsed = time.perf_counter() - started
+    print(f"回放 {len(events)} 个事件，用时 {elapsed:.2f}s ({len(events) / elapsed if elapsed else 0:.0f} 个/s)，"
+          f"被拒绝 {rejected} 个。")
+
+
+if __name__ == "__main__":
+    import sys
+    import app_config
+
+    parser = argparse.ArgumentParser(description="OneBot 群消息实时接收守护进程")
+    parser.add_argument("--config", help=f"JSON/TOML 配置文件 (默认读取环境变量 {app_config.CONFIG_PATH_ENV})")
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="NAME=VALUE",
+                        help="覆盖单个配置项，值按 JSON 解析，可重复使用")
+    subparsers = parser.add_subparsers(dest="command")
+    serve_parser = subparsers.add_parser("serve", help="启动守护进程 (默认)")
+    serve_parser.add_argument("--host", default=None, help="默认 EVENT_HOST")
+    serve_parser.add_argument("--port", type=int, default=None, help="默认 EVENT_PORT")
+    replay_parser = subparsers.add_parser("replay", help="回放 JSONL 事件文件")
+    replay_parser.add_argument("events_path")
+    replay_parser.add_argument("--url", default=None,
+                               help="HTTP 上报地址，或 ws://.../onebot/v11/ws 走 WebSocket (默认 http://EVENT_HOST:EVENT_PORT/)")
+    replay_parser.add_argument("--rate", type=float, default=None, help="每秒回放的事件数，默认尽快发送")
+    args = parser.parse_args()
+    try:
+        # 与总结任务读取同一份配置，保证写入的是同一个消息库/图片缓存；[event_daemon] 表只作用于本模块
+        app_config.load_config([sys.modules[__name__], gemini_test], args.config, args.overrides)
+    except app_config.ConfigError as e:
+        print(f"错误: {e}")
+        sys.exit(2)
+    if args.command == "replay":
+        replay_events(args.events_path, args.url or f"http://{EVENT_HOST}:{EVENT_PORT}/", args.rate,
+                      EVENT_ACCESS_TOKEN, EVENT_SECRET)
+    else:
+        serve(getattr(args, "host", None), getattr(args, "port", None))
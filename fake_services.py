@@ -0,0 +1,336 @@
+import http.server
+import io
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import types
+
+from upload_cache import DEFAULT_FILE_TTL_SECONDS
+
+
+class FakeFilesBackend:
+    """Files API / 上下文缓存的本地替身：内容保存在内存中，可设置有效期与上传延迟，用于离线验证上传缓存。"""
+
+    def __init__(self, file_ttl=DEFAULT_FILE_TTL_SECONDS, upload_latency=0.0):
+        self.file_ttl = file_ttl
+        self.upload_latency = upload_latency
+        self.files = {}
+        self.contexts = {}
+        self.upload_count = 0
+        self.uploaded_bytes = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def upload(self, path, mime_type):
+        with open(path, "rb") as f:
+            data = f.read()
+        if self.upload_latency:
+            time.sleep(self.upload_latency)
+        with self._lock:
+            name = f"files/fake-{next(self._ids)}"
+            expires_at = time.time() + self.file_ttl
+            self.files[name] = (data, mime_type, expires_at)
+            self.upload_count += 1
+            self.uploaded_bytes += len(data)
+        return {"name": name, "uri": f"fake://{name}", "mime_type": mime_type, "expires_at": expires_at}
+
+    def create_context_cache(self, model, text, ttl_seconds):
+        with self._lock:
+            name = f"cachedContents/fake-{next(self._ids)}"
+            expires_at = time.time() + ttl_seconds
+            self.contexts[name] = (model, text, expires_at)
+        return {"name": name, "expires_at": expires_at}
+
+    def is_live(self, name):
+        # 模拟服务端校验：已删除或过期的引用不可用
+        entry = self.files.get(name) or self.contexts.get(name)
+        return entry is not None and entry[-1] > time.time()
+
+    def expire_all(self):
+        with self._lock:
+            self.files.clear()
+            self.contexts.clear()
+
+
+class FakeOneBotServer:
+    """本地假 LLOneBot: 提供合成的 get_group_msg_history 分页与图片 URL，用于离线基准测试。
+
+    消息均匀分布在最近 span_hours 小时内；image_ratio 比例的消息带一张图片，其中 gif_ratio 比例为 GIF，
+    图片从 distinct_images 张不同的合成图中按固定随机种子选取，reply_ratio 比例的消息回复之前的某条消息，
+    相同参数每次生成完全相同的数据。
+    """
+
+    def __init__(self, message_count=5000, span_hours=30, image_ratio=0.2, gif_ratio=0.1, distinct_images=None,
+                 image_size=(800, 600), api_latency=0.0, image_latency=0.0, seed=1, group_id=10000, reply_ratio=0.0):
+        self.api_latency = api_latency
+        self.image_latency = image_latency
+        self.image_size = image_size
+        self.group_id = group_id
+        self.now = int(time.time())
+        self.api_calls = 0
+        self.image_calls = 0
+        self.sent_forwards = []  # 收到的 send_group_forward_msg 请求 (group_id, messages)
+        self._image_bytes = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self.base_url = None
+
+        rng = random.Random(seed)
+        image_message_count = int(message_count * image_ratio)
+        distinct_images = distinct_images or max(1, image_message_count)
+        interval = span_hours * 3600 / max(1, message_count)
+        self.messages = []
+        for i in range(message_count):
+            segments = [{"type": "text", "data": {"text": f"第{i}条消息 " + "测试内容" * rng.randint(1, 8)}}]
+            if reply_ratio and i and rng.random() < reply_ratio:
+                # 回复之前的某条消息 (可能早于统计窗口)
+                segments.insert(0, {"type": "reply", "data": {"id": str(100000 + rng.randrange(i))}})
+            if rng.random() < image_ratio:
+                image_id = rng.randrange(distinct_images)
+                ext = "gif" if rng.random() < gif_ratio else "png"
+                segments.append({"type": "image", "data": {"file": f"{image_id:08X}.{ext}",
+                                                           "url": f"/img/{image_id}.{ext}?rkey={i}"}})
+            self.messages.append({
+                "time": int(self.now - (message_count - i) * interval),
+                "message_seq": i + 1,
+                "message_id": 100000 + i,
+                "user_id": 20000 + rng.randrange(50),
+                "sender": {"card": f"群友{rng.randrange(50)}"},
+                "message": segments,
+            })
+
+    def history_page(self, message_seq=None, count=20):
+        # 与 LLOneBot 相同: 返回 seq 不大于 message_seq 的最后 count 条，旧的在前
+        end = len(self.messages) if message_seq is None else max(0, min(len(self.messages), int(message_seq)))
+        return self.messages[max(0, end - int(count)):end]
+
+    def image_bytes(self, name):
+        with self._lock:
+            if name in self._image_bytes:
+                return self._image_bytes[name]
+        from PIL import Image, ImageDraw
+
+        image_id, ext = name.rsplit(".", 1)
+        rng = random.Random(int(image_id))
+        im = Image.new("RGB", self.image_size, tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(im)
+        for _ in range(12):
+            x0, y0 = rng.randrange(self.image_size[0]), rng.randrange(self.image_size[1])
+            draw.rectangle([x0, y0, x0 + rng.randrange(40, 300), y0 + rng.randrange(40, 300)],
+                           fill=tuple(rng.randrange(256) for _ in range(3)))
+        buf = io.BytesIO()
+        if ext == "gif":
+            frames = [im, im.transpose(Image.FLIP_LEFT_RIGHT)]
+            frames[0].save(buf, "GIF", save_all=True, append_images=frames[1:], duration=100, loop=0)
+        else:
+            im.save(buf, "PNG")
+        data = buf.getvalue()
+        with self._lock:
+            self._image_bytes[name] = data
+        return data
+
+    def prerender_images(self):
+        # 预先生成所有图片，避免基准计时中混入假服务器自身的绘图开销
+        names = {segment["data"]["file"] for msg_obj in self.messages for segment in msg_obj["message"]
+                 if segment["type"] == "image"}
+        for name in names:
+            self.image_bytes(f"{int(name.split('.')[0], 16)}.{name.rsplit('.', 1)[1]}")
+        return len(names)
+
+    def start(self):
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _send(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                params = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                with fake._lock:
+                    fake.api_calls += 1
+                if fake.api_latency: time.sleep(fake.api_latency)
+                action = self.path.rstrip("/").rsplit("/", 1)[-1]
+                if action == "get_group_msg_history":
+                    messages = fake.history_page(params.get("message_seq"), params.get("count", 20))
+                    body = {"status": "ok", "retcode": 0,
+                            "data": {"messages": [dict(m, group_id=fake.group_id) for m in messages]}}
+                elif action == "send_group_forward_msg":
+                    with fake._lock:
+                        fake.sent_forwards.append((params.get("group_id"), params.get("messages")))
+                        message_id = 900000 + len(fake.sent_forwards)
+                    body = {"status": "ok", "retcode": 0, "data": {"message_id": message_id}}
+                elif action == "get_msg":
+                    index = int(params.get("message_id", 0)) - 100000
+                    if 0 <= index < len(fake.messages):
+                        body = {"status": "ok", "retcode": 0, "data": dict(fake.messages[index], group_id=fake.group_id)}
+                    else:
+                        body = {"status": "failed", "retcode": 1200, "msg": "消息不存在"}
+                elif action == "get_login_info":
+                    body = {"status": "ok", "retcode": 0, "data": {"user_id": 10001, "nickname": "bot"}}
+                else:
+                    body = {"status": "failed", "retcode": 1404, "msg": "不支持的 action"}
+                self._send(200, json.dumps(body, ensure_ascii=False).encode("utf-8"), "application/json")
+
+            def do_GET(self):
+                with fake._lock:
+                    fake.image_calls += 1
+                if fake.image_latency: time.sleep(fake.image_latency)
+                name = self.path.split("?")[0].rsplit("/", 1)[-1]
+                self._send(200, fake.image_bytes(name), "image/gif" if name.endswith(".gif") else "image/png")
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self._server.server_port}"
+        # 图片 URL 指向本服务器
+        for msg_obj in self.messages:
+            for segment in msg_obj["message"]:
+                if segment["type"] == "image" and segment["data"]["url"].startswith("/"):
+                    segment["data"]["url"] = self.base_url + segment["data"]["url"]
+        return self.base_url
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class _FakeChunk:
+    def __init__(self, text, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class _FakeUsage:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.cached_content_token_count = None
+        self.thoughts_token_count = None
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+    def __repr__(self):
+        return (f"FakeUsage(prompt={self.prompt_token_count}, candidates={self.candidates_token_count}, "
+                f"total={self.total_token_count})")
+
+
+class FakeAPIError(Exception):
+    # 与 google.genai.errors.APIError 一样带 HTTP 状态码 code
+    def __init__(self, code, message):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class _FakeModels:
+    def __init__(self, client):
+        self._client = client
+
+    def generate_content_stream(self, model, contents, config=None):
+        return self._client.stream_reply(model, contents, config)
+
+
+class _FakeFiles:
+    # client.files 的替身，上传到 FakeFilesBackend，供 GeminiFilesBackend 直接使用
+    def __init__(self, backend):
+        self._backend = backend
+
+    def upload(self, file, config=None):
+        ref = self._backend.upload(file, (config or {}).get("mime_type"))
+        return types.SimpleNamespace(name=ref["name"], uri=ref["uri"], mime_type=ref["mime_type"],
+                                     expiration_time=None)
+
+
+class FakeGeminiClient:
+    """google-genai Client 的本地替身: generate_content_stream 按设定的首块延迟与块间隔流式返回一份格式合规的报告。
+
+    报告中的主题从请求里的聊天记录行中挑选，便于下游解析/发布流程在离线时也能跑通。
+    """
+
+    def __init__(self, first_chunk_latency=0.5, chunk_interval=0.02, chunk_count=20, topic_count=3, quotes_per_topic=4,
+                 fail_times=0, rpm_limit=None, retry_delay=2, files_backend=None, key_rejected=False):
+        self.first_chunk_latency = first_chunk_latency
+        self.chunk_interval = chunk_interval
+        self.chunk_count = chunk_count
+        self.topic_count = topic_count
+        self.quotes_per_topic = quotes_per_topic
+        self.fail_times = fail_times
+        self.rpm_limit = rpm_limit  # 模拟服务端每分钟请求数限制，超出时返回 429 (带 retryDelay)
+        self.retry_delay = retry_delay
+        self.files_backend = files_backend  # 设置后像服务端一样校验请求引用的文件/上下文缓存，失效时返回 403
+        self.files = _FakeFiles(files_backend) if files_backend is not None else None
+        self.key_rejected = key_rejected  # 模拟 Key 被停用，所有请求返回 403
+        self.request_count = 0
+        self.rate_limited_count = 0
+        self._request_times = []
+        self.models = _FakeModels(self)
+        self._lock = threading.Lock()
+        # 兼容完整格式 "时间 名片(QQ号): 内容" 与压缩后的 "时间 U1,U2: 内容"
+        self._line_pattern = re.compile(r"^(\d{2}:\d{2}:\d{2}) (.*?)(?:\((\d*)\))?: (.*)$", re.M)
+
+    def build_report(self, request_text):
+        lines = self._line_pattern.findall(request_text)
+        parts = ["1.  **主要讨论方向概述**：\n    群友们在闲聊，并讨论了若干话题。\n\n2.  **详细主题分析**：\n"]
+        if not lines:
+            parts.append("未能识别出明确的独立讨论主题。\n")
+        per_topic = max(1, len(lines) // max(1, self.topic_count))
+        for t in range(min(self.topic_count, len(lines))):
+            picked = lines[t * per_topic:t * per_topic + self.quotes_per_topic]
+            quotes = "\n".join(f"<<{tm},{name.split(',')[0]},{uid},{text[:60]}>>" for tm, name, uid, text in picked)
+            parts.append(f"话题{t + 1}总结：群友讨论了第{t + 1}个话题。\n{{{quotes}}}\n\n")
+        return "".join(parts)
+
+    def check_refs(self, contents, config):
+        if self.files_backend is None:
+            return
+        names = [part.file_data.file_uri[len("fake://"):] for content in contents for part in content.parts
+                 if getattr(part, "file_data", None) is not None]
+        if config is not None and getattr(config, "cached_content", None):
+            names.append(config.cached_content)
+        for name in names:
+            if not self.files_backend.is_live(name):
+                raise FakeAPIError(403, f"PERMISSION_DENIED: You do not have permission to access {name} "
+                                        "or it may not exist.")
+
+    def stream_reply(self, model, contents, config):
+        with self._lock:
+            self.request_count += 1
+            if self.key_rejected:
+                raise FakeAPIError(403, "PERMISSION_DENIED: API key has been suspended (fake)")
+            now = time.monotonic()
+            self._request_times = [t for t in self._request_times if t > now - 60]
+            if self.rpm_limit is not None and len(self._request_times) >= self.rpm_limit:
+                self.rate_limited_count += 1
+                raise FakeAPIError(429, "RESOURCE_EXHAUSTED (fake) "
+                                        f"{{'retryDelay': '{self.retry_delay}s'}}")
+            self._request_times.append(now)
+            self.check_refs(contents, config)
+            should_fail = self.fail_times > 0
+            if should_fail: self.fail_times -= 1
+        request_text = "".join(getattr(part, "text", None) or "" for content in contents for part in content.parts)
+        image_count = sum(1 for content in contents for part in content.parts if not getattr(part, "text", None))
+        report = self.build_report(request_text)
+        usage = _FakeUsage(len(request_text) // 2 + image_count * 258, len(report) // 2)
+
+        def generate():
+            time.sleep(self.first_chunk_latency)
+            if should_fail:
+                raise FakeAPIError(503, "UNAVAILABLE (fake)")
+            step = max(1, len(report) // max(1, self.chunk_count))
+            for start in range(0, len(report), step):
+                if start: time.sleep(self.chunk_interval)
+                end = start + step
+                yield _FakeChunk(report[start:end], usage if end >= len(report) else None)
+
+        return generate()
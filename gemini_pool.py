@@ -0,0 +1,241 @@
+import random
+import re
+import threading
+import time
+from collections import deque
+
+TRANSIENT_STATUS_CODES = {500, 502, 503, 504}
+KEY_REJECTED_STATUS_CODES = {401, 403}
+_STATUS_MARKERS = (("RESOURCE_EXHAUSTED", 429), ("UNAVAILABLE", 503), ("DEADLINE_EXCEEDED", 504),
+                   ("INTERNAL", 500), ("PERMISSION_DENIED", 403), ("UNAUTHENTICATED", 401))
+_LEADING_STATUS_PATTERN = re.compile(r"\s*(\d{3})\b")
+_RETRY_DELAY_PATTERN = re.compile(r"retryDelay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s")
+
+
+class GeminiPoolExhausted(Exception):
+    pass
+
+
+def error_status_code(error):
+    """从 google-genai 的 APIError (有 code 属性) 或错误信息中识别 HTTP 状态码；识别不出时返回 None。"""
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if isinstance(code, int):
+        return code
+    text = str(error)
+    for marker, status in _STATUS_MARKERS:
+        if marker in text:
+            return status
+    match = _LEADING_STATUS_PATTERN.match(text)
+    return int(match.group(1)) if match else None
+
+
+def is_network_error(error):
+    return isinstance(error, (ConnectionError, TimeoutError)) or any(
+        word in type(error).__name__ for word in ("Timeout", "Connect", "Network", "Protocol"))
+
+
+class GeminiEndpoint:
+    # 一个 (API Key, 模型) 组合及其最近60秒内的请求/token 记录
+    def __init__(self, api_key, model, rpm=None, tpm=None):
+        self.api_key = api_key
+        self.model = model
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = deque()  # [开始时间, token 数]，请求结束后用实际用量替换估算值
+        self.cooldown_until = 0.0
+        self.disabled = False
+        self.in_flight = 0
+        self.calls = 0
+        self.rate_limited = 0
+        self.errors = 0
+
+    @property
+    def label(self):
+        return f"{self.model}@…{self.api_key[-4:]}"
+
+    def available_at(self, now, tokens):
+        """最早可以再发一个约 tokens 大小请求的时间；已停用时返回 None。"""
+        if self.disabled:
+            return None
+        while self.window and self.window[0][0] <= now - 60:
+            self.window.popleft()
+        ready = max(now, self.cooldown_until)
+        if self.rpm and len(self.window) >= self.rpm:
+            ready = max(ready, self.window[len(self.window) - self.rpm][0] + 60)
+        if self.tpm:
+            used = sum(entry[1] for entry in self.window)
+            for started, entry_tokens in self.window:
+                if used + tokens <= self.tpm:
+                    break
+                used -= entry_tokens
+                ready = max(ready, started + 60)
+        return ready
+
+
+class GeminiClientPool:
+    """在多个 API Key 与模型之间分配 Gemini 请求，线程安全，可被并发的总结任务共用。
+
+    每个 (Key, 模型) 按 RPM/TPM 预算限流，额度不足时排队等待 (最多 max_wait 秒)；
+    429 让该 Key 冷却 (优先使用服务端给出的 retryDelay)，换其他 Key 重试；5xx 与网络错误按带抖动的指数退避重试，
+    主模型连续失败 failover_after 次或所有 Key 都排不上队时，依次改用 fallback 模型。
+    已经开始输出的请求失败时不会重试 (避免重复内容)，由调用方处理。
+    请求引用了远程文件/上下文缓存时 (它们只属于上传时的 Key)，由调用方传入 build(endpoint) 为选中的 Key/模型构建内容；
+    这类请求收到 403 时多半是引用不属于该 Key 或已失效，直接抛给调用方处理，不停用 Key。
+    """
+
+    def __init__(self, endpoints, client_factory, max_attempts=6, backoff_base=1.0, backoff_max=30.0, max_wait=120,
+                 failover_after=2, metrics=None):
+        self.endpoints = list(endpoints)
+        self.models = list(dict.fromkeys(endpoint.model for endpoint in self.endpoints))
+        self._client_factory = client_factory
+        self._clients = {}
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_wait = max_wait
+        self.failover_after = max(1, failover_after)
+        self.metrics = metrics
+        self._cond = threading.Condition()
+        self.queued_seconds = 0.0
+
+    def _incr(self, counter):
+        if self.metrics: self.metrics.incr(counter)
+
+    def client_for(self, api_key):
+        with self._cond:
+            client = self._clients.get(api_key)
+            if client is None:
+                client = self._clients[api_key] = self._client_factory(api_key)
+            return client
+
+    def _acquire(self, model, tokens, api_key=None):
+        # 选可最早发出的 Endpoint (相同时选并发数少的)，需要等待时在条件变量上等；超过 max_wait 返回 None
+        deadline = time.monotonic() + self.max_wait
+        waited_from = None
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                candidates = []
+                for index, endpoint in enumerate(self.endpoints):
+                    if endpoint.model != model or (api_key is not None and endpoint.api_key != api_key):
+                        continue
+                    ready = endpoint.available_at(now, tokens)
+                    if ready is not None:
+                        candidates.append((ready, endpoint.in_flight, index, endpoint))
+                if not candidates:
+                    return None
+                ready, _, _, endpoint = min(candidates)
+                if ready <= now:
+                    if waited_from is not None: self.queued_seconds += now - waited_from
+                    entry = [now, tokens]
+                    endpoint.window.append(entry)
+                    endpoint.in_flight += 1
+                    return endpoint, entry
+                if ready > deadline:
+                    return None
+                if waited_from is None:
+                    waited_from = now
+                    self._incr("gemini_queued")
+                self._cond.wait(timeout=ready - now)
+
+    def _release(self, endpoint, entry, actual_tokens):
+        with self._cond:
+            endpoint.in_flight -= 1
+            if actual_tokens: entry[1] = actual_tokens
+            self._cond.notify_all()
+
+    def _backoff_seconds(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def generate_content_stream(self, contents, config=None, estimated_tokens=0, model=None, api_key=None):
+        """与 client.models.generate_content_stream 相同地逐块返回；指定 model/api_key 时只用对应的 Endpoint (不换模型)。
+
+        contents 也可以是 build(endpoint) -> (contents, config, uses_remote_refs)，每次尝试前为选中的 Endpoint 调用。
+        """
+        models = [model] if model else self.models
+        model_index = 0
+        failures_on_model = 0
+        last_error = None
+        for attempt in range(self.max_attempts):
+            acquired = self._acquire(models[model_index], estimated_tokens, api_key)
+            if acquired is None:
+                if model_index + 1 < len(models):
+                    print(f"  [Gemini池] {models[model_index]} 没有可用的额度，改用 {models[model_index + 1]}。")
+                    self._incr("gemini_failovers")
+                    model_index, failures_on_model = model_index + 1, 0
+                    continue
+                break
+            endpoint, entry = acquired
+            started_output = False
+            actual_tokens = None
+            uses_remote_refs = False
+            try:
+                if callable(contents):
+                    request_contents, request_config, uses_remote_refs = contents(endpoint)
+                else:
+                    request_contents, request_config = contents, config
+                stream = self.client_for(endpoint.api_key).models.generate_content_stream(
+                    model=endpoint.model, contents=request_contents, config=request_config)
+                for chunk in stream:
+                    started_output = True
+                    usage = getattr(chunk, "usage_metadata", None)
+                    if usage is not None and getattr(usage, "total_token_count", None):
+                        actual_tokens = usage.total_token_count
+                    yield chunk
+                with self._cond:
+                    endpoint.calls += 1
+                return
+            except Exception as e:
+                last_error = e
+                status = error_status_code(e)
+                with self._cond:
+                    endpoint.errors += 1
+                if started_output or not (status == 429 or status in TRANSIENT_STATUS_CODES
+                                          or status in KEY_REJECTED_STATUS_CODES or is_network_error(e)):
+                    raise
+                if status == 403 and uses_remote_refs:
+                    raise
+                if status == 429:
+                    delay_match = _RETRY_DELAY_PATTERN.search(str(e))
+                    cooldown = float(delay_match.group(1)) if delay_match else self._backoff_seconds(attempt) + 1
+                    with self._cond:
+                        endpoint.rate_limited += 1
+                        endpoint.cooldown_until = time.monotonic() + cooldown
+                    print(f"  [Gemini池] {endpoint.label} 触发限流，冷却 {cooldown:.0f}s 后再用，先换其他 Key 重试。")
+                    self._incr("gemini_rate_limited")
+                elif status in KEY_REJECTED_STATUS_CODES:
+                    with self._cond:
+                        endpoint.disabled = True
+                        self._cond.notify_all()
+                    print(f"  [Gemini池] {endpoint.label} 被拒绝 ({status})，本次运行不再使用该 Key。")
+                else:
+                    failures_on_model += 1
+                    delay = self._backoff_seconds(attempt)
+                    print(f"  [Gemini池] {endpoint.label} 暂时不可用 ({e})，{delay:.1f}s 后重试。")
+                    self._incr("gemini_retries")
+                    time.sleep(delay)
+                    if failures_on_model >= self.failover_after and model_index + 1 < len(models):
+                        print(f"  [Gemini池] {models[model_index]} 连续失败 {failures_on_model} 次，"
+                              f"改用 {models[model_index + 1]}。")
+                        self._incr("gemini_failovers")
+                        model_index, failures_on_model = model_index + 1, 0
+            finally:
+                self._release(endpoint, entry, actual_tokens)
+        with self._cond:
+            all_disabled = all(endpoint.disabled for endpoint in self.endpoints if endpoint.model in models)
+        if all_disabled:
+            raise GeminiPoolExhausted("所有 Key 都已被拒绝 (401/403)，本次运行无法继续请求"
+                                      + (f": {last_error}" if last_error is not None else ""))
+        if last_error is None:
+            raise GeminiPoolExhausted(f"等待 {self.max_wait}s 后仍没有可用的 Key/模型额度")
+        raise GeminiPoolExhausted(f"尝试 {self.max_attempts} 次后仍未成功: {last_error}")
+
+    def report(self):
+        used = [endpoint for endpoint in self.endpoints if endpoint.calls or endpoint.errors]
+        if not used:
+            return
+        print(f"  [Gemini池] 排队等待额度共 {self.queued_seconds:.1f}s；各 Key/模型:")
+        for endpoint in used:
+            state = " (已停用)" if endpoint.disabled else ""
+            print(f"    {endpoint.label:<40} 成功 {endpoint.calls:>4} 次  失败 {endpoint.errors:>3} 次  "
+                  f"限流 {endpoint.rate_limited:>3} 次{state}")
@@ -1,59 +1,197 @@
 import requests
 import datetime
+import hashlib
+import heapq
 import time
 import json
+from concurrent.futures import ThreadPoolExecutor
 import os
 import re  # For sanitizing filenames
 import mimetypes  # For guessing MIME types
-
-# Gemini AI Specific Imports as provided by user
-from google import genai
-from google.genai import types as genai_types
-
-# Pillow for GIF processing
-try:
-    from PIL import Image as PILImage
-
-    PILLOW_AVAILABLE = True
-except ImportError:
-    PILLOW_AVAILABLE = False
-    # This warning will be printed when the script starts if Pillow is missing.
+import threading
+
+from image_cache import ImageCache, image_source_key
+from image_pool import ImageDownloadPool
+from image_preprocess import (PILLOW_AVAILABLE, RECOMPRESS_EXTENSIONS, ImageDeduper, compact_image,
+                              extract_gif_first_frame)
+from media_pool import MediaWorkerPool, extract_video_keyframe
+from message_store import MessageStore
+from upload_cache import GeminiFilesBackend, UploadCache, is_stale_ref_error
+from run_metrics import RunMetrics
+from report_parser import (IMAGE_REF_PATTERN, QuotedMessage, StreamingTopicParser, Topic, TopicFileWriter,
+                           parse_report_topics, render_topics, resolve_quote_times)
+from prompt_planner import IMAGE_TOKEN_ESTIMATE, estimate_text_tokens, estimate_transcript_tokens, plan_chunks
+from gemini_pool import GeminiClientPool, GeminiEndpoint, GeminiPoolExhausted
+from onebot_client import OneBotClient, OneBotError, RateLimiter
+from publisher import SummaryPublisher
+from reply_resolver import ReplyContextResolver
+from transcript_compactor import TranscriptCompactor
+
+# Gemini SDK 导入需要约半秒，只在真正调用 Gemini 时由 load_genai() 导入；只拉取消息/构建提示词的运行不受影响
+genai = None
+genai_types = None
+_genai_import_lock = threading.Lock()
 
 # --- 用户配置 ---
 LLONEBOT_API_URL = "http://127.0.0.1:3000"
+ONEBOT_ACCESS_TOKEN = None  # OneBot 的 Access Token，如果有的话
 TARGET_GROUP_ID = 1021625002
 REQUEST_TIMEOUT = 10
+IMAGE_DOWNLOAD_MAX_WORKERS = 8  # 图片下载/处理的最大并发数，设为 1 即退回串行
+IMAGE_DOWNLOAD_PER_HOST_LIMIT = 4  # 对同一图片主机的最大并发连接数
 DELAY_BETWEEN_REQUESTS = 0.1
+ONEBOT_POOL_SIZE = 10  # OneBot 连接池大小 (keep-alive 连接数)
+ONEBOT_MAX_RETRIES = 3  # 网络错误、超时或 429/5xx 时的最大重试次数 (带抖动的指数退避)
+ONEBOT_RATE_LIMIT = None  # 对 OneBot 的每秒最大请求数，None 表示不限速
 MAX_FETCH_LOOPS = 20
-IMAGE_DOWNLOAD_DIR = "downloaded_qq_images_for_gemini"
+HISTORY_PAGE_SIZE = 100  # 每次 get_group_msg_history 拉取的消息条数
+# 拉取方式: "seek" 先按时间定位窗口起点的 message_seq 再向后顺序拉取，请求数只与窗口大小有关;
+#          "backward" 从最新消息开始逐页向前翻 (旧行为，受 MAX_FETCH_LOOPS 限制)
+FETCH_MODE = "seek"
+MAX_SEEK_FORWARD_PAGES = 500  # seek 模式下向后顺序拉取的最大页数，防止异常情况下无限拉取
+USE_MESSAGE_STORE = True  # 使用本地消息库，每次运行只拉取上次之后的新消息
+MESSAGE_STORE_PATH = "qq_messages.sqlite3"
+# 实时接收守护进程 (event_daemon.py) 在线且未漏收时，本地消息库已经是最新的，总结时不再调用历史消息接口。
+# 守护进程的心跳超过该秒数未更新则视为离线，回退到拉取历史；None 表示总是拉取
+LIVE_INGEST_MAX_STALENESS = 90
+IMAGE_DOWNLOAD_DIR = "downloaded_qq_images_for_gemini"  # 图片缓存目录，按内容哈希存放，所有群共用
+IMAGE_CACHE_MAX_BYTES = 2 * 1024 ** 3  # 图片缓存的磁盘上限，超出后按最近最少使用淘汰
+IMAGE_MAX_EDGE = 1024  # 发送前把图片缩放到最长边不超过该像素数
+IMAGE_RECOMPRESS_FORMAT = "WEBP"  # 发送前重新编码的格式 ("WEBP"/"JPEG"/"PNG")，None 表示保持原图
+IMAGE_RECOMPRESS_QUALITY = 80
+USE_MEDIA_PROCESS_POOL = True  # GIF取帧、缩放重编码、视频关键帧提取在独立进程中并行执行
+MEDIA_POOL_WORKERS = None  # 媒体处理进程数，None 表示使用全部 CPU 核心
+MEDIA_JOB_TIMEOUT = 30  # 单个媒体处理任务的超时秒数
+MEDIA_JOB_MEMORY_LIMIT_MB = 1024  # 每个媒体处理进程的内存上限 (仅类 Unix 系统生效)
+VIDEO_KEYFRAME_EXTRACTORS = ["opencv", "ffmpeg"]  # 依次尝试的视频关键帧提取器，也可写 "模块名:函数名"
+VIDEO_MAX_DOWNLOAD_BYTES = 50 * 1024 ** 2  # 超过该大小的视频不下载
+IMAGE_DEDUP_MAX_DISTANCE = 4  # 感知哈希 (dHash) 距离不超过该值的图片视为近似重复，只附带一次；None 表示只去除完全相同的图片
+# 回复消息: 把 [回复] 展开为被回复消息的发送者与摘录。依次从本次窗口、本地消息库中查找，都没有时才并发调用 get_msg
+RESOLVE_REPLY_CONTEXT = True
+REPLY_EXCERPT_CHARS = 30  # 摘录的最大字数
+REPLY_FETCH_MAX_WORKERS = 4  # 并发 get_msg 请求数
+REPLY_CACHE_SIZE = 4096  # 被回复消息上下文的 LRU 缓存条数 (多群/多次运行共用)
 GEMINI_MODEL_NAME = "gemini-2.5-flash-preview-05-20"  # Matching user example
+# 多 Key / 多模型调度: 请求在所有 Key 之间分配，按每个 Key 的 RPM/TPM 预算排队；429 时换 Key，主模型持续失败时改用备用模型
+GEMINI_API_KEYS = []  # 除 GEMINI_API_KEY_VALUE 外的其他 Key
+GEMINI_FALLBACK_MODELS = []  # 例如 ["gemini-2.0-flash"]，按顺序尝试
+GEMINI_RPM_PER_KEY = 10  # 每个 Key 每个模型每分钟请求数，None 为不限
+GEMINI_TPM_PER_KEY = 250000  # 每个 Key 每个模型每分钟 token 数 (按估算值预留，完成后按实际用量修正)，None 为不限
+GEMINI_MODEL_RATE_LIMITS = {}  # 按模型覆盖上面两项，例如 {"gemini-2.0-flash": (15, 1000000)}
+GEMINI_MAX_ATTEMPTS = 6  # 单次请求最多尝试次数 (含换 Key / 换模型)
+GEMINI_MAX_QUEUE_SECONDS = 120  # 额度不足时最多排队等待的秒数，超过则换备用模型或放弃
 
 # 新增：统计的小时数
 FETCH_HOURS_AGO = 24  # 例如: 24 代表过去24小时, 12 代表过去12小时
 
 # 新增：最大处理消息数量限制
-MAX_MESSAGES_TO_PROCESS = 1500  # 设置一个上限，防止处理过多消息
+# 超出单次请求预算的窗口会被切块后分别总结再合并 (见下方 map-reduce 配置)，因此这里只是防止异常情况的安全上限
+MAX_MESSAGES_TO_PROCESS = 20000
+
+# 记录压缩: 发言者的 "名片(QQ号)" 换成短代号 (附一次图例)，连续的相同发言合并计数，丢弃空消息；
+# 回复中的代号会自动还原为原名片与QQ号
+TRANSCRIPT_COMPACTION = True
+
+# 分块总结 (map-reduce) 配置: 估算 token 数超过 SINGLE_REQUEST_TOKEN_BUDGET 时，
+# 把记录切成不超过 CHUNK_TOKEN_BUDGET 的时间连续片段并发总结，再合并为同样结构的最终报告
+SINGLE_REQUEST_TOKEN_BUDGET = 200000
+CHUNK_TOKEN_BUDGET = 60000
+MAP_REDUCE_MAX_CONCURRENCY = 4
+
+# 增量总结: 按上一次总结之后的新消息 + 上次总结中仍在窗口内的主题生成报告，不再重复发送整段窗口
+# (需要 USE_MESSAGE_STORE，且统计窗口不超过24小时)
+INCREMENTAL_SUMMARY = False
+INCREMENTAL_MAX_CHAIN = 12  # 连续增量总结该次数后做一次完整总结，避免误差累积
+
+# 运行指标: 每次运行结束时追加一行 JSON，或写成 Prometheus textfile (node_exporter textfile collector)，None 表示不输出
+METRICS_JSONL_PATH = "run_metrics.jsonl"
+METRICS_PROMETHEUS_PATH = None
+VERBOSE_PAYLOAD_DUMP = False  # 为 True 时打印每一页历史消息的完整 JSON (仅调试用，大页面时很慢)
+
+# 上传缓存: 图片通过 Files API 上传一次，按内容哈希在有效期内跨运行复用，重叠的时间窗口不再重复上传
+USE_UPLOAD_CACHE = True
+UPLOAD_CACHE_INDEX_PATH = "gemini_upload_cache.json"
+UPLOAD_MIN_BYTES = 32 * 1024  # 小于该大小的图片直接内联发送
+UPLOAD_MAX_WORKERS = 8
+USE_PROMPT_CONTEXT_CACHE = False  # 固定提示词前缀使用上下文缓存 (前缀需达到模型的最小缓存 token 数，否则创建失败并自动回退)
+PROMPT_CONTEXT_CACHE_TTL_SECONDS = 3600
+# 单次请求内联发送的图片总字节数上限 (Gemini 请求体上限 20MB，base64 编码后约膨胀 4/3)，超出的图片通过 Files API 上传后引用
+INLINE_IMAGE_BYTES_BUDGET = 14 * 1024 ** 2
+
+# 发布: 报告按主题以合并转发消息发回这些群，报告生成过程中已完成的主题即开始发送；为空表示只打印不发送
+PUBLISH_GROUP_IDS = []
+PUBLISH_RATE_LIMIT = 0.5  # 所有群合计每秒最多发送的合并转发条数
+PUBLISH_NODE_NICKNAME = "群聊总结"
+PUBLISH_NODE_USER_ID = None  # 总结节点显示的QQ号，None 表示使用机器人自己的QQ号
+PUBLISH_ATTACH_IMAGES = True  # 引用的发言中的《图片N》替换为对应图片
+# 报告生成过程中解析出的主题逐个写入 该目录/<群号>_<时间>.jsonl (每行一个主题)，None 表示不保存
+REPORT_TOPICS_DIR = "summary_topics"
 
 # Moved prompt prefix to configuration
-# The {fetch_hours} placeholder will  be replaced by the value of FETCH_HOURS_AGO
-GEMINI_PROMPT_PREFIX = (
-    f"这是过去{FETCH_HOURS_AGO}小时的部分QQ群聊记录。其中《图片N》代表按顺序提供的第N张图（部分图片可能来自GIF等）。\n"
-    "请用中文结合所有文本和图片信息进行分析和回应。请按照以下指示和结构进行回复：\n\n"
-    "1.  **主要讨论方向概述**：\n"
-    f"    简要总结过去{FETCH_HOURS_AGO}小时内群聊的整体讨论方向或最核心的主题,同一个方向的不同事件应该分别说明。如果无明显核心，请说明情况。\n\n"
-    "2.  **详细主题分析**：\n"
-    "    请分条列举各个具体讨论主题。对于每个主题：\n"
-    "    a.  首先，给出该主题的**总结**，这部分内容不要超过50字。\n"
-    "    b.  然后，在总结之后，紧接着给出相关的**原始聊天记录片段**。这部分请严格使用大括号 {} 包围，并且括号内部的每一条相关原始消息都以 `<<时间,用户名,用户id,发言>>` 的格式独立成行。注意每一个部分给出的聊天记录片段不要超过80行\n"
-    "    例如一个主题的格式：\n"
-    "游戏讨论总结：昨晚大家主要讨论了新发布的游戏A，特别是其画面和玩法。\n"
-    "{<<22:30:05,玩家小明,10001,游戏A的风景太美了《图片5》>>\n"
-    "<<22:31:00,玩家小红,10002,是啊，操作手感也不错，就是有点肝。>>\n"
-    "<<22:35:10,群主,10000,我还没买，看你们聊得挺热闹《图片6》。>>}\n\n"
-    "    请确保每个主题的总结和对应的原始记录块清晰配对。引用图片时继续使用《图片N》。注意识别群友的反语与调侃。\n"
-    "    如果没有识别出任何明确的讨论主题，请在“详细主题分析”部分说明“未能识别出明确的独立讨论主题”。\n\n"
-    "群聊记录开始：\n"
-)
+# The {fetch_hours} placeholder will  be replaced by the value of FETCH_HOURS_AGO (or the per-group window)
+def build_gemini_prompt_prefix(fetch_hours):
+    return (
+        f"这是过去{fetch_hours}小时的部分QQ群聊记录。其中《图片N》代表按顺序提供的第N张图（部分图片可能来自GIF等）。\n"
+        "请用中文结合所有文本和图片信息进行分析和回应。请按照以下指示和结构进行回复：\n\n"
+        "1.  **主要讨论方向概述**：\n"
+        f"    简要总结过去{fetch_hours}小时内群聊的整体讨论方向或最核心的主题,同一个方向的不同事件应该分别说明。如果无明显核心，请说明情况。\n\n"
+        "2.  **详细主题分析**：\n"
+        "    请分条列举各个具体讨论主题。对于每个主题：\n"
+        "    a.  首先，给出该主题的**总结**，这部分内容不要超过50字。\n"
+        "    b.  然后，在总结之后，紧接着给出相关的**原始聊天记录片段**。这部分请严格使用大括号 {} 包围，并且括号内部的每一条相关原始消息都以 `<<时间,用户名,用户id,发言>>` 的格式独立成行。注意每一个部分给出的聊天记录片段不要超过80行\n"
+        "    例如一个主题的格式：\n"
+        "游戏讨论总结：昨晚大家主要讨论了新发布的游戏A，特别是其画面和玩法。\n"
+        "{<<22:30:05,玩家小明,10001,游戏A的风景太美了《图片5》>>\n"
+        "<<22:31:00,玩家小红,10002,是啊，操作手感也不错，就是有点肝。>>\n"
+        "<<22:35:10,群主,10000,我还没买，看你们聊得挺热闹《图片6》。>>}\n\n"
+        "    请确保每个主题的总结和对应的原始记录块清晰配对。引用图片时继续使用《图片N》。注意识别群友的反语与调侃。\n"
+        "    如果没有识别出任何明确的讨论主题，请在“详细主题分析”部分说明“未能识别出明确的独立讨论主题”。\n\n"
+        "群聊记录开始：\n"
+    )
+
+
+GEMINI_PROMPT_PREFIX = build_gemini_prompt_prefix(FETCH_HOURS_AGO)
+
+
+def build_gemini_chunk_prompt_prefix(fetch_hours, chunk_index, chunk_total, time_range, first_image, image_count):
+    image_note = (f"本片段附带 {image_count} 张图片，依次对应《图片{first_image}》至《图片{first_image + image_count - 1}》。"
+                  if image_count else "本片段没有附带图片。")
+    image_note += "编号不在此范围内的图片与之前片段中的图片相同，本片段不再重复附带。"
+    return (
+        f"注意：以下只是完整群聊记录中按时间切分的第 {chunk_index}/{chunk_total} 段 ({time_range})，"
+        f"其他片段会单独总结后再合并。{image_note}请只根据本片段内容回复，图片编号保持原样。\n\n"
+        + build_gemini_prompt_prefix(fetch_hours)
+    )
+
+
+def build_gemini_reduce_prompt(fetch_hours, partial_reports):
+    parts = [
+        f"下面是过去{fetch_hours}小时QQ群聊记录按时间顺序切分后，各片段分别得到的分析结果。",
+        "请把它们合并成一份完整的报告：跨片段延续的同一主题要合并为一个主题，合并后的总结仍不超过50字，"
+        "原始聊天记录片段从各片段中挑选最有代表性的消息，保持原有的 `<<时间,用户名,用户id,发言>>` 格式和《图片N》编号，"
+        "每个主题不超过80行。最终报告的结构要求如下：\n",
+        build_gemini_prompt_prefix(fetch_hours).rsplit("群聊记录开始：", 1)[0],
+    ]
+    for i, report in enumerate(partial_reports, 1):
+        parts.append(f"===== 片段 {i} 的分析结果 =====\n{report.strip()}\n")
+    parts.append("请输出合并后的最终报告：\n")
+    return "\n".join(parts)
+
+def build_gemini_incremental_prompt_prefix(fetch_hours, previous_topics_text, since_str, carried_image_count):
+    carried_range = "《图片1》" if carried_image_count == 1 else f"《图片1》至《图片{carried_image_count}》"
+    image_note = (f"已有主题中的{carried_range}来自之前的记录，本次不再附带；"
+                  f"新消息中的图片从《图片{carried_image_count + 1}》开始依次对应本次提供的图片。\n"
+                  if carried_image_count else "")
+    return (
+        f"下面是此前对过去{fetch_hours}小时群聊总结出的主题，超出时间窗口的聊天记录已被移除：\n\n"
+        f"{previous_topics_text or '(暂无仍在时间窗口内的主题)'}\n\n"
+        f"之后给出的是自 {since_str} 以来的新消息。请把新消息与已有主题合并：延续已有主题的讨论并入对应主题 "
+        "(更新总结并补充代表性记录)，新的讨论形成新主题，没有新进展的已有主题原样保留，"
+        f"输出一份覆盖完整过去{fetch_hours}小时的报告。\n"
+        + image_note
+        + build_gemini_prompt_prefix(fetch_hours).rsplit("群聊记录开始：", 1)[0]
+        + "新消息记录开始：\n"
+    )
 
 # --- API密钥配置 (移至顶部) ---
 GEMINI_API_KEY_VALUE = "YOUR_GEMINI_API_KEY_HERE"
@@ -61,6 +199,21 @@ GEMINI_API_KEY_VALUE = "YOUR_GEMINI_API_KEY_HERE"
 
 # --- 用户配置结束 ---
 
+VIDEO_EXTENSIONS = ['.mp4', '.mov', '.avi', '.mkv', '.webm']
+
+_image_cache = None
+_shared_resource_lock = threading.Lock()
+_message_store = None
+_onebot_client = None
+_media_pool = None
+_gemini_client = None
+_gemini_pool = None
+_upload_cache = None
+_key_upload_caches = {}
+_publish_rate_limiter = None
+_reply_resolver = None
+run_metrics = RunMetrics()
+
 # --- Helper Functions ---
 def ensure_dir_exists(dir_path):
     if not os.path.exists(dir_path):
@@ -94,79 +247,303 @@ def get_mime_type(file_path):
     return mime_type
 
 
+def get_image_cache():
+    global _image_cache
+    with _shared_resource_lock:
+        if _image_cache is None:
+            _image_cache = ImageCache(IMAGE_DOWNLOAD_DIR, IMAGE_CACHE_MAX_BYTES)
+        return _image_cache
+
+
+def get_onebot_client():
+    global _onebot_client
+    with _shared_resource_lock:
+        if _onebot_client is None:
+            _onebot_client = OneBotClient(LLONEBOT_API_URL, ONEBOT_ACCESS_TOKEN, timeout=REQUEST_TIMEOUT,
+                                          pool_size=ONEBOT_POOL_SIZE, max_retries=ONEBOT_MAX_RETRIES,
+                                          rate_limit=ONEBOT_RATE_LIMIT, metrics=run_metrics)
+        return _onebot_client
+
+
+def get_message_store():
+    global _message_store
+    with _shared_resource_lock:
+        if _message_store is None:
+            _message_store = MessageStore(MESSAGE_STORE_PATH)
+        return _message_store
+
+
+def get_media_pool():
+    global _media_pool
+    with _shared_resource_lock:
+        if _media_pool is None:
+            _media_pool = MediaWorkerPool(MEDIA_POOL_WORKERS, MEDIA_JOB_TIMEOUT, MEDIA_JOB_MEMORY_LIMIT_MB)
+        return _media_pool
+
+
+def run_media_job(fn, *args):
+    # CPU 密集的媒体处理交给进程池执行；关闭 USE_MEDIA_PROCESS_POOL 时在当前线程执行
+    with run_metrics.stage(f"media_{fn.__name__}"):
+        if USE_MEDIA_PROCESS_POOL:
+            return get_media_pool().run(fn, *args)
+        return fn(*args)
+
+
 def download_and_process_image_for_gemini(image_url, group_id, image_name_from_qq, message_id_context):
     if not image_url: return None, ""
-    group_image_folder = os.path.join(IMAGE_DOWNLOAD_DIR, f"group_{group_id}")
-    if not ensure_dir_exists(group_image_folder): return None, ""
+    image_cache = get_image_cache()
 
     base_name_from_qq = os.path.basename(image_name_from_qq if image_name_from_qq else "")
     original_safe_basename = ""
     if not base_name_from_qq or base_name_from_qq == "image" or "." not in base_name_from_qq:
         _, ext_from_url = os.path.splitext(image_url.split('?')[0])
         if not ext_from_url or len(ext_from_url) > 5 or len(ext_from_url) < 2: ext_from_url = ".jpg"
-        original_safe_basename = sanitize_filename(f"msg_{message_id_context}_{int(time.time() * 1000)}{ext_from_url}")
+        original_safe_basename = sanitize_filename(f"msg_{message_id_context}{ext_from_url}")
     else:
         original_safe_basename = sanitize_filename(base_name_from_qq)
+    file_ext = os.path.splitext(original_safe_basename)[1].lower()
 
-    original_download_path = os.path.join(group_image_folder, original_safe_basename)
+    is_video = file_ext in VIDEO_EXTENSIONS
 
-    if not (os.path.exists(original_download_path) and os.path.getsize(original_download_path) > 0):
-        try:
+    def download_into(f_img):
+        with run_metrics.stage("image_download"):
             img_response = requests.get(image_url, timeout=REQUEST_TIMEOUT, stream=True)
             img_response.raise_for_status()
-            with open(original_download_path, "wb") as f_img:
-                for chunk in img_response.iter_content(chunk_size=8192): f_img.write(chunk)
-        except Exception as e:
-            print(f"    [图片] 原始文件下载失败: {original_safe_basename} (URL: {image_url[:60]}...), 错误: {e}")
-            if os.path.exists(original_download_path):
-                try:
-                    os.remove(original_download_path)
-                except:
-                    pass
-            return None, f" (下载失败: {original_safe_basename})"
+            downloaded_bytes = 0
+            for chunk in img_response.iter_content(chunk_size=8192):
+                downloaded_bytes += len(chunk)
+                if is_video and downloaded_bytes > VIDEO_MAX_DOWNLOAD_BYTES:
+                    raise ValueError(f"视频超过 {VIDEO_MAX_DOWNLOAD_BYTES // 1024 ** 2} MB，跳过")
+                f_img.write(chunk)
+        run_metrics.incr("image_download_bytes", downloaded_bytes)
+
+    try:
+        content_digest, original_download_path = image_cache.fetch(
+            image_source_key(image_url, image_name_from_qq), file_ext, download_into)
+    except Exception as e:
+        print(f"    [图片] 原始文件下载失败: {original_safe_basename} (URL: {image_url[:60]}...), 错误: {e}")
+        return None, f" (下载失败: {original_safe_basename})"
 
     final_image_path_to_send = original_download_path
     media_info_for_log = ""
-    file_ext = os.path.splitext(original_safe_basename)[1].lower()
 
     if file_ext == '.gif':
         if not PILLOW_AVAILABLE:
             print(f"    [GIF处理] Pillow库未安装，无法提取 {original_safe_basename} 的第一帧。此GIF不会作为图片发送。")
             return None, " (来自GIF - Pillow缺失)"
         try:
-            pil_im = PILImage.open(original_download_path)
-            pil_im.seek(0)
-            frame_filename_base = os.path.splitext(original_safe_basename)[0]
-            frame_save_filename = sanitize_filename(f"{frame_filename_base}_frame0.png")
-            frame_full_path = os.path.join(group_image_folder, frame_save_filename)
-            if pil_im.mode == 'P' or pil_im.mode == 'RGBA':
-                converted_frame = pil_im.convert('RGBA') if pil_im.mode == 'P' else pil_im
-            elif pil_im.mode != 'RGB':
-                converted_frame = pil_im.convert('RGB')
-            else:
-                converted_frame = pil_im
-            converted_frame.save(frame_full_path, "PNG")
-            final_image_path_to_send = frame_full_path
+            final_image_path_to_send = image_cache.derived(
+                content_digest, "frame0", ".png",
+                lambda frame_full_path: run_media_job(extract_gif_first_frame, original_download_path, frame_full_path))
             media_info_for_log = " (来自GIF)"
         except Exception as e_gif:
             print(f"    [GIF处理] 提取GIF第一帧失败 ({original_safe_basename}): {e_gif}. 此图片将不被发送。")
             return None, f" (来自GIF - 处理失败)"
-    elif file_ext in ['.mp4', '.mov', '.avi', '.mkv', '.webm']:
-        print(
-            f"    [视频处理] 检测到视频: {original_safe_basename}. 提取视频第一帧的功能需要额外库 (如OpenCV) 且未在此版本实现。此视频将不被作为图片发送。")
-        return None, f" (来自视频 - 不支持提取)"
+    elif is_video:
+        try:
+            final_image_path_to_send = image_cache.derived(
+                content_digest, "keyframe", ".png",
+                lambda frame_full_path: run_media_job(extract_video_keyframe, original_download_path, frame_full_path,
+                                                      VIDEO_KEYFRAME_EXTRACTORS))
+            media_info_for_log = " (来自视频)"
+        except Exception as e_video:
+            print(f"    [视频处理] 提取视频关键帧失败 ({original_safe_basename}): {e_video}. 此视频将不被作为图片发送。")
+            return None, f" (来自视频 - 不支持提取)"
+
+    return compact_image_for_upload(content_digest, final_image_path_to_send, original_safe_basename), media_info_for_log
+
 
-    if not os.path.exists(final_image_path_to_send) or os.path.getsize(final_image_path_to_send) == 0:
-        print(f"    [错误] 最终图片文件不存在或为空: {final_image_path_to_send}")
-        return None, " (文件错误)"
-    return final_image_path_to_send, media_info_for_log
+def compact_variant_name():
+    return f"compact{IMAGE_MAX_EDGE}_{str(IMAGE_RECOMPRESS_FORMAT).lower()}{IMAGE_RECOMPRESS_QUALITY}"
+
+
+def compact_image_for_upload(content_digest, image_path, display_name):
+    # 缩放并重新编码为更小的格式 (结果缓存为派生文件)，同时记录感知哈希与压缩前后大小。压缩后反而更大时仍发送原图。
+    if not PILLOW_AVAILABLE or not IMAGE_RECOMPRESS_FORMAT: return image_path
+    image_cache = get_image_cache()
+    variant = compact_variant_name()
+    computed_hash = []
+    try:
+        compact_path = image_cache.derived(
+            content_digest, variant, RECOMPRESS_EXTENSIONS.get(IMAGE_RECOMPRESS_FORMAT, ".img"),
+            lambda dst_path: computed_hash.append(run_media_job(
+                compact_image, image_path, dst_path, IMAGE_MAX_EDGE, IMAGE_RECOMPRESS_FORMAT, IMAGE_RECOMPRESS_QUALITY)))
+    except Exception as e:
+        print(f"    [图片压缩] 处理 {display_name} 失败，将发送原图: {e}")
+        return image_path
+    meta = image_cache.get_meta(content_digest, variant)
+    if meta is None:
+        meta = {"dhash": computed_hash[0] if computed_hash else None,
+                "bytes": os.path.getsize(compact_path), "source_bytes": os.path.getsize(image_path)}
+        image_cache.set_meta(content_digest, variant, meta)
+    if meta["bytes"] >= meta["source_bytes"]:
+        return image_path
+    return compact_path
+
+
+def get_image_upload_meta(image_path):
+    # 返回 (内容哈希, 感知哈希, 发送字节数, 原始字节数)，用于近似重复检测与统计
+    image_cache = get_image_cache()
+    content_digest = image_cache.digest_from_path(image_path)
+    meta = image_cache.get_meta(content_digest, compact_variant_name()) or {}
+    is_compact = compact_variant_name() in os.path.basename(image_path)
+    attached_bytes = meta.get("bytes") if is_compact else meta.get("source_bytes")
+    if attached_bytes is None:
+        attached_bytes = os.path.getsize(image_path)
+    return content_digest, meta.get("dhash"), attached_bytes, meta.get("source_bytes", attached_bytes)
 
 
 # --- End Helper Functions ---
 
 # --- Gemini API Call Function (Moved to Top) ---
-def send_to_gemini(text_prompt, image_paths):
-    if not genai or not genai_types:
+def load_genai():
+    """首次调用时导入 google-genai 并设置模块级的 genai/genai_types，导入失败时返回 False。"""
+    global genai, genai_types
+    with _genai_import_lock:
+        if genai is None or genai_types is None:
+            try:
+                from google import genai as genai_module
+                from google.genai import types as types_module
+            except ImportError as e:
+                print(f"错误: google-genai 库导入失败: {e}")
+                return False
+            genai, genai_types = genai_module, types_module
+    return True
+
+
+def get_gemini_client():
+    global _gemini_client
+    with _shared_resource_lock:
+        if _gemini_client is None:
+            load_genai()
+            _gemini_client = genai.Client(api_key=GEMINI_API_KEY_VALUE)
+        return _gemini_client
+
+
+def get_gemini_pool():
+    global _gemini_pool
+    with _shared_resource_lock:
+        if _gemini_pool is None:
+            api_keys = list(dict.fromkeys([GEMINI_API_KEY_VALUE] + [k for k in GEMINI_API_KEYS if k]))
+            endpoints = []
+            for model in dict.fromkeys([GEMINI_MODEL_NAME] + list(GEMINI_FALLBACK_MODELS)):
+                rpm, tpm = GEMINI_MODEL_RATE_LIMITS.get(model, (GEMINI_RPM_PER_KEY, GEMINI_TPM_PER_KEY))
+                endpoints.extend(GeminiEndpoint(api_key, model, rpm, tpm) for api_key in api_keys)
+            # 主 Key 复用 get_gemini_client() (上传缓存/上下文缓存也在这个 Client 上)
+            _gemini_pool = GeminiClientPool(
+                endpoints,
+                lambda api_key: get_gemini_client() if api_key == GEMINI_API_KEY_VALUE else genai.Client(api_key=api_key),
+                max_attempts=GEMINI_MAX_ATTEMPTS, max_wait=GEMINI_MAX_QUEUE_SECONDS, metrics=run_metrics)
+        return _gemini_pool
+
+
+def get_upload_cache(api_key=None):
+    # 远程文件与上下文缓存只能由上传它们的 Key 访问，主 Key 之外的每个 Key 各用一份索引
+    global _upload_cache
+    if api_key is None or api_key == GEMINI_API_KEY_VALUE:
+        client = get_gemini_client()
+        with _shared_resource_lock:
+            if _upload_cache is None:
+                _upload_cache = UploadCache(UPLOAD_CACHE_INDEX_PATH, GeminiFilesBackend(client))
+            return _upload_cache
+    client = get_gemini_pool().client_for(api_key)
+    with _shared_resource_lock:
+        upload_cache = _key_upload_caches.get(api_key)
+        if upload_cache is None:
+            root, ext = os.path.splitext(UPLOAD_CACHE_INDEX_PATH)
+            key_id = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
+            upload_cache = _key_upload_caches[api_key] = UploadCache(f"{root}_{key_id}{ext}", GeminiFilesBackend(client))
+        return upload_cache
+
+
+def report_upload_caches():
+    for upload_cache in [_upload_cache] + list(_key_upload_caches.values()):
+        if upload_cache is not None: upload_cache.report()
+
+
+def plan_remote_images(image_paths, prefer_remote):
+    # 决定每张图片走远程引用还是内联: 内联的总字节数不超过 INLINE_IMAGE_BYTES_BUDGET，超出的部分一律上传，
+    # 这样请求体 (以及构造请求时驻留内存的图片字节) 有固定上限；远程引用失效后的重试也遵守该上限。
+    use_remote = []
+    inline_bytes = 0
+    for image_path in image_paths:
+        size = os.path.getsize(image_path)
+        remote = prefer_remote and size >= UPLOAD_MIN_BYTES
+        if not remote and INLINE_IMAGE_BYTES_BUDGET is not None and inline_bytes + size > INLINE_IMAGE_BYTES_BUDGET:
+            remote = True
+        if not remote: inline_bytes += size
+        use_remote.append(remote)
+    return use_remote
+
+
+def build_gemini_image_parts(image_paths, use_remote_refs, api_key=None):
+    # 返回 (parts, 使用到的远程文件 digest 列表)；读取图片失败时返回 (None, [])。远程文件上传到 api_key 名下
+    use_remote = plan_remote_images(image_paths, use_remote_refs)
+    upload_cache = get_upload_cache(api_key) if any(use_remote) else None
+    if not use_remote_refs and upload_cache is not None:
+        print(f"  [图片] 内联图片超过 {INLINE_IMAGE_BYTES_BUDGET / 1024 ** 2:.1f} MB 上限，"
+              f"其余 {sum(use_remote)} 张改为上传后引用。")
+
+    def build_part(image_path, remote):
+        mime = get_mime_type(image_path)
+        if remote:
+            try:
+                file_ref = upload_cache.file_ref(image_path, mime)
+                return genai_types.Part.from_uri(file_uri=file_ref["uri"], mime_type=file_ref["mime_type"]), \
+                    file_ref["digest"]
+            except Exception as e:
+                print(f"  [上传缓存] 上传 {os.path.basename(image_path)} 失败，改为内联发送: {e}")
+        with open(image_path, 'rb') as f:
+            image_bytes = f.read()
+        return genai_types.Part.from_bytes(mime_type=mime, data=image_bytes), None
+
+    try:
+        if upload_cache is not None:
+            with ThreadPoolExecutor(max_workers=max(1, UPLOAD_MAX_WORKERS), thread_name_prefix="upload") as executor:
+                built = list(executor.map(build_part, image_paths, use_remote))
+        else:
+            built = [build_part(image_path, False) for image_path in image_paths]
+    except AttributeError:
+        print("  [严重错误] `google.genai.types.Part.from_bytes` 不存在。您的 SDK 版本可能与示例代码不兼容。")
+        print("  请检查 google-generativeai SDK 版本。当前 SDK 通常使用 `Part.from_data`。")
+        return None, []
+    except Exception as e:
+        print(f"  [错误] 读取或处理图片失败: {e}")
+        print("  由于图片处理错误，取消发送。")
+        return None, []
+    finally:
+        if upload_cache is not None: upload_cache.flush()
+    return [part for part, _ in built], [digest for _, digest in built if digest]
+
+
+def build_gemini_request(text_prompt, image_paths, prompt_prefix, endpoint, use_remote_refs):
+    # 为选中的 Key/模型构建 (contents, config, 远程文件 digest 列表, 上下文缓存引用)；读取图片失败时返回 None
+    api_parts, remote_digests = build_gemini_image_parts(image_paths, use_remote_refs, endpoint.api_key)
+    if api_parts is None:
+        return None
+    context_ref = None
+    if prompt_prefix and use_remote_refs and USE_PROMPT_CONTEXT_CACHE:
+        upload_cache = get_upload_cache(endpoint.api_key)
+        try:
+            context_ref = upload_cache.context_ref(endpoint.model, prompt_prefix, PROMPT_CONTEXT_CACHE_TTL_SECONDS)
+        except Exception as e:
+            print(f"  [上传缓存] 创建提示词上下文缓存失败，改为随请求发送: {e}")
+        upload_cache.flush()
+    request_text = text_prompt if context_ref else prompt_prefix + text_prompt
+    api_parts.append(genai_types.Part.from_text(text=request_text))
+    contents = [genai_types.Content(role="user", parts=api_parts)]
+    config = genai_types.GenerateContentConfig(
+        response_mime_type="text/plain",
+        cached_content=context_ref["name"] if context_ref else None,
+    )
+    return contents, config, remote_digests, context_ref
+
+
+def send_to_gemini(text_prompt, image_paths, echo=True, prompt_prefix="", on_chunk=None):
+    # 返回完整的回复文本 (失败时为 None)。echo=False 时不逐块打印，供多群并发调用时由调用方统一输出。
+    # on_chunk 在收到每一块文本时被调用 (如边生成边发布)。
+    # prompt_prefix 为固定的提示词前缀，开启 USE_PROMPT_CONTEXT_CACHE 时通过上下文缓存发送，否则拼接在 text_prompt 之前。
+    if not load_genai():
         print("Gemini AI library (genai or genai.types) not available. Cannot send.")
         return
 
@@ -182,272 +559,1007 @@ def send_to_gemini(text_prompt, image_paths):
         print("=" * 70)
         return
 
+    if not text_prompt and not prompt_prefix and not image_paths:
+        print("没有文本或图片可以发送给Gemini。")
+        return
+
     try:
-        client = genai.Client(api_key=gemini_api_key_to_use)
+        pool = get_gemini_pool()
     except Exception as e:
         print(f"初始化Gemini Client失败: {e}")
         return
 
-    model_to_call = GEMINI_MODEL_NAME
-    print(f"\n--- 向 Gemini ({model_to_call}) 发送内容 ---")
+    print(f"\n--- 向 Gemini 发送内容 (首选模型 {GEMINI_MODEL_NAME}) ---")
     print(f"图片数量: {len(image_paths)}")
 
-    api_parts = []
-    for image_path in image_paths:
+    # 先尝试复用远程文件/上下文缓存；引用失效导致请求失败 (且尚未收到任何输出) 时清除这些引用后重试一次:
+    # 图片尽量内联，超出 INLINE_IMAGE_BYTES_BUDGET 的部分重新上传。重试仍失败则放弃
+    use_remote_refs = USE_UPLOAD_CACHE
+    retried_stale_refs = False
+    while True:
+        # 远程文件与上下文缓存只属于上传时的 Key/模型，由 Gemini 池选定 Endpoint 后再用该 Key 的上传缓存构建请求，
+        # 同一 Endpoint 重试时复用；attempt 记录最近一次尝试用到的 Endpoint 与引用
+        built_requests = {}
+        attempt = {}
+
+        def build_request(endpoint):
+            request_key = (endpoint.api_key, endpoint.model)
+            if request_key not in built_requests:
+                with run_metrics.stage("gemini_image_parts"):
+                    built_requests[request_key] = build_gemini_request(
+                        text_prompt, image_paths, prompt_prefix, endpoint, use_remote_refs)
+            attempt["endpoint"] = endpoint
+            attempt["request"] = built_requests[request_key]
+            if attempt["request"] is None:
+                raise ValueError("读取或处理图片失败")
+            contents, config, remote_digests, context_ref = attempt["request"]
+            print(f"  [Gemini] 使用 {endpoint.label} 发送请求。")
+            return contents, config, bool(remote_digests or context_ref)
+
+        if echo: print("\n--- Gemini AI 回复 (流式) ---")
+        last_chunk = None  # Initialize variable to store the last chunk
+        response_text_parts = []
+        run_metrics.incr("gemini_requests")
+        request_started = time.perf_counter()
+        estimated_tokens = estimate_text_tokens(prompt_prefix + text_prompt) + len(image_paths) * IMAGE_TOKEN_ESTIMATE
         try:
-            mime = get_mime_type(image_path)
-            with open(image_path, 'rb') as f:
-                image_bytes = f.read()
-            api_parts.append(genai_types.Part.from_bytes(mime_type=mime, data=image_bytes))
-        except AttributeError:
-            print("  [严重错误] `google.genai.types.Part.from_bytes` 不存在。您的 SDK 版本可能与示例代码不兼容。")
-            print("  请检查 google-generativeai SDK 版本。当前 SDK 通常使用 `Part.from_data`。")
-            return
-        except Exception as e:
-            print(f"  [错误] 读取或处理图片 {os.path.basename(image_path)} 失败: {e}")
-            print("  由于图片处理错误，取消发送。")
-            return
-
-    api_parts.append(genai_types.Part.from_text(text=text_prompt))
-
-    if not text_prompt and not image_paths:
-        print("没有文本或图片可以发送给Gemini。")
-        return
-
-    contents_for_api_call = [
-        genai_types.Content(
-            role="user",
-            parts=api_parts
-        )
-    ]
-
-    generate_content_config = genai_types.GenerateContentConfig(
-        response_mime_type="text/plain",
-    )
-
-    print("\n--- Gemini AI 回复 (流式) ---")
-    last_chunk = None  # Initialize variable to store the last chunk
-    try:
-        response_stream = client.models.generate_content_stream(
-            model=model_to_call,
-            contents=contents_for_api_call,
-            config=generate_content_config,
-        )
-        for chunk in response_stream:
-            if hasattr(chunk, 'text') and chunk.text:
-                print(chunk.text, end="", flush=True)
-            last_chunk = chunk  # Update last_chunk with the current chunk
-
-        print("\n--- Gemini AI 回复结束 ---")
-
-        # After the stream is consumed, the last_chunk should have usage_metadata
-        if last_chunk and hasattr(last_chunk, 'usage_metadata') and last_chunk.usage_metadata:
-            print("\n\n--- Token Usage ---")  # Added extra newline for separation
-            print(last_chunk.usage_metadata)
-        else:
-            print("\n\n[信息] 未能从API响应中获取到 usage_metadata。")
+            response_stream = pool.generate_content_stream(build_request, estimated_tokens=estimated_tokens)
+            for chunk in response_stream:
+                if last_chunk is None:
+                    run_metrics.observe("gemini_first_chunk", time.perf_counter() - request_started)
+                if hasattr(chunk, 'text') and chunk.text:
+                    response_text_parts.append(chunk.text)
+                    if echo: print(chunk.text, end="", flush=True)
+                    if on_chunk: on_chunk(chunk.text)
+                last_chunk = chunk  # Update last_chunk with the current chunk
+
+            if echo: print(f"\n--- Gemini AI 回复结束 ({attempt['endpoint'].model}) ---")
+            run_metrics.observe("gemini_stream", time.perf_counter() - request_started)
+
+            # After the stream is consumed, the last_chunk should have usage_metadata
+            if last_chunk and hasattr(last_chunk, 'usage_metadata') and last_chunk.usage_metadata:
+                run_metrics.record_usage(last_chunk.usage_metadata)
+                print("\n\n--- Token Usage ---")  # Added extra newline for separation
+                print(last_chunk.usage_metadata)
+            else:
+                print("\n\n[信息] 未能从API响应中获取到 usage_metadata。")
+            return "".join(response_text_parts)
 
-    except Exception as e:
-        print(f"\n[错误] 调用Gemini API失败: {e}")
-        import traceback
-        traceback.print_exc()
-        # Also print if usage_metadata was available on an erroring last_chunk, if applicable
-        if last_chunk and hasattr(last_chunk, 'usage_metadata') and last_chunk.usage_metadata:
-            print("\n--- Token Usage (注意: 错误发生前可能已收到部分数据) ---")
-            print(last_chunk.usage_metadata)
+        except Exception as e:
+            run_metrics.incr("gemini_failures")
+            if "request" in attempt and attempt["request"] is None:
+                return None
+            _, _, remote_digests, context_ref = attempt.get("request") or (None, None, [], None)
+            # 只有引用失效 (文件不存在/已过期/无权访问) 才清除引用；限流、5xx、超时等按普通错误处理，不丢弃有效的上传
+            if (remote_digests or context_ref) and not response_text_parts and not retried_stale_refs \
+                    and not isinstance(e, GeminiPoolExhausted) and is_stale_ref_error(e):
+                print(f"\n[上传缓存] 远程引用已失效 ({e})，清除 {len(remote_digests)} 个文件引用后重试。")
+                upload_cache = get_upload_cache(attempt["endpoint"].api_key)
+                for digest in remote_digests:
+                    upload_cache.invalidate("files", digest)
+                if context_ref:
+                    upload_cache.invalidate("contexts", context_ref["key"])
+                upload_cache.flush()
+                use_remote_refs = False
+                retried_stale_refs = True
+                continue
+            print(f"\n[错误] 调用Gemini API失败: {e}")
+            import traceback
+            traceback.print_exc()
+            # Also print if usage_metadata was available on an erroring last_chunk, if applicable
+            if last_chunk and hasattr(last_chunk, 'usage_metadata') and last_chunk.usage_metadata:
+                print("\n--- Token Usage (注意: 错误发生前可能已收到部分数据) ---")
+                print(last_chunk.usage_metadata)
+            return None
 
 
 # --- End Gemini API Call Function ---
 
 # --- QQ Message Fetching and Formatting Logic ---
-def get_target_time_range_timestamps():
+def get_target_time_range_timestamps(fetch_hours=None):
+    if fetch_hours is None: fetch_hours = FETCH_HOURS_AGO
     now_moment = datetime.datetime.now()
-    start_datetime_obj = now_moment - datetime.timedelta(hours=FETCH_HOURS_AGO)
+    start_datetime_obj = now_moment - datetime.timedelta(hours=fetch_hours)
     start_ts = int(start_datetime_obj.timestamp())
     end_ts = int(now_moment.timestamp())
     print(
-        f"目标时间范围: 从 {start_datetime_obj.strftime('%Y-%m-%d %H:%M:%S')} (Unix: {start_ts}) (即过去 {FETCH_HOURS_AGO} 小时)")
+        f"目标时间范围: 从 {start_datetime_obj.strftime('%Y-%m-%d %H:%M:%S')} (Unix: {start_ts}) (即过去 {fetch_hours} 小时)")
     print(f"              至 {now_moment.strftime('%Y-%m-%d %H:%M:%S')} (Unix: {end_ts})")
     return start_ts, end_ts
 
 
-def format_message_content_for_gemini(message_segments, group_id, message_id_context,
-                                      image_paths_collector_list, current_image_placeholder_counter):
-    text_parts_for_this_message = []
-    updated_counter = current_image_placeholder_counter
-    if not isinstance(message_segments, list): return "[消息格式错误]", updated_counter
+class ImageRef:
+    # 消息中一张待下载图片的引用，准备阶段提交给线程池，渲染阶段按顺序取回结果
+    __slots__ = ("image_url", "group_id", "qq_file_name", "message_id_context", "kind")
+
+    def __init__(self, image_url, group_id, qq_file_name, message_id_context, kind="图片"):
+        self.image_url = image_url
+        self.group_id = group_id
+        self.qq_file_name = qq_file_name
+        self.message_id_context = message_id_context
+        self.kind = kind
+
+    def submit(self, image_pool):
+        image_pool.submit(self.image_url, self.group_id, self.qq_file_name, self.message_id_context)
+
+    def resolve(self, image_pool=None):
+        if image_pool:
+            return image_pool.result(self.image_url, self.group_id, self.qq_file_name, self.message_id_context)
+        return download_and_process_image_for_gemini(self.image_url, self.group_id, self.qq_file_name,
+                                                     self.message_id_context)
+
+
+def compact_content_parts(content_parts):
+    # 相邻的文本片段合并成一个字符串、去掉空文本，存成 tuple，大窗口下每条消息只占很少的对象
+    compacted = []
+    for part in content_parts:
+        if isinstance(part, str):
+            if not part: continue
+            if compacted and isinstance(compacted[-1], str):
+                compacted[-1] += part
+                continue
+        compacted.append(part)
+    return tuple(compacted)
+
+
+class ReplyRef:
+    # 回复消息段，渲染时展开为被回复消息的上下文
+    __slots__ = ("message_id",)
+
+    def __init__(self, message_id):
+        self.message_id = message_id
 
+    def render(self, reply_contexts=None):
+        context = reply_contexts.get(self.message_id) if reply_contexts else None
+        if context is None:
+            return f"[回复消息ID:{self.message_id}]"
+        return f"[回复 {context[0]}: {context[1]}]"
+
+
+class PreparedMessage:
+    # 已解析的消息：只保留排序键、行首 "时间 名片(QQ号): " 、发送者和内容片段 (文本、ImageRef 或 ReplyRef)，原始 JSON 可以立即释放
+    __slots__ = ("sort_key", "message_id", "header", "content_parts", "sender", "user_id")
+
+    def __init__(self, sort_key, message_id, header, content_parts, sender=None, user_id=""):
+        self.sort_key = sort_key
+        self.message_id = message_id
+        self.header = header
+        self.content_parts = compact_content_parts(content_parts)
+        self.sender = sender
+        self.user_id = user_id
+
+
+def prepare_message_content(message_segments, group_id, message_id_context, image_pool=None):
+    # 把消息段解析成文本片段与 ImageRef；提供 image_pool 时图片会立即开始下载
+    if not isinstance(message_segments, list): return ["[消息格式错误]"]
+    content_parts = []
     for segment in message_segments:
         seg_type = segment.get("type")
         seg_data = segment.get("data", {})
         if seg_type == "text":
-            text_parts_for_this_message.append(seg_data.get("text", ""))
+            content_parts.append(seg_data.get("text", ""))
         elif seg_type == "image":
             image_url = seg_data.get('url')
             qq_file_name = seg_data.get('file', '')
             if image_url:
-                processed_image_path, media_info = download_and_process_image_for_gemini(
-                    image_url, group_id, qq_file_name, message_id_context
-                )
-                if processed_image_path:
-                    image_paths_collector_list.append(processed_image_path)
-                    text_parts_for_this_message.append(f"《图片{updated_counter}{media_info}》")
-                    updated_counter += 1
-                else:
-                    text_parts_for_this_message.append(
-                        f"[图片: {qq_file_name if qq_file_name else '未知'}{media_info} (处理失败或不支持)]")
+                image_ref = ImageRef(image_url, group_id, qq_file_name, message_id_context)
+                if image_pool: image_ref.submit(image_pool)
+                content_parts.append(image_ref)
             else:
-                text_parts_for_this_message.append(f"[图片: {qq_file_name if qq_file_name else '未知'} (无URL)]")
+                content_parts.append(f"[图片: {qq_file_name if qq_file_name else '未知'} (无URL)]")
         elif seg_type == "video":
+            video_url = seg_data.get('url')
             qq_file_name = seg_data.get('file', '')
-            text_parts_for_this_message.append(f"[视频: {qq_file_name if qq_file_name else '未知'} (帧提取未实现)]")
+            if video_url:
+                # 视频按扩展名走关键帧提取，没有扩展名时补上 .mp4
+                video_file_name = qq_file_name if os.path.splitext(qq_file_name)[1].lower() in VIDEO_EXTENSIONS \
+                    else f"{qq_file_name or f'video_{message_id_context}'}.mp4"
+                video_ref = ImageRef(video_url, group_id, video_file_name, message_id_context, kind="视频")
+                if image_pool: video_ref.submit(image_pool)
+                content_parts.append(video_ref)
+            else:
+                content_parts.append(f"[视频: {qq_file_name if qq_file_name else '未知'} (无URL)]")
         elif seg_type == "at":
-            text_parts_for_this_message.append(f"@{str(seg_data.get('qq', 'all'))}")
+            content_parts.append(f"@{str(seg_data.get('qq', 'all'))}")
         elif seg_type == "face":
-            text_parts_for_this_message.append(f"[表情ID:{seg_data.get('id', '')}]")
+            content_parts.append(f"[表情ID:{seg_data.get('id', '')}]")
         elif seg_type == "reply":
-            text_parts_for_this_message.append(f"[回复消息ID:{seg_data.get('id', '')}]")
+            content_parts.append(ReplyRef(str(seg_data.get('id', ''))))
+    return content_parts
+
+
+def render_message_content(content_parts, image_paths_collector_list, current_image_placeholder_counter,
+                           image_pool=None, image_deduper=None, reply_contexts=None):
+    # 按顺序取回图片结果并分配《图片N》编号；提供 image_deduper 时，与之前某张图近似重复的图片直接引用其编号而不再附带
+    text_parts_for_this_message = []
+    updated_counter = current_image_placeholder_counter
+    for part in content_parts:
+        if isinstance(part, ReplyRef):
+            text_parts_for_this_message.append(part.render(reply_contexts))
+            continue
+        if not isinstance(part, ImageRef):
+            text_parts_for_this_message.append(part)
+            continue
+        processed_image_path, media_info = part.resolve(image_pool)
+        if processed_image_path and image_deduper is not None:
+            content_digest, perceptual_hash, attached_bytes, source_bytes = get_image_upload_meta(processed_image_path)
+            earlier_number = image_deduper.find(content_digest, perceptual_hash)
+            if earlier_number is not None:
+                image_deduper.add_duplicate(attached_bytes)
+                text_parts_for_this_message.append(f"《图片{earlier_number}{media_info}》")
+                continue
+            image_deduper.add(content_digest, perceptual_hash, updated_counter, attached_bytes, source_bytes)
+        if processed_image_path:
+            image_paths_collector_list.append(processed_image_path)
+            text_parts_for_this_message.append(f"《图片{updated_counter}{media_info}》")
+            updated_counter += 1
+        else:
+            text_parts_for_this_message.append(
+                f"[{part.kind}: {part.qq_file_name if part.qq_file_name else '未知'}{media_info} (处理失败或不支持)]")
     return "".join(text_parts_for_this_message), updated_counter
 
 
-def format_display_message_for_gemini(msg_obj, group_id, image_paths_collector_list, current_image_placeholder_counter):
+def get_message_id_context(msg_obj):
+    return msg_obj.get("message_id", f"msgid_{msg_obj.get('message_seq', int(time.time() * 1000))}")
+
+
+def prepare_display_message_for_gemini(msg_obj, group_id, image_pool=None):
     msg_time_unix = msg_obj.get("time", 0)
     dt_object = datetime.datetime.fromtimestamp(msg_time_unix)
     time_str = dt_object.strftime("%H:%M:%S")
     sender_info = msg_obj.get("sender", {})
     sender_display = sender_info.get("card", "") or sender_info.get("nickname", "未知用户")
     user_id = msg_obj.get("user_id", "")
-    message_id = msg_obj.get("message_id", f"msgid_{msg_obj.get('message_seq', int(time.time() * 1000))}")
+    message_id = get_message_id_context(msg_obj)
 
-    text_content, updated_counter = format_message_content_for_gemini(
-        msg_obj.get("message", []), group_id, message_id,
-        image_paths_collector_list, current_image_placeholder_counter
-    )
-    formatted_line = f"{time_str} {sender_display}({user_id}): {text_content}"
-    return formatted_line, updated_counter
+    content_parts = prepare_message_content(msg_obj.get("message", []), group_id, message_id, image_pool)
+    return PreparedMessage((msg_time_unix, msg_obj.get("message_seq", 0)), message_id,
+                           f"{time_str} {sender_display}({user_id}): ", content_parts, sender_display, user_id)
 
 
-def fetch_and_prepare_for_gemini(group_id):
-    if not genai or not genai_types:
-        print("Gemini AI library (genai or genai.types) not available. Exiting.")
-        return None, None
-    if not PILLOW_AVAILABLE:
-        print(
-            "警告: Pillow (PIL) 库未安装。GIF图片将无法提取第一帧，相关图片可能不会被发送。请运行 'pip install Pillow' 来启用此功能。")
+def render_display_message_for_gemini(prepared_message, image_paths_collector_list,
+                                      current_image_placeholder_counter, image_pool=None, image_deduper=None,
+                                      reply_contexts=None):
+    text_content, updated_counter = render_message_content(
+        prepared_message.content_parts, image_paths_collector_list, current_image_placeholder_counter, image_pool,
+        image_deduper, reply_contexts)
+    return prepared_message.header + text_content, updated_counter
 
-    start_ts, end_ts = get_target_time_range_timestamps()
-    ensure_dir_exists(IMAGE_DOWNLOAD_DIR)
-    print(f"正在为Gemini准备群 {group_id} 的消息 (最多 {MAX_MESSAGES_TO_PROCESS} 条)...")
 
-    all_text_parts_for_gemini_prompt = []
-    ordered_image_paths_for_gemini = []
-    current_image_placeholder_counter = 1
-    raw_messages_to_process = []
-    collected_message_ids_for_fetch = set()
+EXCERPT_SEGMENT_PLACEHOLDERS = {"image": "[图片]", "video": "[视频]", "face": "[表情]", "record": "[语音]",
+                                "file": "[文件]", "forward": "[合并转发]"}
 
-    current_message_seq_for_api_call = None
-    loop_count = 0
-    print("  开始从API拉取消息...")
-    while True:
-        loop_count += 1
-        if loop_count > MAX_FETCH_LOOPS:
-            print(f"  [警告] 已达到最大API调用次数 ({MAX_FETCH_LOOPS})。停止拉取。");
-            break
 
-        if len(raw_messages_to_process) >= MAX_MESSAGES_TO_PROCESS:
-            print(
-                f"  [信息] 已收集到 {len(raw_messages_to_process)} 条消息，达到 MAX_MESSAGES_TO_PROCESS ({MAX_MESSAGES_TO_PROCESS}) 限制。停止拉取。")
-            break
+def shorten_excerpt(text):
+    text = " ".join(text.split())
+    return text if len(text) <= REPLY_EXCERPT_CHARS else text[:REPLY_EXCERPT_CHARS] + "…"
 
-        params = {"group_id": int(group_id)}
-        if current_message_seq_for_api_call is not None: params["message_seq"] = int(current_message_seq_for_api_call)
-        params["reverseOrder"]='true'
-        params["count"]=100
-        try:
-            response = requests.post(f"{LLONEBOT_API_URL}/get_group_msg_history", json=params, timeout=REQUEST_TIMEOUT)
-            print(response.text)
-            response.raise_for_status()
-            api_data = response.json()
-        except Exception as e:
-            print(f"  [错误] API请求失败: {e}")
-            break
 
-        if not (api_data and api_data.get("status") == "ok" and api_data.get("retcode") == 0):
-            print(f"  [错误] API返回不成功: {api_data.get('msg', '未知错误') if api_data else '无响应'}")
-            break
+def reply_context_from_message(msg_obj):
+    # 原始消息 (消息库或 get_msg 返回) -> (发送者, 摘录)
+    sender_info = msg_obj.get("sender", {})
+    sender_display = (sender_info.get("card", "") or sender_info.get("nickname", "")
+                      or str(msg_obj.get("user_id", "未知用户")))
+    segments = msg_obj.get("message", [])
+    texts = []
+    for segment in segments if isinstance(segments, list) else []:
+        seg_type = segment.get("type")
+        if seg_type == "text":
+            texts.append(segment.get("data", {}).get("text", ""))
+        elif seg_type == "at":
+            texts.append(f"@{segment.get('data', {}).get('qq', 'all')}")
+        elif seg_type in EXCERPT_SEGMENT_PLACEHOLDERS:
+            texts.append(EXCERPT_SEGMENT_PLACEHOLDERS[seg_type])
+    return sender_display, shorten_excerpt("".join(texts))
+
+
+def reply_context_from_prepared(prepared_message):
+    texts = [part if isinstance(part, str) else f"[{part.kind}]"
+             for part in prepared_message.content_parts if not isinstance(part, ReplyRef)]
+    return prepared_message.sender or "未知用户", shorten_excerpt("".join(texts))
+
+
+def fetch_reply_target(group_id, message_id):
+    # get_msg 明确返回失败 (消息不存在/已撤回) 时返回 None；网络错误时抛出 OneBotError，不缓存结果
+    params = {"message_id": int(message_id) if message_id.lstrip("-").isdigit() else message_id}
+    response = get_onebot_client().call("get_msg", params)
+    data = response.get("data") if response.get("retcode", 0) == 0 else None
+    return reply_context_from_message(data) if data else None
+
+
+def lookup_reply_targets_in_store(group_id, message_ids):
+    if not USE_MESSAGE_STORE:
+        return {}
+    return {message_id: reply_context_from_message(msg_obj)
+            for message_id, msg_obj in get_message_store().messages_by_ids(group_id, message_ids).items()}
+
+
+def get_reply_resolver():
+    global _reply_resolver
+    with _shared_resource_lock:
+        if _reply_resolver is None:
+            _reply_resolver = ReplyContextResolver(lookup_reply_targets_in_store, fetch_reply_target,
+                                                   REPLY_FETCH_MAX_WORKERS, REPLY_CACHE_SIZE)
+        return _reply_resolver
+
+
+def resolve_reply_contexts(group_id, prepared_messages):
+    # 只为实际被回复的消息生成摘录；窗口内的直接从已解析的消息中取
+    target_ids = [part.message_id for prepared_message in prepared_messages
+                  for part in prepared_message.content_parts if isinstance(part, ReplyRef)]
+    if not RESOLVE_REPLY_CONTEXT or not target_ids:
+        return {}
+    wanted = set(target_ids)
+    local = {str(m.message_id): reply_context_from_prepared(m) for m in prepared_messages
+             if str(m.message_id) in wanted}
+    with run_metrics.stage("reply_resolve"):
+        reply_contexts = get_reply_resolver().resolve(group_id, target_ids, local)
+    run_metrics.incr("reply_targets", len(wanted))
+    run_metrics.incr("reply_targets_unresolved", len(wanted) - len(reply_contexts))
+    get_reply_resolver().report()
+    return reply_contexts
+
+
+class PreparedWindow:
+    # 边拉取边准备的消息集合：按 message_id 去重，超过上限时只保留最新的 max_messages 条
+    def __init__(self, max_messages, start_ts=None, end_ts=None):
+        self.max_messages = max_messages
+        self.start_ts = start_ts
+        self.end_ts = end_ts
+        self._heap = []
+        self._seen_ids = set()
+
+    def add(self, prepared_message):
+        if prepared_message.message_id in self._seen_ids: return
+        self._seen_ids.add(prepared_message.message_id)
+        entry = (prepared_message.sort_key, len(self._seen_ids), prepared_message)
+        if len(self._heap) < self.max_messages:
+            heapq.heappush(self._heap, entry)
+        elif entry[0] > self._heap[0][0]:
+            heapq.heapreplace(self._heap, entry)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, message_id):
+        return message_id in self._seen_ids
+
+    def ordered(self):
+        return [entry[2] for entry in sorted(self._heap, key=lambda e: (e[0], e[1]))]
+
+
+def fetch_history_page(group_id, message_seq=None, count=HISTORY_PAGE_SIZE):
+    params = {"group_id": int(group_id)}
+    if message_seq is not None: params["message_seq"] = int(message_seq)
+    params["reverseOrder"] = 'true'
+    params["count"] = count
+    try:
+        with run_metrics.stage("onebot_page"):
+            api_data = get_onebot_client().call("get_group_msg_history", params)
+        if VERBOSE_PAYLOAD_DUMP: print(json.dumps(api_data, ensure_ascii=False))
+    except OneBotError as e:
+        print(f"  [错误] API请求失败 (已重试): {e}")
+        return None
+
+    if not (api_data and api_data.get("status") == "ok" and api_data.get("retcode") == 0):
+        print(f"  [错误] API返回不成功: {api_data.get('msg', '未知错误') if api_data else '无响应'}")
+        return None
+    messages = api_data.get("data", {}).get("messages") or []
+    run_metrics.incr("onebot_pages")
+    run_metrics.incr("onebot_messages", len(messages))
+    return messages
+
+
+def page_history_backwards(group_id, start_ts, from_seq=None, stop_seq=None):
+    # 从 from_seq (None 表示最新) 开始逐页向前翻，每页内最旧的消息在最前面。
+    # 翻到早于 start_ts、不晚于 stop_seq 或没有更早的消息时停止。
+    current_message_seq_for_api_call = from_seq
+    for _ in range(MAX_FETCH_LOOPS):
+        messages_batch = fetch_history_page(group_id, current_message_seq_for_api_call)
+        if messages_batch is None: return
+        if not messages_batch: print("  [信息] API未返回更多消息。"); return
+        yield messages_batch
 
-        messages_batch = api_data.get("data", {}).get("messages")
-        if not messages_batch: print("  [信息] API未返回更多消息。"); break
+        oldest_msg_in_batch = messages_batch[0]
+        oldest_msg_in_batch_time = oldest_msg_in_batch.get("time", 0)
+        oldest_msg_in_batch_seq = oldest_msg_in_batch.get("message_seq")
+        if oldest_msg_in_batch_seq is None:
+            print("  [错误] 批次中的第一条消息缺少 'message_seq'。停止拉取。")
+            return
+        oldest_msg_in_batch_seq = int(oldest_msg_in_batch_seq)
 
-        batch_added_count = 0
+        if oldest_msg_in_batch_time < start_ts:
+            print(
+                f"  [信息] 当前批次最旧消息 ({datetime.datetime.fromtimestamp(oldest_msg_in_batch_time).strftime('%Y-%m-%d %H:%M:%S')}) 早于目标开始时间。停止拉取。")
+            return
+        if stop_seq is not None and oldest_msg_in_batch_seq <= stop_seq:
+            print("  [信息] 已衔接上本地消息库中的已有消息。停止拉取。")
+            return
+        if oldest_msg_in_batch_seq == 0 or (current_message_seq_for_api_call is not None and
+                                            oldest_msg_in_batch_seq >= current_message_seq_for_api_call):
+            print("  [信息] 已到达群聊最早的消息，无更早消息。")
+            return
+
+        current_message_seq_for_api_call = oldest_msg_in_batch_seq
+        time.sleep(DELAY_BETWEEN_REQUESTS)
+    print(f"  [警告] 已达到最大API调用次数 ({MAX_FETCH_LOOPS})。停止拉取，时间窗口可能不完整。")
+
+
+def collect_window_via_api(group_id, start_ts, end_ts, on_message, max_messages=None):
+    # 每拉到一页就把窗口内的消息交给 on_message，不等整个窗口拉完
+    if max_messages is None: max_messages = MAX_MESSAGES_TO_PROCESS
+    collected_message_ids_for_fetch = set()
+    if FETCH_MODE == "seek":
+        sought = seek_seq_before(group_id, start_ts)
+        if sought is None: return
+        lo_seq, _, newest_seq = sought
+        # seek 模式从旧到新拉取，要保留的是最新的 max_messages 条: 窗口超出上限时直接从最新的 max_messages 个 seq 处开始
+        # (撤回等造成的 seq 空洞只会让实际条数更少)，拉满上限即停止，不再准备和下载多余消息的图片
+        if newest_seq - lo_seq > max_messages:
+            lo_seq = newest_seq - max_messages
+            print(f"  [信息] 窗口内消息超过上限 ({max_messages})，只拉取 message_seq {lo_seq} 之后的消息。")
+        for messages_batch in page_history_forwards(group_id, lo_seq, newest_seq, end_ts):
+            for msg_obj in messages_batch:
+                msg_id = msg_obj.get("message_id")
+                msg_seq = msg_obj.get("message_seq")
+                if msg_id in collected_message_ids_for_fetch or (msg_seq is not None and int(msg_seq) <= lo_seq):
+                    continue
+                if start_ts <= msg_obj.get("time", 0) <= end_ts:
+                    on_message(msg_obj)
+                    collected_message_ids_for_fetch.add(msg_id)
+                    if len(collected_message_ids_for_fetch) >= max_messages:
+                        print(f"  [信息] 在处理批次时达到消息数量上限 ({max_messages})。停止拉取。")
+                        return
+        return
+    for messages_batch in page_history_backwards(group_id, start_ts):
         for msg_obj in messages_batch:
-            if len(raw_messages_to_process) >= MAX_MESSAGES_TO_PROCESS:
+            if len(collected_message_ids_for_fetch) >= max_messages:
                 break
-
             msg_id = msg_obj.get("message_id")
             msg_time_unix = msg_obj.get("time", 0)
-
             if msg_id not in collected_message_ids_for_fetch and start_ts <= msg_time_unix <= end_ts:
-                raw_messages_to_process.append(msg_obj)
+                on_message(msg_obj)
                 collected_message_ids_for_fetch.add(msg_id)
-                batch_added_count += 1
-
-        if len(raw_messages_to_process) >= MAX_MESSAGES_TO_PROCESS:
-            print(f"  [信息] 在处理批次时达到 MAX_MESSAGES_TO_PROCESS ({MAX_MESSAGES_TO_PROCESS}) 限制。停止拉取。")
+        if len(collected_message_ids_for_fetch) >= max_messages:
+            print(f"  [信息] 在处理批次时达到消息数量上限 ({max_messages})。停止拉取。")
             break
 
-        oldest_msg_in_batch = messages_batch[0]
-        oldest_msg_in_batch_time = oldest_msg_in_batch.get("time", 0)
-        oldest_msg_in_batch_seq = oldest_msg_in_batch.get("message_seq")
 
-        if oldest_msg_in_batch_seq is None:
-            print("  [错误] 批次中的第一条消息缺少 'message_seq'。停止拉取。");
-            break
+def probe_seq_time(group_id, message_seq, store=None):
+    # 只取 1 条消息，得到 <= message_seq 的最近一条消息的 (seq, time)；该位置及之前没有消息时返回 None。
+    # API 请求失败时抛出 OneBotError，不能当作 "没有消息" 来移动二分边界
+    messages_batch = fetch_history_page(group_id, message_seq, count=1)
+    if messages_batch is None:
+        raise OneBotError("get_group_msg_history", f"试探 message_seq {message_seq} 失败")
+    if not messages_batch or messages_batch[-1].get("message_seq") is None: return None
+    if store: store.add_messages(group_id, messages_batch)
+    return int(messages_batch[-1]["message_seq"]), messages_batch[-1].get("time", 0)
 
-        current_message_seq_for_api_call = int(oldest_msg_in_batch_seq)
 
-        if oldest_msg_in_batch_time < start_ts and batch_added_count == 0:
-            print(
-                f"  [信息] 当前批次最旧消息 ({datetime.datetime.fromtimestamp(oldest_msg_in_batch_time).strftime('%Y-%m-%d %H:%M:%S')}) 早于目标开始时间，且此批次无新相关消息加入。停止拉取。")
+def seek_seq_before(group_id, start_ts, store=None):
+    # 返回 (lo_seq, lo_time, newest_seq)，lo_seq 是一条早于 start_ts 的消息 (0 表示群聊开头)。
+    # 先用本地 seq->time 索引缩小范围，再倍增步长向前试探，最后在 [lo, hi] 之间二分，
+    # 直到区间小于一页；窗口内没有消息或试探请求失败时返回 None。
+    try:
+        return _seek_seq_before(group_id, start_ts, store)
+    except OneBotError as e:
+        print(f"  [错误] 定位窗口起点失败，放弃本次 seek 拉取: {e}")
+        return None
+
+
+def _seek_seq_before(group_id, start_ts, store):
+    newest = probe_seq_time(group_id, None, store)
+    if newest is None: return None
+    newest_seq, newest_time = newest
+    if newest_time < start_ts: return None
+
+    lo_seq, lo_time = None, 0
+    hi_seq = newest_seq
+    if store:
+        before, after = store.seq_bracket(group_id, start_ts)
+        if before: lo_seq, lo_time = before
+        if after and after[0] < hi_seq: hi_seq = after[0]
+
+    probes = 1
+    step = HISTORY_PAGE_SIZE
+    while lo_seq is None:
+        probe = hi_seq - step
+        if probe <= 0:
+            lo_seq, lo_time = 0, 0
             break
-
-        if current_message_seq_for_api_call == 0:
-            print("  [信息] API报告 message_seq 已为0，无更早消息。");
+        probed = probe_seq_time(group_id, probe, store)
+        probes += 1
+        if probed is None:
+            # probe 及之前已没有消息
+            lo_seq, lo_time = 0, 0
             break
-
+        if probed[1] < start_ts:
+            lo_seq, lo_time = probed
+        else:
+            hi_seq = min(hi_seq, probed[0])
+            step *= 2
+
+    while hi_seq - lo_seq > HISTORY_PAGE_SIZE:
+        mid = (lo_seq + hi_seq) // 2
+        probed = probe_seq_time(group_id, mid, store)
+        probes += 1
+        if probed is None or probed[0] <= lo_seq:
+            lo_seq = mid  # (lo, mid] 之间没有消息
+        elif probed[1] < start_ts:
+            lo_seq, lo_time = probed
+        else:
+            hi_seq = probed[0]
         time.sleep(DELAY_BETWEEN_REQUESTS)
+    print(f"  [定位] 经过 {probes} 次试探，窗口起点约在 message_seq {lo_seq} 之后 (最新 seq {newest_seq})。")
+    return lo_seq, lo_time, newest_seq
+
+
+def page_history_forwards(group_id, from_seq, until_seq, end_ts=None):
+    # 从 from_seq 之后按页向后 (向新) 顺序拉取，直到 until_seq 或晚于 end_ts
+    anchor = from_seq + HISTORY_PAGE_SIZE
+    for _ in range(MAX_SEEK_FORWARD_PAGES):
+        messages_batch = fetch_history_page(group_id, anchor)
+        if messages_batch is None: return
+        if messages_batch: yield messages_batch
+        batch_seqs = [int(m["message_seq"]) for m in messages_batch if m.get("message_seq") is not None]
+        batch_newest_seq = max(batch_seqs) if batch_seqs else anchor
+        if batch_newest_seq >= until_seq or anchor >= until_seq: return
+        if end_ts is not None and messages_batch and messages_batch[-1].get("time", 0) > end_ts: return
+        anchor = max(anchor, batch_newest_seq) + HISTORY_PAGE_SIZE
+        time.sleep(DELAY_BETWEEN_REQUESTS)
+    print(f"  [警告] 已达到 seek 模式最大拉取页数 ({MAX_SEEK_FORWARD_PAGES})。停止拉取，时间窗口可能不完整。")
+
+
+def seek_fill_message_store(store, group_id, start_ts, until_seq=None, on_batch=None):
+    # seek 模式: 定位窗口起点后向后顺序拉取到 until_seq (默认最新)，返回 (lo_seq, lo_time, newest_seq)
+    sought = seek_seq_before(group_id, start_ts, store)
+    if sought is None: return None
+    lo_seq, lo_time, newest_seq = sought
+    fetched_count = 0
+    for messages_batch in page_history_forwards(group_id, lo_seq, until_seq if until_seq is not None else newest_seq):
+        fetched_count += store.add_messages(group_id, messages_batch)
+        if on_batch: on_batch(messages_batch)
+    print(f"  [消息库] seek 模式拉取 {fetched_count} 条消息。")
+    return lo_seq, lo_time, newest_seq
+
+
+def sync_message_store(store, group_id, start_ts, on_batch=None):
+    # 增量拉取: 只向前翻到本地库已有的最新 seq 为止；若窗口开始时间早于本地已覆盖的范围，再向前补齐。
+    # 每一页写入消息库后都会交给 on_batch，调用方可以边拉取边处理。
+    coverage = store.get_coverage(group_id)
+    live_status = store.get_live_status(group_id) if LIVE_INGEST_MAX_STALENESS else None
+    if coverage and live_status and live_status[0] and time.time() - live_status[1] <= LIVE_INGEST_MAX_STALENESS \
+            and coverage[1] <= start_ts:
+        print("  [消息库] 实时接收守护进程在线且未漏收消息，直接使用本地消息库，无需拉取历史。")
+        return
+    if FETCH_MODE == "seek":
+        covered_newest_time = store.get_message_time(group_id, coverage[2]) if coverage else None
+        if covered_newest_time is None or covered_newest_time < start_ts:
+            # 本地库与窗口没有交集，直接定位到窗口起点，不必从最新消息一页页往回翻
+            sought = seek_fill_message_store(store, group_id, start_ts, on_batch=on_batch)
+            if sought: store.merge_coverage(group_id, *sought)
+            return
 
-    print(
-        f"  API拉取完成，共获得 {len(raw_messages_to_process)} 条原始消息进行处理 (设定上限为 {MAX_MESSAGES_TO_PROCESS})。")
-    if not raw_messages_to_process:
-        print("没有收集到任何在时间范围内的唯一消息。")
-        return None, None
+    known_newest_seq = coverage[2] if coverage else None
+    fetched_count = 0
+    newest_seq = oldest_seq = oldest_time = None
+    reached_known = history_exhausted = False
+    for messages_batch in page_history_backwards(group_id, start_ts, stop_seq=known_newest_seq):
+        fetched_count += store.add_messages(group_id, messages_batch)
+        if on_batch: on_batch(messages_batch)
+        batch_seqs = [int(m["message_seq"]) for m in messages_batch if m.get("message_seq") is not None]
+        if not batch_seqs: break
+        newest_seq = max(newest_seq or 0, max(batch_seqs))
+        if oldest_seq is not None and min(batch_seqs) >= oldest_seq: history_exhausted = True
+        oldest_seq, oldest_time = min(batch_seqs), messages_batch[0].get("time", 0)
+        if known_newest_seq is not None and oldest_seq <= known_newest_seq: reached_known = True
+
+    if newest_seq is not None:
+        if reached_known:
+            coverage = (coverage[0], coverage[1], max(newest_seq, coverage[2]))
+        else:
+            coverage = (oldest_seq, 0 if history_exhausted or oldest_seq == 0 else oldest_time, newest_seq)
+        coverage = store.merge_coverage(group_id, *coverage)
+
+    if coverage and coverage[1] > start_ts:
+        print("  [信息] 本地消息库未覆盖整个时间窗口，向前补齐更早的消息...")
+        if FETCH_MODE == "seek":
+            sought = seek_fill_message_store(store, group_id, start_ts, until_seq=coverage[0], on_batch=on_batch)
+            if sought: store.merge_coverage(group_id, sought[0], sought[1], coverage[2])
+        else:
+            backfill_oldest_seq, backfill_oldest_time = coverage[0], coverage[1]
+            for messages_batch in page_history_backwards(group_id, start_ts, from_seq=coverage[0]):
+                fetched_count += store.add_messages(group_id, messages_batch)
+                if on_batch: on_batch(messages_batch)
+                batch_seqs = [int(m["message_seq"]) for m in messages_batch if m.get("message_seq") is not None]
+                if not batch_seqs: break
+                if min(batch_seqs) >= backfill_oldest_seq or min(batch_seqs) == 0:
+                    backfill_oldest_time = 0
+                    break
+                backfill_oldest_seq, backfill_oldest_time = min(batch_seqs), messages_batch[0].get("time", 0)
+            store.merge_coverage(group_id, backfill_oldest_seq, backfill_oldest_time, coverage[2])
+    print(f"  [消息库] 本次从API拉取 {fetched_count} 条消息 (增量)。")
+
+
+def collect_window_via_store(store, group_id, start_ts, end_ts, on_message, max_messages=None):
+    if max_messages is None: max_messages = MAX_MESSAGES_TO_PROCESS
+
+    def on_batch(messages_batch):
+        # 新拉到的消息立即处理 (开始下载图片)，其余的再从消息库中按时间索引读取
+        for msg_obj in messages_batch:
+            if start_ts <= msg_obj.get("time", 0) <= end_ts:
+                on_message(msg_obj)
+
+    sync_message_store(store, group_id, start_ts, on_batch)
+    for msg_obj in store.iter_messages_in_range(group_id, start_ts, end_ts, max_messages):
+        on_message(msg_obj)
+
+
+def fetch_window_messages(group_id, fetch_hours=None, max_messages=None, image_pool=None, since_ts=None):
+    # 拉取与准备流水线: 每拉到一页，其中的消息立刻被解析成 PreparedMessage，图片立刻提交给 image_pool，
+    # 原始 JSON 随即释放。返回的 PreparedWindow 最后再按 (time, message_seq) 排序。
+    # since_ts 不为空时 (增量总结) 只拉取晚于 since_ts 的消息，PreparedWindow.start_ts 仍为完整窗口的起点。
+    if max_messages is None: max_messages = MAX_MESSAGES_TO_PROCESS
+    start_ts, end_ts = get_target_time_range_timestamps(fetch_hours)
+    fetch_start_ts = max(start_ts, since_ts + 1) if since_ts is not None else start_ts
+    if since_ts is not None:
+        print(f"  [增量总结] 只拉取 {datetime.datetime.fromtimestamp(fetch_start_ts).strftime('%Y-%m-%d %H:%M:%S')} 之后的新消息。")
+    print(f"正在为Gemini准备群 {group_id} 的消息 (最多 {max_messages} 条)...")
+    prepared_window = PreparedWindow(max_messages, start_ts, end_ts)
+
+    def on_message(msg_obj):
+        if get_message_id_context(msg_obj) in prepared_window: return
+        prepared_window.add(prepare_display_message_for_gemini(msg_obj, group_id, image_pool))
 
-    raw_messages_to_process.sort(key=lambda m: (m.get("time", 0), m.get("message_seq", 0)))
+    print("  开始从API拉取消息...")
+    with run_metrics.stage("window_fetch"):
+        if USE_MESSAGE_STORE:
+            collect_window_via_store(get_message_store(), group_id, fetch_start_ts, end_ts, on_message, max_messages)
+        else:
+            collect_window_via_api(group_id, fetch_start_ts, end_ts, on_message, max_messages)
+    run_metrics.incr("window_messages", len(prepared_window))
 
-    print(f"  消息排序完成。开始格式化 ({len(raw_messages_to_process)} 条) 并下载/处理图片...")
+    print(
+        f"  API拉取完成，共获得 {len(prepared_window)} 条原始消息进行处理 (设定上限为 {max_messages})。")
+    return prepared_window
+
+
+class PreviousSummary:
+    # 上一次总结的结构化结果 (见 MessageStore.save_summary)，image_paths 为 {"图片编号": 本地路径}
+    def __init__(self, end_ts, chain_length, topics, image_paths):
+        self.end_ts = end_ts
+        self.chain_length = chain_length
+        self.topics = topics
+        self.image_paths = image_paths
+
+
+def load_previous_summary(group_id, fetch_hours=None):
+    # 能与当前窗口衔接的上一次总结；未开启增量总结、没有记录或无法衔接时返回 None (进行完整总结)
+    if fetch_hours is None: fetch_hours = FETCH_HOURS_AGO
+    if not (INCREMENTAL_SUMMARY and USE_MESSAGE_STORE) or fetch_hours > 24:
+        return None
+    record = get_message_store().latest_summary(group_id)
+    if record is None:
+        return None
+    window_start_ts = int(time.time() - fetch_hours * 3600)
+    if record["start_time"] > window_start_ts or record["end_time"] < window_start_ts:
+        print("  [增量总结] 上一次总结的时间范围与当前窗口不衔接，进行完整总结。")
+        return None
+    if record["chain_length"] >= INCREMENTAL_MAX_CHAIN:
+        print(f"  [增量总结] 已连续增量总结 {record['chain_length']} 次，本次进行完整总结。")
+        return None
+    return PreviousSummary(record["end_time"], record["chain_length"],
+                           [Topic.from_record(topic) for topic in record["topics"]], record["image_paths"])
+
+
+def carry_over_topics(previous_summary, window_start_ts):
+    # 去掉早于窗口起点的记录 (全部过期的主题整体丢弃)，并把仍被引用的图片重新编号为《图片1》起
+    carried_image_paths = []
+    renumbered = {}
+
+    def renumber_image_ref(match):
+        old_number = match.group(1)
+        path = previous_summary.image_paths.get(old_number)
+        if not path or not os.path.exists(path):
+            return "[图片]"
+        if old_number not in renumbered:
+            carried_image_paths.append(path)
+            renumbered[old_number] = len(carried_image_paths)
+        return f"《图片{renumbered[old_number]}》"
+
+    carried_topics = []
+    for topic in previous_summary.topics:
+        quotes = [quote for quote in topic.quotes if (quote.ts or 0) >= window_start_ts]
+        if not quotes:
+            continue
+        carried_topics.append(Topic(
+            IMAGE_REF_PATTERN.sub(renumber_image_ref, topic.summary),
+            [QuotedMessage(quote.time, quote.name, quote.user_id, IMAGE_REF_PATTERN.sub(renumber_image_ref, quote.text),
+                           quote.ts) for quote in quotes]))
+    expired_count = len(previous_summary.topics) - len(carried_topics)
+    print(f"  [增量总结] 沿用上次总结的 {len(carried_topics)} 个主题 (过期 {expired_count} 个)，"
+          f"其中引用的 {len(carried_image_paths)} 张图片不再重复发送。")
+    return carried_topics, carried_image_paths
+
+
+class Transcript:
+    # 组装好的群聊记录: 每行一条消息，line_image_counts[i] 为第 i 行引用的图片数，image_paths 与《图片N》顺序一致。
+    # 增量总结时 carried_topics 为沿用的已有主题，其中的《图片1..K》对应 carried_image_paths (不随请求发送)，
+    # 新消息的图片从《图片K+1》开始编号。
+    # 开启记录压缩时 lines 为压缩后的行，compactor 保存代号图例并负责把回复中的代号还原。
+    def __init__(self, group_id, fetch_hours, lines, image_paths, line_image_counts, start_ts=None, end_ts=None,
+                 previous_summary=None, carried_topics=None, carried_image_paths=(), compactor=None):
+        self.group_id = group_id
+        self.fetch_hours = fetch_hours
+        self.lines = lines
+        self.image_paths = image_paths
+        self.line_image_counts = line_image_counts
+        self.start_ts = start_ts
+        self.end_ts = end_ts
+        self.previous_summary = previous_summary
+        self.carried_topics = carried_topics
+        self.carried_image_paths = list(carried_image_paths)
+        self.compactor = compactor
+
+    @property
+    def first_image_number(self):
+        return len(self.carried_image_paths) + 1
+
+    def image_path_for_number(self, number):
+        index = number - 1
+        if index < len(self.carried_image_paths):
+            return self.carried_image_paths[index] if index >= 0 else None
+        index -= len(self.carried_image_paths)
+        return self.image_paths[index] if index < len(self.image_paths) else None
+
+    def prompt_prefix(self):
+        if self.previous_summary is not None:
+            since_str = datetime.datetime.fromtimestamp(self.previous_summary.end_ts).strftime('%Y-%m-%d %H:%M:%S')
+            return build_gemini_incremental_prompt_prefix(self.fetch_hours, render_topics(self.carried_topics),
+                                                          since_str, len(self.carried_image_paths))
+        return build_gemini_prompt_prefix(self.fetch_hours)
+
+    def body_text(self, start_line=0, end_line=None):
+        header = self.compactor.header(start_line, end_line) if self.compactor else ""
+        return header + "\n".join(self.lines[start_line:end_line])
+
+    def body_header(self):
+        return self.compactor.header() if self.compactor else ""
+
+    def expand_aliases(self, text):
+        return self.compactor.expand_text(text) if self.compactor and text else text
+
+    def expand_topic(self, topic):
+        return self.compactor.expand_topic(topic) if self.compactor else topic
+
+    def prompt_text(self):
+        return self.prompt_prefix() + self.body_text()
+
+
+def prepare_gemini_transcript(group_id, prepared_window, fetch_hours=None, image_pool=None, previous_summary=None):
+    if fetch_hours is None: fetch_hours = FETCH_HOURS_AGO
+    all_text_parts_for_gemini_prompt = []
+    ordered_image_paths_for_gemini = []
+    line_image_counts = []
+    carried_topics, carried_image_paths = None, []
+    if previous_summary is not None:
+        carried_topics, carried_image_paths = carry_over_topics(previous_summary, prepared_window.start_ts)
+    current_image_placeholder_counter = len(carried_image_paths) + 1
+    image_deduper = ImageDeduper(IMAGE_DEDUP_MAX_DISTANCE)
+    prompt_build_started = time.perf_counter()
+
+    prepared_messages = prepared_window.ordered()
+    print(f"  消息排序完成。开始格式化 ({len(prepared_messages)} 条) 并等待图片下载/处理...")
+
+    own_pool = image_pool is None
+    if own_pool:
+        image_pool = ImageDownloadPool(download_and_process_image_for_gemini, IMAGE_DOWNLOAD_MAX_WORKERS,
+                                       IMAGE_DOWNLOAD_PER_HOST_LIMIT)
+    try:
+        # 拉取阶段未提交的图片 (例如未提供 image_pool 时) 在这里一次性提交，已提交的不会重复下载
+        for prepared_message in prepared_messages:
+            for part in prepared_message.content_parts:
+                if isinstance(part, ImageRef): part.submit(image_pool)
+
+        # 图片在后台下载时解析被回复的消息
+        reply_contexts = resolve_reply_contexts(group_id, prepared_messages)
+
+        # 按消息顺序取回图片结果并分配《图片N》编号
+        compactor = TranscriptCompactor() if TRANSCRIPT_COMPACTION else None
+        for prepared_message in prepared_messages:
+            counter_before = current_image_placeholder_counter
+            if compactor:
+                text_content, current_image_placeholder_counter = render_message_content(
+                    prepared_message.content_parts, ordered_image_paths_for_gemini, current_image_placeholder_counter,
+                    image_pool, image_deduper, reply_contexts)
+                compactor.add(prepared_message.header[:8], prepared_message.sender, prepared_message.user_id,
+                              text_content, current_image_placeholder_counter - counter_before)
+                continue
+            formatted_line, current_image_placeholder_counter = render_display_message_for_gemini(
+                prepared_message, ordered_image_paths_for_gemini, current_image_placeholder_counter, image_pool,
+                image_deduper, reply_contexts
+            )
+            all_text_parts_for_gemini_prompt.append(formatted_line)
+            line_image_counts.append(current_image_placeholder_counter - counter_before)
+        if compactor:
+            all_text_parts_for_gemini_prompt, line_image_counts = compactor.lines, compactor.line_image_counts
+            run_metrics.incr("compaction_tokens_saved", compactor.report())
+        image_deduper.report()
+        if USE_MEDIA_PROCESS_POOL and _media_pool is not None: _media_pool.report()
+    finally:
+        if own_pool:
+            image_pool.shutdown()
+            image_pool.report()
+    get_image_cache().save()
+    if own_pool:
+        get_image_cache().report()
+    run_metrics.observe("prompt_build", time.perf_counter() - prompt_build_started)
+    run_metrics.incr("transcript_lines", len(all_text_parts_for_gemini_prompt))
+    run_metrics.incr("transcript_images", len(ordered_image_paths_for_gemini))
+    run_metrics.incr("transcript_duplicate_images", image_deduper.duplicate_images)
+
+    return Transcript(group_id, fetch_hours, all_text_parts_for_gemini_prompt, ordered_image_paths_for_gemini,
+                      line_image_counts, prepared_window.start_ts, prepared_window.end_ts, previous_summary,
+                      carried_topics, carried_image_paths, compactor)
+
+
+def fetch_and_prepare_transcript(group_id, fetch_hours=None, max_messages=None):
+    if not PILLOW_AVAILABLE:
+        print(
+            "警告: Pillow (PIL) 库未安装。GIF图片将无法提取第一帧，相关图片可能不会被发送。请运行 'pip install Pillow' 来启用此功能。")
 
-    for msg_obj in raw_messages_to_process:
-        formatted_line, current_image_placeholder_counter = format_display_message_for_gemini(
-            msg_obj, group_id, ordered_image_paths_for_gemini, current_image_placeholder_counter
-        )
-        all_text_parts_for_gemini_prompt.append(formatted_line)
+    ensure_dir_exists(IMAGE_DOWNLOAD_DIR)
+    with ImageDownloadPool(download_and_process_image_for_gemini, IMAGE_DOWNLOAD_MAX_WORKERS,
+                           IMAGE_DOWNLOAD_PER_HOST_LIMIT) as image_pool:
+        previous_summary = load_previous_summary(group_id, fetch_hours)
+        prepared_window = fetch_window_messages(group_id, fetch_hours, max_messages, image_pool,
+                                                previous_summary.end_ts if previous_summary else None)
+        if not len(prepared_window) and previous_summary is None:
+            print("没有收集到任何在时间范围内的唯一消息。")
+            return None
+        transcript = prepare_gemini_transcript(group_id, prepared_window, fetch_hours, image_pool, previous_summary)
+        image_pool.report()
+    get_image_cache().report()
+    return transcript
+
+
+def summarize_transcript(transcript, echo=True, on_chunk=None):
+    # 估算 token 数未超过单次请求预算时直接发送；否则按时间切块并发总结 (map)，再合并成一份报告 (reduce)
+    # on_chunk 只接收最终报告的文本块 (未还原代号)，分块总结的中间结果不会传给它；返回的报告中代号已还原
+    return transcript.expand_aliases(_summarize_transcript(transcript, echo, on_chunk))
+
+
+def _summarize_transcript(transcript, echo, on_chunk):
+    prefix_tokens = estimate_text_tokens(transcript.prompt_prefix() + transcript.body_header())
+    total_tokens = prefix_tokens + estimate_transcript_tokens(transcript.lines, transcript.line_image_counts)
+    if total_tokens <= SINGLE_REQUEST_TOKEN_BUDGET:
+        return send_to_gemini(transcript.body_text(), transcript.image_paths, echo=echo,
+                              prompt_prefix=transcript.prompt_prefix(), on_chunk=on_chunk)
+
+    chunks = plan_chunks(transcript.lines, transcript.line_image_counts, max(1, CHUNK_TOKEN_BUDGET - prefix_tokens))
+    print(f"\n[分块总结] 估算 {total_tokens} tokens，超过单次预算 {SINGLE_REQUEST_TOKEN_BUDGET}，"
+          f"切分为 {len(chunks)} 段 (每段不超过约 {CHUNK_TOKEN_BUDGET} tokens) 并发总结。")
+
+    def summarize_chunk(chunk_index, chunk):
+        chunk_lines = transcript.lines[chunk.start_line:chunk.end_line]
+        time_range = f"{chunk_lines[0][:8]} 至 {chunk_lines[-1][:8]}"
+        chunk_prompt = build_gemini_chunk_prompt_prefix(
+            transcript.fetch_hours, chunk_index, len(chunks), time_range, chunk.first_image + transcript.first_image_number,
+            chunk.image_count
+        ) + transcript.body_text(chunk.start_line, chunk.end_line)
+        chunk_images = transcript.image_paths[chunk.first_image:chunk.first_image + chunk.image_count]
+        return send_to_gemini(chunk_prompt, chunk_images, echo=False)
+
+    with ThreadPoolExecutor(max_workers=max(1, MAP_REDUCE_MAX_CONCURRENCY), thread_name_prefix="map") as executor:
+        partial_reports = list(executor.map(summarize_chunk, range(1, len(chunks) + 1), chunks))
+    failed_count = sum(1 for report in partial_reports if report is None)
+    if failed_count == len(partial_reports):
+        print("[分块总结] 所有片段均总结失败。")
+        return None
+    if failed_count:
+        print(f"[分块总结] 警告: {failed_count} 个片段总结失败，最终报告将缺少这些时间段。")
+    partial_reports = [report for report in partial_reports if report is not None]
+    if transcript.carried_topics:
+        # 增量总结: 沿用的已有主题作为最早的一段参与合并
+        partial_reports.insert(0, render_topics(transcript.carried_topics))
+    if len(partial_reports) == 1:
+        if echo: print(partial_reports[0])
+        if on_chunk: on_chunk(partial_reports[0])
+        return partial_reports[0]
+    print(f"[分块总结] {len(partial_reports)} 段总结完成，开始合并...")
+    return send_to_gemini(build_gemini_reduce_prompt(transcript.fetch_hours, partial_reports), [], echo=echo,
+                          on_chunk=on_chunk)
+
+
+def create_publisher(transcript, group_ids=None):
+    # 所有发布共用一个限速器，多群并发发布时合计速率仍不超过 PUBLISH_RATE_LIMIT
+    global _publish_rate_limiter
+    with _shared_resource_lock:
+        if _publish_rate_limiter is None and PUBLISH_RATE_LIMIT:
+            _publish_rate_limiter = RateLimiter(PUBLISH_RATE_LIMIT)
+    title = (f"群 {transcript.group_id} 过去 {transcript.fetch_hours} 小时的聊天总结"
+             if transcript.fetch_hours else None)
+    return SummaryPublisher(get_onebot_client(), PUBLISH_GROUP_IDS if group_ids is None else group_ids,
+                            rate_limiter=_publish_rate_limiter, node_user_id=PUBLISH_NODE_USER_ID,
+                            node_nickname=PUBLISH_NODE_NICKNAME,
+                            image_resolver=transcript.image_path_for_number if PUBLISH_ATTACH_IMAGES else None,
+                            title=title)
+
+
+def summarize_transcript_topics(transcript, echo=True, on_topic=None, on_overview=None):
+    # 总结的同时增量解析回复: 概述交给 on_overview，每个主题一完成就交给 on_topic 并写入 REPORT_TOPICS_DIR，
+    # 返回 (回复文本, 主题列表)
+    writer = None
+    if REPORT_TOPICS_DIR:
+        os.makedirs(REPORT_TOPICS_DIR, exist_ok=True)
+        stamp = datetime.datetime.fromtimestamp(transcript.end_ts or time.time()).strftime("%Y%m%d_%H%M%S")
+        writer = TopicFileWriter(os.path.join(REPORT_TOPICS_DIR, f"{transcript.group_id}_{stamp}.jsonl"))
+
+    def handle_topic(topic):
+        transcript.expand_topic(topic)
+        if transcript.end_ts is not None: resolve_quote_times([topic], transcript.end_ts)
+        if writer: writer.write(topic)
+        if on_topic: on_topic(topic)
+
+    def handle_overview(overview):
+        if on_overview: on_overview(transcript.expand_aliases(overview))
+
+    parser = StreamingTopicParser(handle_topic, handle_overview)
+    try:
+        reply_text = summarize_transcript(transcript, echo=echo, on_chunk=parser.feed)
+    finally:
+        if writer: writer.close()
+    if writer and parser.topics: print(f"  [报告] {len(parser.topics)} 个主题已保存到 {writer.path}")
+    return reply_text, parser.topics
 
-    final_text_prompt = GEMINI_PROMPT_PREFIX + "\n".join(
-        all_text_parts_for_gemini_prompt)
 
-    return final_text_prompt, ordered_image_paths_for_gemini
+def save_summary_for_incremental(transcript, reply_text, topics=None):
+    # 保存本次报告的主题结构，供下一次运行增量总结；topics 为流式解析的结果，未提供时重新解析 reply_text
+    if not (INCREMENTAL_SUMMARY and USE_MESSAGE_STORE) or reply_text is None or transcript.end_ts is None:
+        return
+    if topics is None: topics = parse_report_topics(reply_text)
+    topics = resolve_quote_times(topics, transcript.end_ts)
+    if not topics:
+        print("  [增量总结] 未能从回复中解析出主题，下次运行将进行完整总结。")
+        return
+    referenced_image_paths = {}
+    for topic in topics:
+        for number in topic.image_numbers:
+            path = transcript.image_path_for_number(number)
+            if path: referenced_image_paths[str(number)] = path
+    chain_length = transcript.previous_summary.chain_length + 1 if transcript.previous_summary else 0
+    get_message_store().save_summary(transcript.group_id, transcript.start_ts, transcript.end_ts, chain_length,
+                                     reply_text, [topic.to_record() for topic in topics], referenced_image_paths)
+    print(f"  [增量总结] 已保存 {len(topics)} 个主题，下次运行只需发送新消息。")
+
+
+def write_run_metrics(**labels):
+    run_metrics.report()
+    try:
+        if METRICS_JSONL_PATH: run_metrics.write_jsonl(METRICS_JSONL_PATH, **labels)
+        if METRICS_PROMETHEUS_PATH: run_metrics.write_prometheus(METRICS_PROMETHEUS_PATH)
+    except OSError as e:
+        print(f"  [运行指标] 写入失败: {e}")
 
 
 # --- End QQ Message Fetching and Formatting Logic ---
 
 # --- Main Execution Block ---
 if __name__ == "__main__":
+    # 直接运行本脚本时同样读取 QQSUM_CONFIG 配置文件与环境变量；完整的命令行入口见 cli.py
+    import sys
+    from app_config import ConfigError, load_config
+    try:
+        load_config([sys.modules[__name__]])
+    except ConfigError as e:
+        print(f"错误: {e}")
+        exit(2)
+
     if not PILLOW_AVAILABLE:
         print("\n警告: Pillow 库未安装，GIF图片的第一帧提取功能将不可用。相关图片可能不会被发送。")
         print("请运行 'pip install Pillow' 来安装。\n")
 
-    if not genai or not genai_types:
+    if not load_genai():
         print("错误: google-generativeai 库导入失败。请确保已正确安装。脚本无法继续。")
         exit(1)
 
@@ -456,7 +1568,7 @@ if __name__ == "__main__":
         print("=" * 70)
         print("错误：Gemini API Key 未配置或仍为占位符。")
         print("请在脚本顶部的 GEMINI_API_KEY_VALUE 处填入您真实的Gemini API Key。")
-        print("如果您希望通过环境变量设置，请修改脚本对应行为。")
+        print("也可以通过环境变量 GEMINI_API_KEY 或 QQSUM_CONFIG 指定的配置文件设置。")
         print("=" * 70)
         exit(1)
 
@@ -464,17 +1576,25 @@ if __name__ == "__main__":
         print("=" * 50)
         print(f"提示：您可能正在使用示例群号: {TARGET_GROUP_ID}")
         print(f"将从过去 {FETCH_HOURS_AGO} 小时拉取消息，最多处理 {MAX_MESSAGES_TO_PROCESS} 条。")
-        print(f"图片将临时下载到 '{IMAGE_DOWNLOAD_DIR}/group_{TARGET_GROUP_ID}' 目录。")
+        print(f"图片将缓存到 '{IMAGE_DOWNLOAD_DIR}' 目录 (上限 {IMAGE_CACHE_MAX_BYTES // 1024 ** 2} MB)。")
         print(f"确保 GEMINI_API_KEY_VALUE 已在脚本中正确设置，并且已安装 google-generativeai 和 Pillow。")
-        print(f"将使用模型: {GEMINI_MODEL_NAME}")
+        print(f"首选模型: {GEMINI_MODEL_NAME} (实际使用的模型见每次请求的输出)")
         print("!!! 安全警告: API密钥当前配置在脚本中。请确保此脚本文件的安全，或改用环境变量。 !!!")
         print("=" * 50)
 
-    aggregated_text, ordered_image_paths = fetch_and_prepare_for_gemini(TARGET_GROUP_ID)
-    # print(aggregated_text)
-    if aggregated_text is not None and ordered_image_paths is not None:
-        send_to_gemini(aggregated_text, ordered_image_paths)
-        print(f"\n提示: 处理完成。临时图片位于 '{IMAGE_DOWNLOAD_DIR}' 目录，您可能需要手动清理。")
+    transcript = fetch_and_prepare_transcript(TARGET_GROUP_ID)
+    # print(transcript.prompt_text())
+    if transcript is not None:
+        publisher = create_publisher(transcript) if PUBLISH_GROUP_IDS else None
+        reply_text, topics = summarize_transcript_topics(
+            transcript, on_topic=publisher.publish_topic if publisher else None,
+            on_overview=publisher.publish_overview if publisher else None)
+        if publisher: publisher.close(reply_text)
+        save_summary_for_incremental(transcript, reply_text, topics)
+        report_upload_caches()
+        if _gemini_pool is not None: _gemini_pool.report()
+        write_run_metrics(group_id=TARGET_GROUP_ID)
+        print(f"\n提示: 处理完成。图片缓存位于 '{IMAGE_DOWNLOAD_DIR}' 目录，超出上限时会自动淘汰。")
     else:
         print("未能准备好发送给Gemini的内容或准备过程中出错。")
 # --- End Main Execution Block ---
\ No newline at end of file
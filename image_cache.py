@@ -0,0 +1,264 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# QQ 图片 URL 中每次都会变化、与图片内容无关的查询参数
+VOLATILE_URL_PARAMS = {"rkey", "term", "is_origin", "t", "spec"}
+
+
+def image_source_key(image_url, image_name_from_qq=""):
+    """同一张图片在不同消息/群里给出的稳定标识：优先 QQ 的 file 名，其次去掉易变参数的 URL。"""
+    base_name = os.path.basename(image_name_from_qq or "")
+    if base_name and base_name != "image" and "." in base_name:
+        return f"file:{base_name.lower()}"
+    parts = urlsplit(image_url or "")
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                   if k.lower() not in VOLATILE_URL_PARAMS)
+    return "url:" + urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ""))
+
+
+class ImageCache:
+    """按内容哈希存储的磁盘图片缓存，带字节上限与 LRU 淘汰。
+
+    index.json 记录 来源标识 -> 内容哈希 -> 文件，命中时无需逐个 os.path.exists/getsize。
+    派生文件（如 GIF 第一帧）挂在原始对象下，随原始对象一起淘汰。
+    本次运行访问过的对象不会被淘汰，避免把即将发送的图片删掉；常驻进程应把 pin_accessed 设为 False。
+    保存时与磁盘上的索引合并，多个进程 (守护进程与总结任务) 共用同一目录时不会互相覆盖。
+    """
+
+    INDEX_FILENAME = "index.json"
+
+    def __init__(self, root_dir, max_bytes):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self._index_path = os.path.join(root_dir, self.INDEX_FILENAME)
+        self._lock = threading.RLock()
+        self._key_locks = {}
+        self._pinned = set()
+        self.pin_accessed = True
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.evicted_bytes = 0
+        os.makedirs(os.path.join(root_dir, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(root_dir, "tmp"), exist_ok=True)
+        self._keys, self._objects = self._load_index()
+        self._total = sum(self._object_bytes(obj) for obj in self._objects.values())
+
+    # --- 索引 ---
+    def _load_index(self):
+        try:
+            with open(self._index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data.get("keys", {}), data.get("objects", {})
+        except FileNotFoundError:
+            return {}, {}
+        except Exception as e:
+            print(f"    [图片缓存] 索引文件损坏，将重建: {e}")
+            return {}, {}
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            self._merge_disk_index()
+            self._evict_if_needed()
+            tmp_path = self._index_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"keys": self._keys, "objects": self._objects}, f, ensure_ascii=False)
+            os.replace(tmp_path, self._index_path)
+            self._dirty = False
+
+    def _merge_disk_index(self):
+        # 并入其他进程写入的对象；文件已不存在的 (被其他进程淘汰或本进程淘汰) 两边都丢弃
+        disk_keys, disk_objects = self._load_index()
+        for digest, obj in disk_objects.items():
+            mine = self._objects.get(digest)
+            if mine is None:
+                if os.path.exists(self._abs(obj["file"])):
+                    self._objects[digest] = obj
+                    self._total += self._object_bytes(obj)
+                continue
+            mine["atime"] = max(mine["atime"], obj.get("atime", 0))
+            derived = mine.setdefault("derived", {})
+            for name, entry in obj.get("derived", {}).items():
+                if name not in derived and os.path.exists(self._abs(entry["file"])):
+                    derived[name] = entry
+                    self._total += entry["size"]
+            for name, value in obj.get("meta", {}).items():
+                mine.setdefault("meta", {}).setdefault(name, value)
+        if disk_objects:
+            for digest in [d for d in self._objects if d not in disk_objects and d not in self._pinned]:
+                if not os.path.exists(self._abs(self._objects[digest]["file"])):
+                    self._remove_object(digest)
+        for key, digest in disk_keys.items():
+            if digest in self._objects:
+                self._keys.setdefault(key, digest)
+
+    def total_bytes(self):
+        return self._total
+
+    @staticmethod
+    def _object_bytes(obj):
+        return obj["size"] + sum(d["size"] for d in obj.get("derived", {}).values())
+
+    def _abs(self, rel_path):
+        return os.path.join(self.root_dir, rel_path)
+
+    def _key_lock(self, key):
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None:
+                lock = threading.Lock()
+                self._key_locks[key] = lock
+            return lock
+
+    def _touch(self, digest):
+        obj = self._objects[digest]
+        obj["atime"] = time.time()
+        if self.pin_accessed: self._pinned.add(digest)
+        self._dirty = True
+
+    # --- 原始图片 ---
+    def lookup(self, source_key):
+        with self._lock:
+            digest = self._keys.get(source_key)
+            if digest is None or digest not in self._objects:
+                return None, None
+            self._touch(digest)
+            return digest, self._abs(self._objects[digest]["file"])
+
+    def fetch(self, source_key, ext, download_fn):
+        """返回 (内容哈希, 本地路径)。未命中时调用 download_fn(文件对象) 写入内容。"""
+        digest, path = self.lookup(source_key)
+        if digest:
+            self.hits += 1
+            return digest, path
+        with self._key_lock(source_key):
+            digest, path = self.lookup(source_key)
+            if digest:
+                self.hits += 1
+                return digest, path
+            self.misses += 1
+            return self._store_download(source_key, ext, download_fn)
+
+    def _store_download(self, source_key, ext, download_fn):
+        tmp_path = os.path.join(self.root_dir, "tmp", f"{threading.get_ident()}_{time.time_ns()}{ext}")
+        try:
+            with open(tmp_path, "wb") as f:
+                download_fn(f)
+            hasher = hashlib.sha256()
+            size = 0
+            with open(tmp_path, "rb") as f:
+                for block in iter(lambda: f.read(65536), b""):
+                    hasher.update(block)
+                    size += len(block)
+            if size == 0:
+                raise ValueError("下载内容为空")
+            digest = hasher.hexdigest()
+            rel_path = os.path.join("objects", digest[:2], digest + ext)
+            with self._lock:
+                if digest in self._objects:
+                    # 同一张图以不同来源出现（例如在多个群里转发），只保留一份
+                    os.remove(tmp_path)
+                else:
+                    os.makedirs(os.path.dirname(self._abs(rel_path)), exist_ok=True)
+                    os.replace(tmp_path, self._abs(rel_path))
+                    self._objects[digest] = {"file": rel_path, "size": size, "atime": time.time(), "derived": {}}
+                    self._total += size
+                self._keys[source_key] = digest
+                self._touch(digest)
+                self._evict_if_needed()
+                return digest, self._abs(self._objects[digest]["file"])
+        finally:
+            if os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    # --- 派生文件 ---
+    def derived(self, digest, name, ext, produce_fn):
+        """返回派生文件路径，缓存未命中时调用 produce_fn(目标路径) 生成。"""
+        with self._lock:
+            obj = self._objects.get(digest)
+            if obj is None:
+                raise KeyError(digest)
+            entry = obj.get("derived", {}).get(name)
+            if entry:
+                self._touch(digest)
+                return self._abs(entry["file"])
+        with self._key_lock(f"derived:{digest}:{name}"):
+            with self._lock:
+                entry = self._objects.get(digest, {}).get("derived", {}).get(name)
+                if entry:
+                    return self._abs(entry["file"])
+            rel_path = os.path.join("objects", digest[:2], f"{digest}_{name}{ext}")
+            produce_fn(self._abs(rel_path))
+            size = os.path.getsize(self._abs(rel_path))
+            with self._lock:
+                obj = self._objects.get(digest)
+                if obj is None:
+                    raise KeyError(digest)
+                obj.setdefault("derived", {})[name] = {"file": rel_path, "size": size}
+                self._total += size
+                self._touch(digest)
+                self._evict_if_needed()
+            return self._abs(rel_path)
+
+    # --- 元数据 (如感知哈希、压缩前后大小)，随索引一起保存 ---
+    def get_meta(self, digest, name):
+        with self._lock:
+            return self._objects.get(digest, {}).get("meta", {}).get(name)
+
+    def set_meta(self, digest, name, value):
+        with self._lock:
+            obj = self._objects.get(digest)
+            if obj is not None:
+                obj.setdefault("meta", {})[name] = value
+                self._dirty = True
+
+    @staticmethod
+    def digest_from_path(path):
+        # 原始文件与派生文件都以内容哈希开头命名: objects/ab/<sha256>[_<派生名>].<扩展名>
+        return os.path.basename(path)[:64]
+
+    def invalidate(self, digest):
+        with self._lock:
+            self._remove_object(digest)
+
+    # --- 淘汰 ---
+    def _remove_object(self, digest):
+        obj = self._objects.pop(digest, None)
+        if obj is None:
+            return
+        self._total -= self._object_bytes(obj)
+        for rel_path in [obj["file"]] + [d["file"] for d in obj.get("derived", {}).values()]:
+            try:
+                os.remove(self._abs(rel_path))
+            except OSError:
+                pass
+        for key in [k for k, v in self._keys.items() if v == digest]:
+            del self._keys[key]
+        self._pinned.discard(digest)
+        self._dirty = True
+
+    def _evict_if_needed(self):
+        if not self.max_bytes:
+            return
+        if self._total <= self.max_bytes:
+            return
+        candidates = sorted((obj["atime"], digest) for digest, obj in self._objects.items()
+                            if digest not in self._pinned)
+        for _, digest in candidates:
+            if self._total <= self.max_bytes:
+                break
+            self.evicted_bytes += self._object_bytes(self._objects[digest])
+            self._remove_object(digest)
+
+    def report(self):
+        print(f"  [图片缓存] 命中 {self.hits} 次, 新下载 {self.misses} 张, 本次淘汰 {self.evicted_bytes / 1048576:.1f} MB, "
+              f"当前占用 {self.total_bytes() / 1048576:.1f} MB / 上限 {self.max_bytes / 1048576:.0f} MB。")
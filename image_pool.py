@@ -0,0 +1,119 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+
+class ImageDownloadPool:
+    """有界线程池：并发下载/处理图片，同时限制每个主机的并发数。
+
+    worker_fn 与 download_and_process_image_for_gemini 的签名一致，
+    submit() 对同一张图片只提交一次，调用方按消息顺序 result() 取回结果，
+    因此《图片N》的编号与串行版本完全一致。
+
+    长期运行的预取场景 (实时接收守护进程) 使用 keep_results=False：任务完成后不再保留结果，只起到填充图片缓存的作用；
+    max_pending 限制未完成的任务数，超出时 submit() 阻塞，从而把背压传递给调用方。
+    """
+
+    def __init__(self, worker_fn, max_workers=8, per_host_limit=4, keep_results=True, max_pending=None):
+        self._worker_fn = worker_fn
+        self._keep_results = keep_results
+        self._pending_slots = threading.BoundedSemaphore(max_pending) if max_pending else None
+        self._job_count = 0
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="img")
+        self._per_host_limit = max(1, per_host_limit)
+        self._host_semaphores = {}
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._serial_seconds = 0.0
+        self._first_submit = None
+        self._last_done = None
+
+    def _host_semaphore(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            sem = self._host_semaphores.get(host)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self._per_host_limit)
+                self._host_semaphores[host] = sem
+            return sem
+
+    def _run(self, image_url, group_id, image_name_from_qq, message_id_context):
+        with self._host_semaphore(image_url):
+            started = time.perf_counter()
+            try:
+                return self._worker_fn(image_url, group_id, image_name_from_qq, message_id_context)
+            finally:
+                finished = time.perf_counter()
+                with self._lock:
+                    self._serial_seconds += finished - started
+                    self._last_done = max(self._last_done or finished, finished)
+
+    @staticmethod
+    def _key(image_url, image_name_from_qq, message_id_context):
+        return image_url, image_name_from_qq, message_id_context
+
+    def submit(self, image_url, group_id, image_name_from_qq, message_id_context):
+        key = self._key(image_url, image_name_from_qq, message_id_context)
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                return future
+        if self._pending_slots:
+            self._pending_slots.acquire()
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                if self._pending_slots: self._pending_slots.release()
+                return future
+            if self._first_submit is None:
+                self._first_submit = time.perf_counter()
+            future = self._executor.submit(self._run, image_url, group_id, image_name_from_qq, message_id_context)
+            self._futures[key] = future
+            self._job_count += 1
+        future.add_done_callback(lambda f, done_key=key: self._on_done(done_key))
+        return future
+
+    def _on_done(self, key):
+        if self._pending_slots:
+            self._pending_slots.release()
+        if not self._keep_results:
+            with self._lock:
+                self._futures.pop(key, None)
+
+    def result(self, image_url, group_id, image_name_from_qq, message_id_context):
+        future = self.submit(image_url, group_id, image_name_from_qq, message_id_context)
+        try:
+            return future.result()
+        except Exception as e:
+            print(f"    [图片] 并发处理失败: {image_url[:60]}..., 错误: {e}")
+            return None, " (处理异常)"
+
+    def stats(self):
+        with self._lock:
+            wall = 0.0
+            if self._first_submit is not None and self._last_done is not None:
+                wall = max(0.0, self._last_done - self._first_submit)
+            return {
+                "jobs": self._job_count,
+                "serial_seconds": self._serial_seconds,
+                "wall_seconds": wall,
+                "saved_seconds": max(0.0, self._serial_seconds - wall),
+            }
+
+    def report(self):
+        s = self.stats()
+        if not s["jobs"]:
+            return
+        print(f"  [图片池] 共处理 {s['jobs']} 张图片: 串行耗时约 {s['serial_seconds']:.2f}s, "
+              f"并发实际耗时 {s['wall_seconds']:.2f}s, 节省约 {s['saved_seconds']:.2f}s。")
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown()
+        return False
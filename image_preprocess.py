@@ -0,0 +1,120 @@
+import importlib.util
+
+# Pillow 只在真正处理图片时才导入 (多在媒体处理进程中)，只拉取消息的运行不必付出导入开销
+PILLOW_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+RECOMPRESS_EXTENSIONS = {"WEBP": ".webp", "JPEG": ".jpg", "PNG": ".png"}
+
+
+def _pil_image():
+    from PIL import Image
+    return Image
+
+
+def extract_gif_first_frame(gif_path, frame_full_path):
+    PILImage = _pil_image()
+    pil_im = PILImage.open(gif_path)
+    pil_im.seek(0)
+    if pil_im.mode == 'P' or pil_im.mode == 'RGBA':
+        converted_frame = pil_im.convert('RGBA') if pil_im.mode == 'P' else pil_im
+    elif pil_im.mode != 'RGB':
+        converted_frame = pil_im.convert('RGB')
+    else:
+        converted_frame = pil_im
+    converted_frame.save(frame_full_path, "PNG")
+
+
+def compact_image(src_path, dst_path, max_edge, image_format="WEBP", quality=80):
+    """把图片缩放到最长边不超过 max_edge 并重新编码，返回用于感知哈希的 dHash。"""
+    PILImage = _pil_image()
+    with PILImage.open(src_path) as pil_im:
+        pil_im.seek(0)
+        if image_format == "JPEG":
+            converted = pil_im.convert("RGB")
+        elif pil_im.mode not in ("RGB", "RGBA"):
+            converted = pil_im.convert("RGBA" if "transparency" in pil_im.info or pil_im.mode in ("P", "LA") else "RGB")
+        else:
+            converted = pil_im.copy()
+    if max_edge and max(converted.size) > max_edge:
+        converted.thumbnail((max_edge, max_edge), PILImage.LANCZOS)
+    save_kwargs = {"quality": quality} if image_format in ("WEBP", "JPEG") else {"optimize": True}
+    converted.save(dst_path, image_format, **save_kwargs)
+    return dhash(converted)
+
+
+def dhash(pil_im, hash_size=8):
+    # difference hash: 缩成 (hash_size+1) x hash_size 的灰度图，比较相邻像素的明暗得到 64 位指纹
+    small = pil_im.convert("L").resize((hash_size + 1, hash_size), _pil_image().BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class ImageDeduper:
+    """一次运行内的近似重复图片检测: 与之前已附带图片的 dHash 距离不超过 max_distance 时复用其编号。
+
+    64 位指纹被切成 8 段，距离不超过 7 的两个指纹至少有一段完全相同，只需比较同段相同的候选。
+    """
+
+    BANDS = 8
+
+    def __init__(self, max_distance):
+        self.max_distance = None if max_distance is None else min(max_distance, self.BANDS - 1)
+        self._by_content = {}
+        self._by_band = {}
+        self.attached_images = 0
+        self.attached_bytes = 0
+        self.source_bytes = 0
+        self.duplicate_images = 0
+        self.duplicate_bytes = 0
+
+    def _bands(self, perceptual_hash):
+        band_bits = 64 // self.BANDS
+        mask = (1 << band_bits) - 1
+        return [(i, (perceptual_hash >> (i * band_bits)) & mask) for i in range(self.BANDS)]
+
+    @staticmethod
+    def _informative(perceptual_hash):
+        # 纯色/无纹理图片的指纹是全 0 或全 1，彼此之间没有区分度，只按内容完全相同去重
+        return perceptual_hash is not None and perceptual_hash not in (0, (1 << 64) - 1)
+
+    def find(self, content_key, perceptual_hash):
+        if content_key in self._by_content:
+            return self._by_content[content_key]
+        if self.max_distance is None or not self._informative(perceptual_hash):
+            return None
+        best = None
+        for band in self._bands(perceptual_hash):
+            for seen_hash, number in self._by_band.get(band, ()):
+                distance = hamming_distance(seen_hash, perceptual_hash)
+                if distance <= self.max_distance and (best is None or distance < best[0]):
+                    best = (distance, number)
+        return best[1] if best else None
+
+    def add(self, content_key, perceptual_hash, number, attached_bytes, source_bytes):
+        self._by_content[content_key] = number
+        if self._informative(perceptual_hash):
+            for band in self._bands(perceptual_hash):
+                self._by_band.setdefault(band, []).append((perceptual_hash, number))
+        self.attached_images += 1
+        self.attached_bytes += attached_bytes
+        self.source_bytes += source_bytes
+
+    def add_duplicate(self, attached_bytes):
+        self.duplicate_images += 1
+        self.duplicate_bytes += attached_bytes
+
+    def report(self):
+        saved_by_recompress = max(0, self.source_bytes - self.attached_bytes)
+        print(f"  [图片预处理] 附带 {self.attached_images} 张图片共 {self.attached_bytes / 1024:.0f} KB "
+              f"(压缩节省 {saved_by_recompress / 1024:.0f} KB)；"
+              f"跳过近似重复 {self.duplicate_images} 张，节省 {self.duplicate_bytes / 1024:.0f} KB。")
@@ -0,0 +1,165 @@
+import importlib
+import multiprocessing
+import os
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+try:
+    import signal
+except ImportError:
+    signal = None
+
+
+class MediaJobError(Exception):
+    pass
+
+
+class MediaJobTimeout(MediaJobError):
+    pass
+
+
+# --- 视频关键帧提取器 ---
+# 每个提取器签名为 fn(src_path, dst_png_path)，失败时抛出异常。
+# 除内置名称外，也可以在 VIDEO_KEYFRAME_EXTRACTORS 中写 "模块名:函数名" 接入自定义实现。
+VIDEO_KEYFRAME_OFFSET_SECONDS = 1.0
+
+
+def extract_keyframe_opencv(src_path, dst_path):
+    import cv2
+
+    capture = cv2.VideoCapture(src_path)
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25
+        frame_count = capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0
+        # 第一帧经常是黑屏，取第 1 秒 (或视频 10% 处，取较小者) 的画面
+        target_frame = int(min(fps * VIDEO_KEYFRAME_OFFSET_SECONDS, frame_count * 0.1)) if frame_count else 0
+        capture.set(cv2.CAP_PROP_POS_FRAMES, target_frame)
+        ok, frame = capture.read()
+        if not ok:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = capture.read()
+        if not ok:
+            raise MediaJobError("OpenCV 无法读取视频帧")
+        if not cv2.imwrite(dst_path, frame):
+            raise MediaJobError("OpenCV 写入关键帧失败")
+    finally:
+        capture.release()
+
+
+def extract_keyframe_ffmpeg(src_path, dst_path):
+    ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg:
+        raise MediaJobError("未找到 ffmpeg")
+    for offset in (VIDEO_KEYFRAME_OFFSET_SECONDS, 0):
+        completed = subprocess.run(
+            [ffmpeg, "-y", "-loglevel", "error", "-ss", str(offset), "-i", src_path, "-frames:v", "1", dst_path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if completed.returncode == 0 and os.path.exists(dst_path) and os.path.getsize(dst_path) > 0:
+            return
+    raise MediaJobError(f"ffmpeg 提取关键帧失败: {completed.stderr.decode(errors='replace')[:200]}")
+
+
+VIDEO_KEYFRAME_EXTRACTORS = {
+    "opencv": extract_keyframe_opencv,
+    "ffmpeg": extract_keyframe_ffmpeg,
+}
+
+
+def resolve_video_extractor(name):
+    if name in VIDEO_KEYFRAME_EXTRACTORS:
+        return VIDEO_KEYFRAME_EXTRACTORS[name]
+    module_name, _, function_name = name.partition(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def extract_video_keyframe(src_path, dst_path, extractor_names):
+    errors = []
+    for name in extractor_names:
+        try:
+            resolve_video_extractor(name)(src_path, dst_path)
+            return name
+        except Exception as e:
+            errors.append(f"{name}: {e}")
+    raise MediaJobError("; ".join(errors) or "未配置视频关键帧提取器")
+
+
+# --- 工作进程 ---
+def _init_worker(memory_limit_mb):
+    if resource is not None and memory_limit_mb:
+        limit_bytes = int(memory_limit_mb) * 1024 * 1024
+        try:
+            resource.setrlimit(resource.RLIMIT_AS, (limit_bytes, limit_bytes))
+        except (ValueError, OSError):
+            pass
+
+
+def _on_job_timeout(signum, frame):
+    raise MediaJobTimeout("任务超时")
+
+
+def _run_job(fn, args, timeout):
+    # 在工作进程内用 SIGALRM 实现单个任务的超时，避免卡死的解码拖住整个进程
+    use_alarm = signal is not None and hasattr(signal, "setitimer") and timeout
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _on_job_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return fn(*args)
+    except MemoryError:
+        raise MediaJobError("超出内存上限")
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class MediaWorkerPool:
+    """CPU 密集的媒体处理 (GIF 取帧、缩放重编码、视频关键帧) 在独立进程中执行，不阻塞主线程与下载线程。
+
+    run() 可以被多个线程同时调用；每个任务有超时，每个工作进程有内存上限。
+    """
+
+    def __init__(self, max_workers=None, job_timeout=30, memory_limit_mb=1024):
+        self.job_timeout = job_timeout
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers or os.cpu_count() or 1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker, initargs=(memory_limit_mb,))
+        self._lock = threading.Lock()
+        self.job_count = 0
+        self.failed_count = 0
+        self.job_seconds = 0.0
+
+    def run(self, fn, *args):
+        started = time.perf_counter()
+        future = self._executor.submit(_run_job, fn, args, self.job_timeout)
+        failed = False
+        try:
+            # 主进程侧多等几秒作为兜底，正常情况下超时由工作进程内的 SIGALRM 触发
+            return future.result(timeout=self.job_timeout + 5 if self.job_timeout else None)
+        except FutureTimeoutError:
+            failed = True
+            future.cancel()
+            raise MediaJobTimeout(f"任务超过 {self.job_timeout}s 未完成")
+        except Exception:
+            failed = True
+            raise
+        finally:
+            with self._lock:
+                self.job_count += 1
+                self.failed_count += failed
+                self.job_seconds += time.perf_counter() - started
+
+    def report(self):
+        if self.job_count:
+            print(f"  [媒体进程池] 完成 {self.job_count} 个任务 (失败 {self.failed_count})，累计处理耗时 {self.job_seconds:.2f}s。")
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
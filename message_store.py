@@ -0,0 +1,208 @@
+import json
+import sqlite3
+import threading
+
+
+class MessageStore:
+    """本地 SQLite 消息库：按 (群号, message_seq) 存储原始消息，并按时间建索引。
+
+    coverage 表记录每个群已完整拉取过的连续 seq 区间，
+    这样下次运行只需拉取比 newest_seq 更新的消息，时间窗口直接从索引中查询。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                group_id INTEGER NOT NULL,
+                message_seq INTEGER NOT NULL,
+                message_id INTEGER,
+                time INTEGER NOT NULL,
+                raw TEXT NOT NULL,
+                PRIMARY KEY (group_id, message_seq)
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_group_time ON messages (group_id, time, message_seq);
+            CREATE INDEX IF NOT EXISTS idx_messages_group_message_id ON messages (group_id, message_id);
+            CREATE TABLE IF NOT EXISTS coverage (
+                group_id INTEGER PRIMARY KEY,
+                oldest_seq INTEGER NOT NULL,
+                oldest_time INTEGER NOT NULL,
+                newest_seq INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS summaries (
+                group_id INTEGER NOT NULL,
+                start_time INTEGER NOT NULL,
+                end_time INTEGER NOT NULL,
+                chain_length INTEGER NOT NULL,
+                report TEXT NOT NULL,
+                topics TEXT NOT NULL,
+                image_paths TEXT NOT NULL,
+                PRIMARY KEY (group_id, end_time)
+            );
+            CREATE TABLE IF NOT EXISTS live_ingest (
+                group_id INTEGER PRIMARY KEY,
+                contiguous INTEGER NOT NULL,
+                heartbeat INTEGER NOT NULL
+            );
+        """)
+        self._conn.commit()
+
+    def add_messages(self, group_id, messages):
+        rows = []
+        for msg_obj in messages:
+            seq = msg_obj.get("message_seq")
+            if seq is None:
+                continue
+            rows.append((int(group_id), int(seq), msg_obj.get("message_id"), int(msg_obj.get("time", 0)),
+                         json.dumps(msg_obj, ensure_ascii=False, separators=(",", ":"))))
+        if not rows:
+            return 0
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO messages (group_id, message_seq, message_id, time, raw) VALUES (?, ?, ?, ?, ?)",
+                rows)
+            self._conn.commit()
+        return len(rows)
+
+    def iter_messages_in_range(self, group_id, start_ts, end_ts, limit=None, chunk_size=500):
+        """按 (time, message_seq) 升序逐条返回时间窗口内的消息，有 limit 时只保留最新的 limit 条；
+        分块读取，不一次性把整个窗口读进内存。"""
+        lower = (int(start_ts), -1)
+        if limit:
+            with self._lock:
+                cutoff = self._conn.execute(
+                    "SELECT time, message_seq FROM messages WHERE group_id = ? AND time >= ? AND time <= ? "
+                    "ORDER BY time DESC, message_seq DESC LIMIT 1 OFFSET ?",
+                    (int(group_id), int(start_ts), int(end_ts), int(limit) - 1)).fetchone()
+            if cutoff:
+                lower = (cutoff[0], cutoff[1] - 1)
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT raw, time, message_seq FROM messages WHERE group_id = ? AND time >= ? AND time <= ? "
+                    "AND (time, message_seq) > (?, ?) ORDER BY time, message_seq LIMIT ?",
+                    (int(group_id), int(start_ts), int(end_ts), lower[0], lower[1], chunk_size)).fetchall()
+            for raw, _, _ in rows:
+                yield json.loads(raw)
+            if len(rows) < chunk_size:
+                return
+            lower = (rows[-1][1], rows[-1][2])
+
+    def seq_bracket(self, group_id, ts):
+        """本地 seq->time 索引中 ts 两侧最近的已知点: ((seq, time) 早于 ts, (seq, time) 不早于 ts)，未知为 None。"""
+        with self._lock:
+            before = self._conn.execute(
+                "SELECT message_seq, time FROM messages WHERE group_id = ? AND time < ? "
+                "ORDER BY time DESC, message_seq DESC LIMIT 1", (int(group_id), int(ts))).fetchone()
+            after = self._conn.execute(
+                "SELECT message_seq, time FROM messages WHERE group_id = ? AND time >= ? "
+                "ORDER BY time ASC, message_seq ASC LIMIT 1", (int(group_id), int(ts))).fetchone()
+        return before, after
+
+    def get_message_time(self, group_id, message_seq):
+        with self._lock:
+            row = self._conn.execute("SELECT time FROM messages WHERE group_id = ? AND message_seq = ?",
+                                     (int(group_id), int(message_seq))).fetchone()
+        return row[0] if row else None
+
+    def messages_by_ids(self, group_id, message_ids):
+        """按 message_id 批量查找消息，返回 {message_id: 消息}；不在库中的 id 不出现在结果里。"""
+        ids = [int(m) for m in message_ids if str(m).lstrip("-").isdigit()]
+        found = {}
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT message_id, raw FROM messages WHERE group_id = ? AND message_id IN "
+                    f"({','.join('?' * len(batch))})", [int(group_id)] + batch).fetchall()
+            for message_id, raw in rows:
+                found[str(message_id)] = json.loads(raw)
+        return found
+
+    def get_coverage(self, group_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT oldest_seq, oldest_time, newest_seq FROM coverage WHERE group_id = ?",
+                (int(group_id),)).fetchone()
+        return row
+
+    def set_coverage(self, group_id, oldest_seq, oldest_time, newest_seq):
+        with self._lock:
+            self._write_coverage(group_id, oldest_seq, oldest_time, newest_seq)
+
+    def _write_coverage(self, group_id, oldest_seq, oldest_time, newest_seq):
+        # 调用方需持有 self._lock
+        self._conn.execute(
+            "INSERT OR REPLACE INTO coverage (group_id, oldest_seq, oldest_time, newest_seq) VALUES (?, ?, ?, ?)",
+            (int(group_id), int(oldest_seq), int(oldest_time), int(newest_seq)))
+        self._conn.commit()
+
+    def merge_coverage(self, group_id, oldest_seq, oldest_time, newest_seq):
+        """把一段已连续写入的 [oldest_seq, newest_seq] 并入覆盖范围 (读-改-写在同一把锁内完成)，返回合并后的范围。
+
+        与已有范围重叠或相邻时取并集；不相交时保留较新的一段。拉取历史与实时接收可能同时更新同一个群，
+        各自只提交自己确认过的那一段，不会用过时的读取结果覆盖对方的更新。
+        """
+        with self._lock:
+            current = self._conn.execute(
+                "SELECT oldest_seq, oldest_time, newest_seq FROM coverage WHERE group_id = ?",
+                (int(group_id),)).fetchone()
+            merged = (int(oldest_seq), int(oldest_time), int(newest_seq))
+            if current is not None:
+                if merged[0] <= current[2] + 1 and current[0] <= merged[2] + 1:
+                    low = min(current, merged, key=lambda c: c[0])
+                    merged = (low[0], low[1], max(current[2], merged[2]))
+                elif current[2] > merged[2]:
+                    merged = current
+            if merged != current:
+                self._write_coverage(group_id, *merged)
+            return merged
+
+    def save_summary(self, group_id, start_time, end_time, chain_length, report, topics, image_paths):
+        """保存一次总结的结构化结果；只保留每个群结束时间不早于 start_time 的记录。"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO summaries (group_id, start_time, end_time, chain_length, report, topics, "
+                "image_paths) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (int(group_id), int(start_time), int(end_time), int(chain_length), report,
+                 json.dumps(topics, ensure_ascii=False, separators=(",", ":")),
+                 json.dumps(image_paths, ensure_ascii=False)))
+            self._conn.execute("DELETE FROM summaries WHERE group_id = ? AND end_time < ?",
+                               (int(group_id), int(start_time)))
+            self._conn.commit()
+
+    def latest_summary(self, group_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT start_time, end_time, chain_length, report, topics, image_paths FROM summaries "
+                "WHERE group_id = ? ORDER BY end_time DESC LIMIT 1", (int(group_id),)).fetchone()
+        if not row:
+            return None
+        return {"start_time": row[0], "end_time": row[1], "chain_length": row[2], "report": row[3],
+                "topics": json.loads(row[4]), "image_paths": json.loads(row[5])}
+
+    def set_live_status(self, group_id, contiguous, heartbeat):
+        """实时接收守护进程记录: contiguous 表示 coverage 的 newest_seq 之后没有漏收的消息，heartbeat 为最近确认在线的时间。"""
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO live_ingest (group_id, contiguous, heartbeat) VALUES (?, ?, ?)",
+                               (int(group_id), 1 if contiguous else 0, int(heartbeat)))
+            self._conn.commit()
+
+    def touch_live_groups(self, heartbeat):
+        with self._lock:
+            self._conn.execute("UPDATE live_ingest SET heartbeat = ? WHERE contiguous = 1", (int(heartbeat),))
+            self._conn.commit()
+
+    def get_live_status(self, group_id):
+        with self._lock:
+            row = self._conn.execute("SELECT contiguous, heartbeat FROM live_ingest WHERE group_id = ?",
+                                     (int(group_id),)).fetchone()
+        return (bool(row[0]), row[1]) if row else None
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,110 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class OneBotError(Exception):
+    def __init__(self, action, message, response_text=None):
+        super().__init__(f"{action}: {message}")
+        self.action = action
+        self.response_text = response_text
+
+
+class RateLimiter:
+    """令牌桶限速器，rate 为每秒请求数，burst 为允许的突发请求数。线程安全。"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+class OneBotClient:
+    """共享的 OneBot HTTP 客户端：连接池 + keep-alive，失败时按带抖动的指数退避重试，可选限速。
+
+    可被多个线程同时使用 (requests.Session 的连接池本身是线程安全的)。
+    """
+
+    def __init__(self, base_url, access_token=None, timeout=10, connect_timeout=3, pool_size=10,
+                 max_retries=3, backoff_base=0.5, backoff_max=8.0, rate_limit=None, rate_burst=5, metrics=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = RateLimiter(rate_limit, rate_burst) if rate_limit else None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Content-Type"] = "application/json"
+        if access_token:
+            self.session.headers["Authorization"] = f"Bearer {access_token}"
+        self.metrics = metrics  # 可选的 RunMetrics，记录 HTTP 往返与 JSON 解析耗时、响应字节数
+        self.request_count = 0
+        self.retry_count = 0
+
+    def _backoff_seconds(self, attempt):
+        # full jitter: 在 [0, min(上限, base * 2^attempt)] 之间随机等待，避免多个线程同时重试
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def call(self, action, params=None, idempotent=True):
+        """调用 OneBot action 并返回解析后的 JSON；重试耗尽或遇到不可重试的错误时抛出 OneBotError。
+
+        idempotent=False (如发送消息) 时只在请求确定未被处理的情况下重试 (连接超时、429/503)，避免重复发送。
+        """
+        endpoint = f"{self.base_url}/{action}"
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.retry_count += 1
+                time.sleep(self._backoff_seconds(attempt - 1))
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            self.request_count += 1
+            started = time.perf_counter()
+            try:
+                response = self.session.post(endpoint, json=params or {}, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                last_error = OneBotError(action, f"网络错误: {e}")
+                if idempotent or isinstance(e, requests.ConnectTimeout):
+                    continue
+                raise last_error
+            if response.status_code in RETRYABLE_STATUS_CODES and (idempotent or response.status_code in (429, 503)):
+                last_error = OneBotError(action, f"HTTP {response.status_code}", response.text)
+                continue
+            if response.status_code >= 400:
+                raise OneBotError(action, f"HTTP {response.status_code}", response.text)
+            if self.metrics:
+                self.metrics.observe("onebot_http", time.perf_counter() - started)
+                self.metrics.incr("onebot_response_bytes", len(response.content))
+                started = time.perf_counter()
+            try:
+                return response.json()
+            except ValueError as e:
+                raise OneBotError(action, f"响应不是有效的JSON: {e}", response.text)
+            finally:
+                if self.metrics: self.metrics.observe("onebot_json_parse", time.perf_counter() - started)
+        raise last_error
+
+    def close(self):
+        self.session.close()
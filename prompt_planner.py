@@ -0,0 +1,49 @@
+import re
+
+# 粗略的 token 估算: 中日韩字符约 1 token/字，其余字符约 4 字符/token，每张图片按固定值计
+IMAGE_TOKEN_ESTIMATE = 258
+_CJK_PATTERN = re.compile(r"[⺀-鿿가-힯豈-﫿＀-￯]")
+
+
+def estimate_text_tokens(text):
+    if not text:
+        return 0
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    return cjk_count + (len(text) - cjk_count + 3) // 4
+
+
+def estimate_transcript_tokens(lines, line_image_counts):
+    return (sum(estimate_text_tokens(line) + 1 for line in lines)
+            + sum(line_image_counts) * IMAGE_TOKEN_ESTIMATE)
+
+
+class TranscriptChunk:
+    # 按时间连续的一段记录: lines[start_line:end_line]，对应 image_paths[first_image:first_image + image_count]
+    def __init__(self, start_line, end_line, first_image, image_count, estimated_tokens):
+        self.start_line = start_line
+        self.end_line = end_line
+        self.first_image = first_image
+        self.image_count = image_count
+        self.estimated_tokens = estimated_tokens
+
+
+def plan_chunks(lines, line_image_counts, token_budget):
+    """把记录切成时间连续、估算 token 数不超过 token_budget 的若干段。单行超出预算时独占一段。"""
+    chunks = []
+    start_line = 0
+    first_image = 0
+    chunk_tokens = 0
+    chunk_images = 0
+    for i, (line, image_count) in enumerate(zip(lines, line_image_counts)):
+        line_tokens = estimate_text_tokens(line) + 1 + image_count * IMAGE_TOKEN_ESTIMATE
+        if i > start_line and chunk_tokens + line_tokens > token_budget:
+            chunks.append(TranscriptChunk(start_line, i, first_image, chunk_images, chunk_tokens))
+            start_line = i
+            first_image += chunk_images
+            chunk_tokens = 0
+            chunk_images = 0
+        chunk_tokens += line_tokens
+        chunk_images += image_count
+    if start_line < len(lines):
+        chunks.append(TranscriptChunk(start_line, len(lines), first_image, chunk_images, chunk_tokens))
+    return chunks
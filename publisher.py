@@ -0,0 +1,167 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from onebot_client import OneBotError
+from report_parser import IMAGE_REF_PATTERN
+
+DEFAULT_MAX_QUOTES_PER_MESSAGE = 60  # 每条合并转发中引用的聊天记录条数上限，超出的主题拆成多条发送
+DEFAULT_MAX_MESSAGE_BYTES = 3 * 1024 ** 2  # 每条合并转发的估算大小上限 (JSON 长度 + 附带图片的文件大小)
+FALLBACK_NODE_USER_ID = 10000
+
+
+def quote_content_segments(quote, image_resolver=None):
+    # 把引用的发言转换成消息段；《图片N》能找到本地文件时替换为图片，否则保留文字
+    segments = [{"type": "text", "data": {"text": f"[{quote.time}] "}}]
+    text = quote.text
+    position = 0
+    for match in IMAGE_REF_PATTERN.finditer(text):
+        path = image_resolver(int(match.group(1))) if image_resolver else None
+        if not path or not os.path.exists(path):
+            continue
+        if match.start() > position:
+            segments.append({"type": "text", "data": {"text": text[position:match.start()]}})
+        segments.append({"type": "image", "data": {"file": "file:///" + os.path.abspath(path).lstrip("/")}})
+        position = match.end()
+    if position < len(text):
+        segments.append({"type": "text", "data": {"text": text[position:]}})
+    return segments
+
+
+def estimate_node_bytes(node):
+    size = len(json.dumps(node, ensure_ascii=False).encode("utf-8"))
+    for segment in node["data"]["content"]:
+        if segment["type"] == "image":
+            try:
+                size += os.path.getsize(segment["data"]["file"][len("file://"):])
+            except OSError:
+                pass
+    return size
+
+
+class SummaryPublisher:
+    """把报告按主题发回群里: 每个主题一条合并转发 (总结 + 嵌套的原始聊天记录)，过大的主题拆成多条。
+
+    publish_topic()/publish_overview() 可直接作为 StreamingTopicParser 的 on_topic/on_overview，报告还在生成时，
+    已完成的部分就开始发送；概述 (带标题) 作为第一条合并转发。
+    每个目标群一个发送线程以保证主题顺序，多个群之间并发发送，共用同一个限速器。
+    """
+
+    def __init__(self, client, group_ids, rate_limiter=None, node_user_id=None, node_nickname="群聊总结",
+                 image_resolver=None, max_quotes=DEFAULT_MAX_QUOTES_PER_MESSAGE, max_bytes=DEFAULT_MAX_MESSAGE_BYTES,
+                 title=None):
+        self.client = client
+        self.group_ids = [int(g) for g in group_ids]
+        self.rate_limiter = rate_limiter
+        self.node_user_id = node_user_id
+        self.node_nickname = node_nickname
+        self.image_resolver = image_resolver
+        self.max_quotes = max(1, max_quotes)
+        self.max_bytes = max_bytes
+        self.title = title
+        self._executors = {g: ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"pub{g}") for g in self.group_ids}
+        self._futures = []
+        self._lock = threading.Lock()
+        self._topic_count = 0
+        self._overview_sent = False
+        self._started = time.perf_counter()
+        self._first_sent_at = None
+        self.sent_count = 0
+        self.failed_count = 0
+
+    def _bot_user_id(self):
+        if self.node_user_id is None:
+            try:
+                self.node_user_id = int(self.client.call("get_login_info")["data"]["user_id"])
+            except (OneBotError, KeyError, TypeError, ValueError) as e:
+                print(f"  [发布] 获取机器人QQ号失败，转发节点使用默认QQ号: {e}")
+                self.node_user_id = FALLBACK_NODE_USER_ID
+        return self.node_user_id
+
+    def _node(self, nickname, user_id, content):
+        return {"type": "node", "data": {"user_id": user_id, "nickname": nickname, "content": content}}
+
+    def _text_node(self, text):
+        return self._node(self.node_nickname, self._bot_user_id(), [{"type": "text", "data": {"text": text}}])
+
+    def _quote_node(self, quote):
+        user_id = int(quote.user_id) if quote.user_id.isdigit() else self._bot_user_id()
+        return self._node(quote.name or str(user_id), user_id, quote_content_segments(quote, self.image_resolver))
+
+    def build_topic_messages(self, topic_number, topic):
+        """返回该主题要发送的若干条合并转发 (每条为节点列表)，按条数与估算大小拆分。"""
+        parts = [[]]
+        part_bytes = 0
+        for quote in topic.quotes:
+            node = self._quote_node(quote)
+            node_bytes = estimate_node_bytes(node)
+            if parts[-1] and (len(parts[-1]) >= self.max_quotes or part_bytes + node_bytes > self.max_bytes):
+                parts.append([])
+                part_bytes = 0
+            parts[-1].append(node)
+            part_bytes += node_bytes
+        messages = []
+        for i, quote_nodes in enumerate(parts, 1):
+            heading = f"话题{topic_number}" + (f" ({i}/{len(parts)})" if len(parts) > 1 else "")
+            if self.title and topic_number == 1 and i == 1 and not self._overview_sent:
+                heading = f"{self.title}\n\n{heading}"
+            messages.append([self._text_node(f"{heading}\n{topic.summary}"),
+                             self._node("聊天记录", self._bot_user_id(), quote_nodes)])
+        return messages
+
+    def _send(self, group_id, nodes, label):
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+        try:
+            response = self.client.call("send_group_forward_msg", {"group_id": group_id, "messages": nodes},
+                                        idempotent=False)
+            if response.get("retcode", 0) != 0:
+                raise OneBotError("send_group_forward_msg", response.get("msg") or response.get("wording"),
+                                  json.dumps(response, ensure_ascii=False))
+        except OneBotError as e:
+            with self._lock:
+                self.failed_count += 1
+            print(f"  [发布] 群 {group_id} 的{label}发送失败: {e}")
+            return False
+        with self._lock:
+            self.sent_count += 1
+            if self._first_sent_at is None:
+                self._first_sent_at = time.perf_counter()
+        return True
+
+    def publish_overview(self, overview):
+        text = f"{self.title}\n\n主要讨论方向概述\n{overview}" if self.title else f"主要讨论方向概述\n{overview}"
+        with self._lock:
+            self._overview_sent = True
+        for group_id, executor in self._executors.items():
+            self._futures.append(executor.submit(self._send, group_id, [self._text_node(text)], "概述"))
+
+    def publish_topic(self, topic):
+        with self._lock:
+            self._topic_count += 1
+            topic_number = self._topic_count
+        messages = self.build_topic_messages(topic_number, topic)
+        for group_id, executor in self._executors.items():
+            for i, nodes in enumerate(messages, 1):
+                label = f"话题{topic_number}" + (f" 第{i}部分" if len(messages) > 1 else "")
+                self._futures.append(executor.submit(self._send, group_id, nodes, label))
+
+    def close(self, final_text=None):
+        """等待所有发送完成。没有解析出任何主题时，把完整回复作为一条纯文本合并转发发送。"""
+        if final_text and not self._topic_count:
+            for group_id, executor in self._executors.items():
+                self._futures.append(executor.submit(self._send, group_id, [self._text_node(final_text)], "报告"))
+        for future in self._futures:
+            future.result()
+        for executor in self._executors.values():
+            executor.shutdown()
+        self.report()
+        return self.failed_count == 0
+
+    def report(self):
+        first_sent = (f"，首条在开始后 {self._first_sent_at - self._started:.1f}s 发出"
+                      if self._first_sent_at is not None else "")
+        print(f"  [发布] {len(self.group_ids)} 个群，{self._topic_count} 个主题，成功发送 {self.sent_count} 条合并转发，"
+              f"失败 {self.failed_count} 条{first_sent}。")
@@ -0,0 +1,89 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ReplyContextResolver:
+    """按 message_id 解析被回复消息的上下文 (发送者, 摘录)。
+
+    依次查找: 本次窗口内的消息 (调用方传入) -> LRU 缓存 -> 本地消息库 (一次批量查询) -> get_msg (有界并发)。
+    确认不存在的消息也会缓存，同一条消息不会被反复请求；请求出错的不缓存，下次运行再试。
+    """
+
+    def __init__(self, store_lookup, remote_fetch, max_workers=4, cache_size=4096):
+        self._store_lookup = store_lookup  # (group_id, [message_id]) -> {message_id: context}
+        self._remote_fetch = remote_fetch  # (group_id, message_id) -> context 或 None (不存在)，出错时抛异常
+        self._max_workers = max(1, max_workers)
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"local": 0, "cache": 0, "store": 0, "remote": 0, "missing": 0}
+
+    def _cache_get(self, key):
+        with self._lock:
+            if key not in self._cache:
+                return False, None
+            self._cache.move_to_end(key)
+            return True, self._cache[key]
+
+    def _cache_put(self, key, context):
+        with self._lock:
+            self._cache[key] = context
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def _count(self, source, n=1):
+        with self._lock:
+            self.stats[source] += n
+
+    def resolve(self, group_id, message_ids, local=None):
+        """返回 {message_id: context}；找不到的 id 不在结果中。local 为窗口内已知的 {message_id: context}。"""
+        local = local or {}
+        results = {}
+        pending = []
+        for message_id in dict.fromkeys(message_ids):
+            if message_id in local:
+                results[message_id] = local[message_id]
+                self._count("local")
+                continue
+            cached, context = self._cache_get((group_id, message_id))
+            if cached:
+                if context is not None: results[message_id] = context
+                self._count("cache")
+            else:
+                pending.append(message_id)
+
+        if pending and self._store_lookup:
+            found = self._store_lookup(group_id, pending)
+            for message_id, context in found.items():
+                results[message_id] = context
+                self._cache_put((group_id, message_id), context)
+            self._count("store", len(found))
+            pending = [message_id for message_id in pending if message_id not in found]
+
+        if pending and self._remote_fetch:
+            def fetch(message_id):
+                try:
+                    return message_id, True, self._remote_fetch(group_id, message_id)
+                except Exception as e:
+                    print(f"    [回复] 获取消息 {message_id} 失败: {e}")
+                    return message_id, False, None
+
+            with ThreadPoolExecutor(max_workers=min(self._max_workers, len(pending)),
+                                    thread_name_prefix="reply") as executor:
+                for message_id, ok, context in executor.map(fetch, pending):
+                    if ok: self._cache_put((group_id, message_id), context)
+                    if context is not None:
+                        results[message_id] = context
+                        self._count("remote")
+                    else:
+                        self._count("missing")
+        return results
+
+    def report(self):
+        s = dict(self.stats)
+        if not sum(s.values()):
+            return
+        print(f"  [回复] 被回复消息: 窗口内 {s['local']} 条，缓存 {s['cache']} 条，消息库 {s['store']} 条，"
+              f"get_msg {s['remote']} 条，未找到 {s['missing']} 条。")
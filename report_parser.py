@@ -0,0 +1,156 @@
+import datetime
+import json
+import re
+
+# 报告中每个主题是 "总结文字" 后跟一个 {<<时间,用户名,用户id,发言>> ...} 块
+_QUOTE_BLOCK_PATTERN = re.compile(r"\{\s*(<<.*?>>)\s*\}", re.S)
+_QUOTE_LINE_PATTERN = re.compile(r"<<(\d{1,2}:\d{2}:\d{2}),(.*?),(\d*),(.*?)>>", re.S)
+IMAGE_REF_PATTERN = re.compile(r"《图片(\d+)》")
+# 报告的两个章节标题: "1. **主要讨论方向概述**：" 与 "2. **详细主题分析**："
+_SECTION_HEADING_PATTERN = re.compile(r"^[ \t]*(?:\d+\.)?[ \t]*\**(?:主要讨论方向概述|详细主题分析)\**[ \t]*[：:]?[ \t]*", re.M)
+_DETAIL_HEADING_PATTERN = re.compile(r"^[^\n{]*详细主题分析[^\n]*\n", re.M)
+
+
+class QuotedMessage:
+    # 主题中引用的一条原始发言；ts 为 resolve_quote_times 推算出的完整时间戳
+    __slots__ = ("time", "name", "user_id", "text", "ts")
+
+    def __init__(self, time, name, user_id, text, ts=None):
+        self.time = time
+        self.name = name
+        self.user_id = user_id
+        self.text = text
+        self.ts = ts
+
+    @property
+    def raw(self):
+        return f"<<{self.time},{self.name},{self.user_id},{self.text}>>"
+
+    @property
+    def image_numbers(self):
+        return [int(n) for n in IMAGE_REF_PATTERN.findall(self.text)]
+
+
+class Topic:
+    __slots__ = ("summary", "quotes")
+
+    def __init__(self, summary, quotes):
+        self.summary = summary
+        self.quotes = quotes
+
+    @property
+    def image_numbers(self):
+        # 总结与引用中出现的《图片N》编号，按首次出现的顺序去重
+        numbers = [int(n) for n in IMAGE_REF_PATTERN.findall(self.summary)]
+        for quote in self.quotes:
+            numbers.extend(quote.image_numbers)
+        return list(dict.fromkeys(numbers))
+
+    def to_record(self):
+        # 紧凑的持久化格式: [总结, [[时间, 用户名, 用户id, 发言, 时间戳], ...]]
+        return [self.summary, [[q.time, q.name, q.user_id, q.text, q.ts] for q in self.quotes]]
+
+    @classmethod
+    def from_record(cls, record):
+        summary, quotes = record
+        return cls(summary, [QuotedMessage(*quote) for quote in quotes])
+
+
+def _paragraph(text):
+    # 去掉章节标题后的所有非空行
+    lines = (line.strip() for line in _SECTION_HEADING_PATTERN.sub("", text).splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def _topic_from_block(preceding_text, block_text):
+    # 总结取上一个块 (或 "详细主题分析" 标题) 之后、本块之前的整段文字
+    quotes = [QuotedMessage(*m.groups()) for m in _QUOTE_LINE_PATTERN.finditer(block_text)]
+    if not quotes:
+        return None
+    return Topic(_paragraph(preceding_text), quotes)
+
+
+class StreamingTopicParser:
+    """边接收流式回复边解析: feed() 返回本次新完成的主题 (遇到块的右括号即视为完成)，结果与 parse_report_topics 一致。
+
+    on_topic 在每个主题完成时被调用，feed 可直接作为 send_to_gemini 的 on_chunk。
+    "详细主题分析" 标题出现时，之前的 "主要讨论方向概述" 作为 overview 交给 on_overview (先于第一个主题)；
+    回复中没有该标题时 overview 为空字符串，概述并入第一个主题的总结。
+    """
+
+    def __init__(self, on_topic=None, on_overview=None):
+        self.on_topic = on_topic
+        self.on_overview = on_overview
+        self._buffer = ""
+        self._previous_end = 0
+        self.overview = None
+        self.topics = []
+
+    def _find_overview(self):
+        heading = _DETAIL_HEADING_PATTERN.search(self._buffer)
+        first_block = _QUOTE_BLOCK_PATTERN.search(self._buffer)
+        if heading and (first_block is None or heading.start() < first_block.start()):
+            self.overview = _paragraph(self._buffer[:heading.start()])
+            self._previous_end = heading.end()
+            if self.overview and self.on_overview: self.on_overview(self.overview)
+        elif first_block:
+            self.overview = ""
+
+    def feed(self, text):
+        self._buffer += text or ""
+        if self.overview is None: self._find_overview()
+        completed = []
+        for block in _QUOTE_BLOCK_PATTERN.finditer(self._buffer, self._previous_end):
+            topic = _topic_from_block(self._buffer[self._previous_end:block.start()], block.group(1))
+            self._previous_end = block.end()
+            if topic:
+                completed.append(topic)
+                self.topics.append(topic)
+                if self.on_topic: self.on_topic(topic)
+        return completed
+
+    @property
+    def text(self):
+        return self._buffer
+
+
+def parse_report_topics(report_text):
+    """把报告拆成 Topic 列表；无法识别格式的部分被忽略。"""
+    return StreamingTopicParser().feed(report_text)
+
+
+def resolve_quote_times(topics, end_ts):
+    # 报告里只有 时:分:秒，取不晚于 end_ts 的最近一次该时刻作为消息时间
+    end_dt = datetime.datetime.fromtimestamp(end_ts)
+    for topic in topics:
+        for quote in topic.quotes:
+            hours, minutes, seconds = (int(x) for x in quote.time.split(":"))
+            candidate = end_dt.replace(hour=hours % 24, minute=minutes, second=seconds, microsecond=0)
+            if candidate > end_dt:
+                candidate -= datetime.timedelta(days=1)
+            quote.ts = int(candidate.timestamp())
+    return topics
+
+
+def render_topics(topics):
+    return "\n\n".join(f"{topic.summary}\n{{" + "\n".join(q.raw for q in topic.quotes) + "}" for topic in topics)
+
+
+class TopicFileWriter:
+    """把主题逐个追加写入 JSON lines 文件 (每行一个 Topic.to_record())，每写一个立即 flush，读取方不必等整份报告生成完。"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+
+    def write(self, topic):
+        self._file.write(json.dumps(topic.to_record(), ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def load_topics_file(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [Topic.from_record(json.loads(line)) for line in f if line.strip()]
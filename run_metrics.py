@@ -0,0 +1,109 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+USAGE_FIELDS = ("prompt_token_count", "candidates_token_count", "cached_content_token_count",
+                "thoughts_token_count", "total_token_count")
+
+
+def peak_rss_mb(children=False):
+    """进程的峰值常驻内存 (MB)；children=True 时为已退出子进程 (如媒体处理进程) 中的最大值。不支持的平台返回 None。"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # Linux 上 ru_maxrss 单位为 KB，macOS 上为字节
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+class RunMetrics:
+    """一次运行的分阶段耗时、计数与字节数。线程安全，可被下载线程、分块总结线程同时写入。
+
+    阶段耗时按名称累计 (次数/总耗时/最大耗时)，计数器只增不减；结束时写成 JSON lines 或 Prometheus textfile。
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            stats = self._stages.setdefault(stage, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    @contextmanager
+    def stage(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def incr(self, counter, value=1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def record_usage(self, usage_metadata):
+        for field in USAGE_FIELDS:
+            value = getattr(usage_metadata, field, None)
+            if value:
+                self.incr(f"gemini_{field}", value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "started_at": self.started_at,
+                "wall_seconds": time.time() - self.started_at,
+                "stages": {name: dict(stats) for name, stats in self._stages.items()},
+                "counters": dict(self._counters),
+                "peak_rss_mb": peak_rss_mb(),
+            }
+
+    def write_jsonl(self, path, **labels):
+        record = dict(labels, **self.snapshot())
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def write_prometheus(self, path, prefix="qq_summary"):
+        # node_exporter textfile collector 格式；先写临时文件再替换，避免采集到写了一半的文件
+        snapshot = self.snapshot()
+        lines = [f"# TYPE {prefix}_stage_seconds_total counter",
+                 f"# TYPE {prefix}_stage_count_total counter",
+                 f"# TYPE {prefix}_stage_max_seconds gauge"]
+        for name, stats in sorted(snapshot["stages"].items()):
+            lines.append(f'{prefix}_stage_seconds_total{{stage="{name}"}} {stats["seconds"]:.6f}')
+            lines.append(f'{prefix}_stage_count_total{{stage="{name}"}} {stats["count"]}')
+            lines.append(f'{prefix}_stage_max_seconds{{stage="{name}"}} {stats["max_seconds"]:.6f}')
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        if snapshot["peak_rss_mb"] is not None:
+            lines.append(f"# TYPE {prefix}_peak_rss_bytes gauge")
+            lines.append(f"{prefix}_peak_rss_bytes {int(snapshot['peak_rss_mb'] * 1024 * 1024)}")
+        lines.append(f"# TYPE {prefix}_run_wall_seconds gauge")
+        lines.append(f"{prefix}_run_wall_seconds {snapshot['wall_seconds']:.3f}")
+        lines.append(f"# TYPE {prefix}_last_run_timestamp_seconds gauge")
+        lines.append(f"{prefix}_last_run_timestamp_seconds {int(time.time())}")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+    def report(self):
+        snapshot = self.snapshot()
+        if snapshot["peak_rss_mb"] is not None:
+            print(f"  [运行指标] 峰值内存 (RSS) {snapshot['peak_rss_mb']:.1f} MB。")
+        print("  [运行指标] 各阶段耗时:")
+        for name, stats in sorted(snapshot["stages"].items(), key=lambda item: -item[1]["seconds"]):
+            print(f"    {name:<24} {stats['count']:>6} 次  合计 {stats['seconds']:>8.2f}s  最长 {stats['max_seconds']:>7.2f}s")
@@ -0,0 +1,138 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import gemini_test
+from image_pool import ImageDownloadPool
+
+# --- 用户配置 ---
+# 每个群可以单独设置统计的小时数和最大消息数，未设置的项使用 gemini_test 中的默认值；
+# publish_to 为报告发回的群号列表 (通常就是该群本身)，不设置则只打印
+SUMMARY_GROUPS = [
+    {"group_id": 1021625002, "fetch_hours": 24, "max_messages": 1500, "publish_to": []},
+]
+ONEBOT_MAX_CONCURRENCY = 2  # 同时向本地 OneBot 拉取历史消息的群数
+GEMINI_MAX_CONCURRENCY = 2  # 同时调用 Gemini API 的群数
+MAX_ACTIVE_GROUPS = 8  # 同时处于流水线中的群数 (拉取/图片处理/生成 各阶段合计)
+
+
+# --- 用户配置结束 ---
+
+
+class GroupRunResult:
+    def __init__(self, group_id):
+        self.group_id = group_id
+        self.status = "pending"
+        self.message_count = 0
+        self.image_count = 0
+        self.fetch_seconds = 0.0
+        self.prepare_seconds = 0.0
+        self.gemini_wait_seconds = 0.0
+        self.gemini_seconds = 0.0
+        self.total_seconds = 0.0
+        self.reply_text = None
+        self.topics = []
+
+
+def run_group_job(job, onebot_semaphore, gemini_semaphore, image_pool, output_lock):
+    group_id = job["group_id"]
+    fetch_hours = job.get("fetch_hours", gemini_test.FETCH_HOURS_AGO)
+    result = GroupRunResult(group_id)
+    job_started = time.perf_counter()
+    try:
+        # 阶段1: 拉取历史消息，受本地 OneBot 并发上限约束；图片在拉取的同时就开始下载
+        previous_summary = gemini_test.load_previous_summary(group_id, fetch_hours)
+        with onebot_semaphore:
+            stage_started = time.perf_counter()
+            prepared_window = gemini_test.fetch_window_messages(group_id, fetch_hours, job.get("max_messages"),
+                                                                image_pool,
+                                                                previous_summary.end_ts if previous_summary else None)
+            result.fetch_seconds = time.perf_counter() - stage_started
+        result.message_count = len(prepared_window)
+        if not result.message_count and previous_summary is None:
+            result.status = "no messages"
+            return result
+
+        # 阶段2: 等待图片下载/处理并组装提示词，不占用 OneBot 与 Gemini 的名额
+        stage_started = time.perf_counter()
+        transcript = gemini_test.prepare_gemini_transcript(group_id, prepared_window, fetch_hours, image_pool,
+                                                           previous_summary)
+        result.prepare_seconds = time.perf_counter() - stage_started
+        result.image_count = len(transcript.image_paths)
+        del prepared_window
+
+        # 阶段3: 调用 Gemini，受 Gemini 并发上限约束；需要发布时边生成边发送已完成的主题
+        publisher = gemini_test.create_publisher(transcript, job["publish_to"]) if job.get("publish_to") else None
+        wait_started = time.perf_counter()
+        with gemini_semaphore:
+            stage_started = time.perf_counter()
+            result.gemini_wait_seconds = stage_started - wait_started
+            result.reply_text, result.topics = gemini_test.summarize_transcript_topics(
+                transcript, echo=False, on_topic=publisher.publish_topic if publisher else None,
+                on_overview=publisher.publish_overview if publisher else None)
+            result.gemini_seconds = time.perf_counter() - stage_started
+        if publisher and not publisher.close(result.reply_text):
+            result.status = "publish failed"
+        gemini_test.save_summary_for_incremental(transcript, result.reply_text, result.topics)
+        if result.status == "pending":
+            result.status = "ok" if result.reply_text is not None else "gemini failed"
+        with output_lock:
+            print(f"\n===== 群 {group_id} 的 Gemini 回复 =====")
+            print(result.reply_text if result.reply_text is not None else "(无回复)")
+            print(f"===== 群 {group_id} 回复结束 =====")
+    except Exception as e:
+        result.status = f"error: {e}"
+        print(f"[错误] 群 {group_id} 处理失败: {e}")
+    finally:
+        result.total_seconds = time.perf_counter() - job_started
+    return result
+
+
+def print_run_summary(results, wall_seconds):
+    print("\n===== 多群汇总 =====")
+    print(f"{'群号':>12} {'状态':<14} {'消息':>6} {'图片':>5} {'拉取s':>7} {'图片s':>7} {'排队s':>7} {'生成s':>7} {'合计s':>7}")
+    for r in results:
+        print(f"{r.group_id:>12} {r.status[:14]:<14} {r.message_count:>6} {r.image_count:>5} {r.fetch_seconds:>7.1f} "
+              f"{r.prepare_seconds:>7.1f} {r.gemini_wait_seconds:>7.1f} {r.gemini_seconds:>7.1f} {r.total_seconds:>7.1f}")
+    serial_seconds = sum(r.total_seconds for r in results)
+    print(f"总耗时 {wall_seconds:.1f}s (各群耗时之和 {serial_seconds:.1f}s)。")
+
+
+def run_groups(jobs):
+    onebot_semaphore = threading.BoundedSemaphore(max(1, ONEBOT_MAX_CONCURRENCY))
+    gemini_semaphore = threading.BoundedSemaphore(max(1, GEMINI_MAX_CONCURRENCY))
+    output_lock = threading.Lock()
+    started = time.perf_counter()
+    # 所有群共用一个图片线程池，总并发仍受 IMAGE_DOWNLOAD_MAX_WORKERS 限制
+    with ImageDownloadPool(gemini_test.download_and_process_image_for_gemini, gemini_test.IMAGE_DOWNLOAD_MAX_WORKERS,
+                           gemini_test.IMAGE_DOWNLOAD_PER_HOST_LIMIT) as image_pool, \
+            ThreadPoolExecutor(max_workers=max(1, min(MAX_ACTIVE_GROUPS, len(jobs))),
+                               thread_name_prefix="group") as executor:
+        futures = [executor.submit(run_group_job, job, onebot_semaphore, gemini_semaphore, image_pool, output_lock)
+                   for job in jobs]
+        results = [f.result() for f in futures]
+        image_pool.report()
+    gemini_test.get_image_cache().report()
+    gemini_test.report_upload_caches()
+    if gemini_test._gemini_pool is not None: gemini_test._gemini_pool.report()
+    print_run_summary(results, time.perf_counter() - started)
+    gemini_test.write_run_metrics(group_ids=[r.group_id for r in results])
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+    from app_config import ConfigError, load_config
+    try:
+        # 配置文件中 [scheduler] 表以及 SUMMARY_GROUPS 等本模块的配置写入这里，其余写入 gemini_test
+        load_config([sys.modules[__name__], gemini_test])
+    except ConfigError as e:
+        print(f"错误: {e}")
+        exit(2)
+    if not gemini_test.load_genai():
+        print("错误: google-generativeai 库导入失败。请确保已正确安装。脚本无法继续。")
+        exit(1)
+    if not SUMMARY_GROUPS:
+        print("请在 SUMMARY_GROUPS 中配置至少一个群。")
+        exit(1)
+    run_groups(SUMMARY_GROUPS)
@@ -1,29 +1,32 @@
-import requests
 import json
-import time
+
+from onebot_client import OneBotClient
 
 ONEBOT_API_URL = "http://127.0.0.1:3000"  # Your API URL
 TARGET_GROUP_ID = "796119994"  # Your Target Group ID
 ACCESS_TOKEN = None  # Your Access Token, if any
+REQUEST_TIMEOUT = 30  # Forward messages can take a while to be accepted
 
+_onebot_client = None
 
-def send_onebot_request(action: str, params: dict):
-    endpoint = f"{ONEBOT_API_URL}/{action}"
-    headers = {"Content-Type": "application/json"}
-    if ACCESS_TOKEN:
-        headers["Authorization"] = f"Bearer {ACCESS_TOKEN}"
 
+def get_onebot_client():
+    global _onebot_client
+    if _onebot_client is None:
+        _onebot_client = OneBotClient(ONEBOT_API_URL, ACCESS_TOKEN, timeout=REQUEST_TIMEOUT)
+    return _onebot_client
+
+
+def send_onebot_request(action: str, params: dict):
     print(f"Sending action '{action}' with payload: {json.dumps(params, indent=2, ensure_ascii=False)}")
     try:
-        response = requests.post(endpoint, headers=headers, json=params)
-        response.raise_for_status()
-        response_json = response.json()
+        response_json = get_onebot_client().call(action, params, idempotent=False)
         print(f"Success: {json.dumps(response_json, indent=2, ensure_ascii=False)}")
         return response_json
     except Exception as e:
         print(f"Error sending action '{action}': {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            print(f"Error details: {e.response.text}")
+        if getattr(e, 'response_text', None):
+            print(f"Error details: {e.response_text}")
         return None
 
 
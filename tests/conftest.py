@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gemini_test  # noqa: E402
+from run_metrics import RunMetrics  # noqa: E402
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    """让 gemini_test 的共享资源与配置只作用于本测试: 文件写到 tmp_path，测试结束后恢复原值。"""
+    assert gemini_test.load_genai()
+    monkeypatch.chdir(tmp_path)
+    for name, value in {
+        "GEMINI_API_KEY_VALUE": "primary-key",
+        "GEMINI_API_KEYS": [],
+        "GEMINI_FALLBACK_MODELS": [],
+        "GEMINI_MAX_QUEUE_SECONDS": 5,
+        "USE_UPLOAD_CACHE": True,
+        "USE_PROMPT_CONTEXT_CACHE": False,
+        "UPLOAD_CACHE_INDEX_PATH": str(tmp_path / "upload_cache.json"),
+        "IMAGE_DOWNLOAD_DIR": str(tmp_path / "images"),
+        "MESSAGE_STORE_PATH": str(tmp_path / "messages.sqlite3"),
+        "USE_MEDIA_PROCESS_POOL": False,
+        "METRICS_JSONL_PATH": None,
+        "REPORT_TOPICS_DIR": None,
+        "_gemini_client": None,
+        "_gemini_pool": None,
+        "_upload_cache": None,
+        "_key_upload_caches": {},
+        "_image_cache": None,
+        "_message_store": None,
+        "_onebot_client": None,
+        "run_metrics": RunMetrics(),
+    }.items():
+        monkeypatch.setattr(gemini_test, name, value)
+    yield gemini_test
+    if gemini_test._message_store is not None:
+        gemini_test._message_store.close()
+
+
+def write_images(directory, count, size=64 * 1024):
+    # 内容互不相同、大于 UPLOAD_MIN_BYTES 的图片文件，发送时会走上传缓存
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"image{i}.png")
+        with open(path, "wb") as f:
+            f.write(bytes([i]) * size)
+        paths.append(path)
+    return paths
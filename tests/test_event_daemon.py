@@ -0,0 +1,106 @@
+import time
+
+import pytest
+
+import event_daemon
+from fake_services import FakeOneBotServer
+from image_cache import ImageCache
+from message_store import MessageStore
+
+GROUP_ID = 10000
+
+
+@pytest.fixture
+def server():
+    fake = FakeOneBotServer(40, span_hours=1, image_ratio=0.5, seed=7, group_id=GROUP_ID)
+    fake.start()
+    yield fake
+    fake.stop()
+
+
+def as_event(msg_obj, **changes):
+    return dict(msg_obj, post_type="message", message_type="group", group_id=GROUP_ID, **changes)
+
+
+def test_ingest_persists_messages_coverage_and_image_cache(pipeline, server, monkeypatch):
+    monkeypatch.setattr(pipeline, "LLONEBOT_API_URL", server.base_url)
+    store = pipeline.get_message_store()
+    history, live = server.messages[:20], server.messages[20:]
+    store.add_messages(GROUP_ID, history)
+    store.set_coverage(GROUP_ID, 1, history[0]["time"], 20)
+    store.set_live_status(GROUP_ID, True, time.time())
+
+    daemon = event_daemon.EventIngestDaemon(store, [GROUP_ID])
+    daemon._process_batch([as_event(m) for m in live])
+    daemon.stop()
+
+    assert daemon.stored_count == len(live)
+    assert store.get_coverage(GROUP_ID) == (1, history[0]["time"], 40)
+    assert store.get_live_status(GROUP_ID)[0]
+    assert not daemon._resync_pending
+    # 预下载的图片在 stop() 时写入索引，新进程 (总结任务) 能直接命中；守护进程不固定访问过的图片
+    image_files = {segment["data"]["file"] for m in live for segment in m["message"] if segment["type"] == "image"}
+    assert image_files and server.image_calls == len(image_files)
+    reloaded = ImageCache(pipeline.IMAGE_DOWNLOAD_DIR, pipeline.IMAGE_CACHE_MAX_BYTES)
+    assert len(reloaded._keys) == len(image_files)
+    assert not pipeline.get_image_cache()._pinned
+
+
+def test_events_without_seq_are_skipped_without_resync(pipeline):
+    store = pipeline.get_message_store()
+    store.set_coverage(GROUP_ID, 1, 0, 5)
+    store.set_live_status(GROUP_ID, True, time.time())
+    daemon = event_daemon.EventIngestDaemon(store, [GROUP_ID], prefetch_images=False)
+    events = [as_event({"message_id": 1, "message_seq": None, "time": int(time.time()), "user_id": 1,
+                        "sender": {}, "message": "没有 seq"}),
+              as_event({"message_id": 2, "message_seq": 6, "time": int(time.time()), "user_id": 1,
+                        "sender": {}, "message": "有 seq"})]
+    daemon._process_batch(events)
+    daemon._process_batch(events[:1])
+    assert not daemon._resync_pending
+    assert store.get_coverage(GROUP_ID) == (1, 0, 6)
+
+
+def test_seq_gap_requests_resync(pipeline):
+    store = pipeline.get_message_store()
+    store.set_coverage(GROUP_ID, 1, 0, 5)
+    store.set_live_status(GROUP_ID, True, time.time())
+    daemon = event_daemon.EventIngestDaemon(store, [GROUP_ID], prefetch_images=False)
+    daemon._process_batch([as_event({"message_id": 9, "message_seq": 9, "time": int(time.time()), "user_id": 1,
+                                     "sender": {}, "message": "跳过了 6-8"})])
+    assert daemon._resync_pending == {GROUP_ID}
+    assert not store.get_live_status(GROUP_ID)[0]
+    assert store.get_coverage(GROUP_ID) == (1, 0, 5)
+
+
+def test_merge_coverage_keeps_concurrent_updates(tmp_path):
+    store = MessageStore(str(tmp_path / "m.sqlite3"))
+    assert store.merge_coverage(1, 10, 100, 20) == (10, 100, 20)
+    # 实时接收延伸了较新的一端，补齐线程随后提交基于旧读取结果的较早一段: 两者合并而不是互相覆盖
+    assert store.merge_coverage(1, 10, 100, 30) == (10, 100, 30)
+    assert store.merge_coverage(1, 5, 50, 20) == (5, 50, 30)
+    # 不相交时保留较新的一段
+    assert store.merge_coverage(1, 40, 400, 50) == (40, 400, 50)
+    assert store.merge_coverage(1, 1, 10, 2) == (40, 400, 50)
+    assert store.get_coverage(1) == (40, 400, 50)
+    store.close()
+
+
+def test_image_cache_save_merges_other_process_entries(tmp_path):
+    root = str(tmp_path / "images")
+    daemon_cache, summarizer_cache = ImageCache(root, 10 ** 9), ImageCache(root, 10 ** 9)
+    daemon_cache.fetch("a", ".png", lambda f: f.write(b"aaa"))
+    summarizer_cache.fetch("b", ".png", lambda f: f.write(b"bbbb"))
+    doomed, _ = summarizer_cache.fetch("c", ".png", lambda f: f.write(b"ccccc"))
+    daemon_cache.save()
+    summarizer_cache.save()
+    assert sorted(ImageCache(root, 10 ** 9)._keys) == ["a", "b", "c"]
+
+    # 一方淘汰的对象不会被另一方保存时写回
+    summarizer_cache.invalidate(doomed)
+    summarizer_cache.save()
+    daemon_cache.set_meta(daemon_cache.lookup("a")[0], "seen", True)
+    daemon_cache.save()
+    reloaded = ImageCache(root, 10 ** 9)
+    assert sorted(reloaded._keys) == ["a", "b"]
+    assert reloaded.total_bytes() == 7
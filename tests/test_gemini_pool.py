@@ -0,0 +1,80 @@
+import pytest
+from google.genai import types
+
+from conftest import write_images
+from fake_services import FakeAPIError, FakeFilesBackend, FakeGeminiClient
+from gemini_pool import GeminiClientPool, GeminiEndpoint, GeminiPoolExhausted
+
+
+def make_pool(clients, models=("m1",), **kwargs):
+    endpoints = [GeminiEndpoint(api_key, model) for model in models for api_key in clients]
+    kwargs.setdefault("backoff_base", 0)
+    return GeminiClientPool(endpoints, lambda api_key: clients[api_key], **kwargs)
+
+
+def request(text="12:00:00 U1: 你好\n"):
+    return [types.Content(role="user", parts=[types.Part.from_text(text=text)])]
+
+
+def collect(stream):
+    return "".join(chunk.text for chunk in stream)
+
+
+def test_rejected_key_is_disabled_and_request_fails_over():
+    rejected = FakeGeminiClient(0, 0, key_rejected=True)
+    good = FakeGeminiClient(0, 0)
+    pool = make_pool({"bad": rejected, "good": good})
+    assert collect(pool.generate_content_stream(request()))
+    assert pool.endpoints[0].disabled and pool.endpoints[0].errors == 1
+    assert (good.request_count, pool.endpoints[1].calls) == (1, 1)
+    # 之后的请求不再发往已停用的 Key
+    collect(pool.generate_content_stream(request()))
+    assert (rejected.request_count, good.request_count) == (1, 2)
+
+
+def test_all_keys_rejected_reports_rejection_not_quota():
+    pool = make_pool({"a": FakeGeminiClient(0, 0, key_rejected=True), "b": FakeGeminiClient(0, 0, key_rejected=True)})
+    with pytest.raises(GeminiPoolExhausted, match="被拒绝"):
+        collect(pool.generate_content_stream(request()))
+    with pytest.raises(GeminiPoolExhausted, match="被拒绝"):
+        collect(pool.generate_content_stream(request()))
+
+
+def test_rate_limited_key_cools_down_and_other_key_serves():
+    limited = FakeGeminiClient(0, 0, rpm_limit=0, retry_delay=30)
+    pool = make_pool({"limited": limited, "free": FakeGeminiClient(0, 0)})
+    assert collect(pool.generate_content_stream(request()))
+    assert not pool.endpoints[0].disabled
+    assert pool.endpoints[0].rate_limited == 1 and pool.endpoints[1].calls == 1
+
+
+def test_builder_runs_per_endpoint_and_ref_403_is_left_to_caller():
+    pool = make_pool({"a": FakeGeminiClient(0, 0, key_rejected=True), "b": FakeGeminiClient(0, 0)})
+    built_for = []
+
+    def build(endpoint):
+        built_for.append(endpoint.api_key)
+        return request(), None, True
+
+    with pytest.raises(FakeAPIError):
+        collect(pool.generate_content_stream(build))
+    # 引用了远程文件的请求收到 403 时不停用 Key，由调用方清除引用后重试
+    assert built_for == ["a"] and not pool.endpoints[0].disabled
+
+
+def test_send_uses_other_key_with_its_own_uploads_when_primary_is_disabled(pipeline, tmp_path, monkeypatch):
+    primary_files, extra_files = FakeFilesBackend(), FakeFilesBackend()
+    primary = pipeline._gemini_client = FakeGeminiClient(0, 0, files_backend=primary_files, key_rejected=True)
+    extra = FakeGeminiClient(0, 0, files_backend=extra_files)
+    monkeypatch.setattr(pipeline, "GEMINI_API_KEYS", ["extra-key"])
+    monkeypatch.setattr(pipeline.genai, "Client", lambda api_key: extra)
+    images = write_images(str(tmp_path), 2)
+
+    assert pipeline.send_to_gemini("12:00:00 U1: 你好\n", images, echo=False)
+    assert pipeline.send_to_gemini("12:00:00 U1: 你好\n", images, echo=False)
+    primary_endpoint, extra_endpoint = pipeline.get_gemini_pool().endpoints
+    assert primary_endpoint.disabled and primary.request_count == 2
+    assert extra_endpoint.calls == 2 and extra.request_count == 2
+    # 第二次请求在备用 Key 下上传并引用自己的文件，不会引用主 Key 的上传
+    assert extra_files.upload_count == 2
+    assert len(pipeline.get_upload_cache("extra-key")._entries["files"]) == 2
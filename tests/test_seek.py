@@ -0,0 +1,38 @@
+import pytest
+
+from fake_services import FakeOneBotServer
+
+GROUP_ID = 10000
+
+
+@pytest.fixture
+def seek(pipeline, monkeypatch):
+    fake = FakeOneBotServer(2000, span_hours=20, image_ratio=0, seed=3, group_id=GROUP_ID)
+    monkeypatch.setattr(pipeline, "LLONEBOT_API_URL", fake.start())
+    monkeypatch.setattr(pipeline, "DELAY_BETWEEN_REQUESTS", 0)
+    yield pipeline, fake
+    fake.stop()
+
+
+def test_seek_finds_message_before_window(seek):
+    pipeline, fake = seek
+    start_ts = fake.messages[1500]["time"]
+    lo_seq, lo_time, newest_seq = pipeline.seek_seq_before(GROUP_ID, start_ts)
+    assert newest_seq == 2000
+    assert lo_time < start_ts and 1501 - pipeline.HISTORY_PAGE_SIZE <= lo_seq <= 1501
+
+
+@pytest.mark.parametrize("failing_call", [2, 5])
+def test_failed_probe_aborts_seek_instead_of_moving_bounds(seek, monkeypatch, failing_call):
+    # 第 2 次试探在倍增阶段，第 5 次在二分阶段；失败时都不能当作 "没有消息"
+    pipeline, fake = seek
+    fetch_history_page = pipeline.fetch_history_page
+    calls = []
+
+    def flaky_fetch(group_id, message_seq=None, count=pipeline.HISTORY_PAGE_SIZE):
+        calls.append(message_seq)
+        return None if len(calls) == failing_call else fetch_history_page(group_id, message_seq, count)
+
+    monkeypatch.setattr(pipeline, "fetch_history_page", flaky_fetch)
+    assert pipeline.seek_seq_before(GROUP_ID, fake.messages[1500]["time"]) is None
+    assert len(calls) == failing_call
@@ -0,0 +1,77 @@
+from conftest import write_images
+from fake_services import FakeAPIError, FakeFilesBackend, FakeGeminiClient
+from gemini_pool import GeminiPoolExhausted
+from upload_cache import UploadCache, is_stale_ref_error
+
+
+def test_stale_ref_errors_are_only_missing_or_forbidden_refs():
+    assert is_stale_ref_error(FakeAPIError(404, "NOT_FOUND"))
+    assert is_stale_ref_error(FakeAPIError(403, "PERMISSION_DENIED"))
+    assert is_stale_ref_error(FakeAPIError(400, "File files/abc is not in an ACTIVE state"))
+    assert not is_stale_ref_error(FakeAPIError(400, "Invalid argument"))
+    assert not is_stale_ref_error(FakeAPIError(429, "RESOURCE_EXHAUSTED"))
+    assert not is_stale_ref_error(FakeAPIError(503, "UNAVAILABLE: file may not exist"))
+    assert not is_stale_ref_error(TimeoutError("timed out"))
+    assert not is_stale_ref_error(GeminiPoolExhausted("尝试 6 次后仍未成功: 429"))
+
+
+def test_index_is_written_once_per_flush(tmp_path):
+    backend = FakeFilesBackend()
+    index_path = tmp_path / "index.json"
+    cache = UploadCache(str(index_path), backend)
+    for path in write_images(str(tmp_path), 3):
+        cache.file_ref(path, "image/png")
+    assert not index_path.exists()
+    cache.flush()
+    assert len(UploadCache(str(index_path), backend)._entries["files"]) == 3
+
+
+def test_expired_refs_fall_back_to_inline_once(pipeline, tmp_path):
+    backend = FakeFilesBackend()
+    client = pipeline._gemini_client = FakeGeminiClient(0, 0, files_backend=backend)
+    images = write_images(str(tmp_path), 3)
+
+    assert pipeline.send_to_gemini("12:00:00 U1: 你好\n", images, echo=False)
+    assert (client.request_count, backend.upload_count) == (1, 3)
+    # 第二次运行复用已上传的文件，不再上传
+    assert pipeline.send_to_gemini("12:00:00 U1: 你好\n", images, echo=False)
+    assert (client.request_count, backend.upload_count) == (2, 3)
+
+    # 服务端的文件全部失效: 清除引用后内联重试一次
+    backend.expire_all()
+    assert pipeline.send_to_gemini("12:00:00 U1: 你好\n", images, echo=False)
+    assert (client.request_count, backend.upload_count) == (4, 3)
+    assert UploadCache(pipeline.UPLOAD_CACHE_INDEX_PATH, backend)._entries["files"] == {}
+
+
+def test_stale_ref_fallback_is_not_retried_again(pipeline, tmp_path):
+    # 每个请求都返回 403: 带引用的请求失败后只重试一次，然后放弃
+    client = pipeline._gemini_client = FakeGeminiClient(0, 0, files_backend=FakeFilesBackend(), key_rejected=True)
+    assert pipeline.send_to_gemini("12:00:00 U1: 你好\n", write_images(str(tmp_path), 2), echo=False) is None
+    assert client.request_count == 2
+
+
+def test_transient_errors_keep_uploaded_refs(pipeline, tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, "GEMINI_MAX_ATTEMPTS", 2)
+    backend = FakeFilesBackend()
+    client = pipeline._gemini_client = FakeGeminiClient(0, 0, files_backend=backend, fail_times=2)
+    pipeline.get_gemini_pool().backoff_base = 0
+    assert pipeline.send_to_gemini("12:00:00 U1: 你好\n", write_images(str(tmp_path), 2), echo=False) is None
+    assert client.request_count == 2
+    assert len(UploadCache(pipeline.UPLOAD_CACHE_INDEX_PATH, backend)._entries["files"]) == 2
+
+
+def test_stale_ref_retry_keeps_inline_budget(pipeline, tmp_path, monkeypatch):
+    # 重试时图片尽量内联，但内联总量仍不超过上限，超出的部分重新上传
+    monkeypatch.setattr(pipeline, "INLINE_IMAGE_BYTES_BUDGET", 100 * 1024)
+    backend = FakeFilesBackend()
+    client = pipeline._gemini_client = FakeGeminiClient(0, 0, files_backend=backend)
+    images = write_images(str(tmp_path), 3)
+    assert pipeline.send_to_gemini("12:00:00 U1: 你好\n", images, echo=False)
+    assert backend.upload_count == 3
+
+    backend.expire_all()
+    assert pipeline.send_to_gemini("12:00:00 U1: 你好\n", images, echo=False)
+    assert client.request_count == 3
+    assert backend.upload_count == 5
+    assert len(UploadCache(pipeline.UPLOAD_CACHE_INDEX_PATH, backend)._entries["files"]) == 2
@@ -0,0 +1,104 @@
+import re
+
+from prompt_planner import estimate_text_tokens
+
+ALIAS_NOTE = ("为节省篇幅，下面的记录中发言者以代号表示 (如 U1)，代号对应的群名片与QQ号见图例；"
+              "连续出现的相同发言合并为一行 (时间为第一条的时间)，列出所有发言者并以 (×N) 标注次数。"
+              "引用原始聊天记录时，用户名写该条发言者的代号、用户id留空，例如 <<22:30:05,U1,,发言内容>>，"
+              "总结中提到群友时可以写 @代号 (如 @U1)，系统会自动还原为群名片。\n")
+# 只在两个位置还原代号: 引用的用户名字段，以及总结中的 @代号；正文里的其他 "U12" 之类文字保持原样
+_ALIAS_QUOTE_HEADER = re.compile(r"<<(\d{1,2}:\d{2}:\d{2}),@?(U\d+),(@?U\d+|\d*),")
+_ALIAS_MENTION = re.compile(r"(?<![A-Za-z0-9_])@(U\d+)(?![0-9])")
+
+
+class TranscriptCompactor:
+    """发送前压缩群聊记录，减少提示词 token:
+
+    - 发言者的 "名片(QQ号)" 换成本次运行内的短代号 U1、U2…，图例只出现一次；
+    - 连续的相同发言 (刷屏的 "+1"、重复表情) 合并为一行，保留所有发言者并标注 (×N)；
+    - 没有任何内容的消息 (只含不支持的消息段) 直接丢弃。
+    代号到原名片/QQ号的映射保留在本对象中，模型回复里引用的用户名与 @代号 由 expand_text/expand_topic 还原。
+    """
+
+    def __init__(self):
+        self.senders = {}  # 代号 -> (群名片, QQ号)
+        self._aliases = {}  # QQ号 (没有时为名片) -> 代号
+        self.lines = []
+        self.line_image_counts = []
+        self.line_aliases = []
+        self._last_content = None
+        self._repeat_time = None
+        self._repeat_count = 0
+        self.original_tokens = 0
+        self.dropped_count = 0
+        self.collapsed_count = 0
+
+    def _alias(self, name, user_id):
+        key = str(user_id) if user_id not in (None, "") else f"name:{name}"
+        alias = self._aliases.get(key)
+        if alias is None:
+            alias = f"U{len(self._aliases) + 1}"
+            self._aliases[key] = alias
+            self.senders[alias] = (name, str(user_id or ""))
+        return alias
+
+    def add(self, time_str, name, user_id, content, image_count=0):
+        self.original_tokens += estimate_text_tokens(f"{time_str} {name}({user_id}): {content}") + 1
+        if not content.strip() and not image_count:
+            self.dropped_count += 1
+            return
+        alias = self._alias(name, user_id)
+        if not image_count and self.lines and not self.line_image_counts[-1] and content == self._last_content:
+            aliases = self.line_aliases[-1]
+            if alias not in aliases: aliases.append(alias)
+            self._repeat_count += 1
+            self.collapsed_count += 1
+            self.lines[-1] = f"{self._repeat_time} {','.join(aliases)}: {content} (×{self._repeat_count})"
+            return
+        self._last_content = content
+        self._repeat_time = time_str
+        self._repeat_count = 1
+        self.lines.append(f"{time_str} {alias}: {content}")
+        self.line_image_counts.append(image_count)
+        self.line_aliases.append([alias])
+
+    def legend(self, start_line=0, end_line=None):
+        # 只列出指定行范围内出现过的代号 (分块总结时每块只带自己的图例)
+        used = {alias for aliases in self.line_aliases[start_line:end_line] for alias in aliases}
+        entries = [f"{alias}={name}({user_id})" for alias, (name, user_id) in self.senders.items() if alias in used]
+        return "发言者图例：" + "；".join(entries) + "\n\n" if entries else ""
+
+    def header(self, start_line=0, end_line=None):
+        return ALIAS_NOTE + self.legend(start_line, end_line)
+
+    def compacted_tokens(self):
+        return estimate_text_tokens(self.header()) + sum(estimate_text_tokens(line) + 1 for line in self.lines)
+
+    def expand_text(self, text):
+        if not text or not self.senders:
+            return text
+
+        def expand_quote(match):
+            name, user_id = self.senders.get(match.group(2), (match.group(2), match.group(3)))
+            return f"<<{match.group(1)},{name},{user_id},"
+
+        text = _ALIAS_QUOTE_HEADER.sub(expand_quote, text)
+        return _ALIAS_MENTION.sub(lambda m: self.senders[m.group(1)][0] if m.group(1) in self.senders else m.group(0),
+                                  text)
+
+    def expand_topic(self, topic):
+        for quote in topic.quotes:
+            alias = quote.name.lstrip("@")
+            if alias in self.senders:
+                quote.name, quote.user_id = self.senders[alias]
+            quote.text = self.expand_text(quote.text)
+        topic.summary = self.expand_text(topic.summary)
+        return topic
+
+    def report(self):
+        saved = self.original_tokens - self.compacted_tokens()
+        ratio = saved / self.original_tokens * 100 if self.original_tokens else 0.0
+        print(f"  [记录压缩] 发言者代号 {len(self.senders)} 个，合并连续重复 {self.collapsed_count} 条，"
+              f"丢弃空消息 {self.dropped_count} 条；估算 {self.original_tokens} -> {self.compacted_tokens()} tokens，"
+              f"节省 {saved} ({ratio:.1f}%)。")
+        return saved
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+DEFAULT_FILE_TTL_SECONDS = 47 * 3600  # Files API 的文件保留 48 小时，留出余量
+# 引用的远程文件/上下文缓存已被删除、过期或不属于当前 Key 时，服务端返回 403/404，或 400 并附带这些说明
+_STALE_REF_STATUS_CODES = {403, 404}
+_STALE_REF_MARKERS = ("NOT_FOUND", "not found", "may not exist", "expired", "not in an ACTIVE state", "PERMISSION_DENIED")
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def is_stale_ref_error(error):
+    """请求失败是否因为引用的远程文件/上下文缓存不可用 (不存在、已过期、无权访问)；限流、5xx、超时等不算。"""
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if isinstance(code, int):
+        if code in _STALE_REF_STATUS_CODES:
+            return True
+        if code != 400:
+            return False
+    text = str(error)
+    return any(marker in text for marker in _STALE_REF_MARKERS)
+
+
+class GeminiFilesBackend:
+    """通过 google-genai 客户端的 Files API / 上下文缓存接口上传内容。"""
+
+    def __init__(self, client, default_ttl=DEFAULT_FILE_TTL_SECONDS):
+        self.client = client
+        self.default_ttl = default_ttl
+
+    @staticmethod
+    def _timestamp(value, fallback):
+        return value.timestamp() if value is not None and hasattr(value, "timestamp") else fallback
+
+    def upload(self, path, mime_type):
+        uploaded = self.client.files.upload(file=path, config={"mime_type": mime_type})
+        return {
+            "name": uploaded.name,
+            "uri": uploaded.uri,
+            "mime_type": uploaded.mime_type or mime_type,
+            "expires_at": self._timestamp(getattr(uploaded, "expiration_time", None), time.time() + self.default_ttl),
+        }
+
+    def create_context_cache(self, model, text, ttl_seconds):
+        cached = self.client.caches.create(model=model, config={
+            "contents": [{"role": "user", "parts": [{"text": text}]}],
+            "ttl": f"{int(ttl_seconds)}s",
+        })
+        return {
+            "name": cached.name,
+            "expires_at": self._timestamp(getattr(cached, "expire_time", None), time.time() + ttl_seconds),
+        }
+
+
+class UploadCache:
+    """内容哈希 -> 已上传的远程引用，跨运行持久化在 index_path 中。
+
+    引用在到期前 safety_margin 秒起视为失效并重新上传；请求因引用失效而失败时由调用方 invalidate 后改用内联数据。
+    新增/清除引用只在内存中标记，由调用方在一次请求构建完成后调用 flush() 统一写回索引。
+    backend 需提供 upload(path, mime_type) 与 create_context_cache(model, text, ttl_seconds)，返回值见 GeminiFilesBackend。
+    """
+
+    def __init__(self, index_path, backend, safety_margin=900):
+        self.index_path = index_path
+        self.backend = backend
+        self.safety_margin = safety_margin
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._entries = {"files": {}, "contexts": {}}
+        self._dirty = False
+        self.hit_count = 0
+        self.upload_count = 0
+        self.reused_bytes = 0
+        self.uploaded_bytes = 0
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                loaded = json.load(f)
+            self._entries["files"].update(loaded.get("files", {}))
+            self._entries["contexts"].update(loaded.get("contexts", {}))
+        except (OSError, ValueError) as e:
+            print(f"  [上传缓存] 索引文件损坏，将重新上传: {e}")
+        self.purge_expired()
+
+    def _save(self):
+        # 调用方需持有 self._lock；先写临时文件再替换，避免中断时留下半个索引
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _valid_entry(self, section, key):
+        with self._lock:
+            entry = self._entries[section].get(key)
+        if entry and entry["expires_at"] - self.safety_margin > time.time():
+            return entry
+        return None
+
+    def _store(self, section, key, entry):
+        with self._lock:
+            self._entries[section][key] = entry
+            self._dirty = True
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                self._save()
+                self._dirty = False
+
+    def file_ref(self, path, mime_type):
+        """返回 {"name", "uri", "mime_type", "expires_at"}；同一内容已有未过期的引用时直接复用。"""
+        digest = file_sha256(path)
+        size = os.path.getsize(path)
+        with self._key_lock(digest):
+            entry = self._valid_entry("files", digest)
+            if entry:
+                with self._lock:
+                    self.hit_count += 1
+                    self.reused_bytes += size
+                return dict(entry, digest=digest)
+            entry = self.backend.upload(path, mime_type)
+            self._store("files", digest, entry)
+            with self._lock:
+                self.upload_count += 1
+                self.uploaded_bytes += size
+            return dict(entry, digest=digest)
+
+    def context_ref(self, model, text, ttl_seconds):
+        """固定提示词前缀的上下文缓存，按 (模型, 文本) 复用。"""
+        key = hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+        with self._key_lock(key):
+            entry = self._valid_entry("contexts", key)
+            if entry:
+                return dict(entry, key=key)
+            entry = self.backend.create_context_cache(model, text, ttl_seconds)
+            self._store("contexts", key, entry)
+            return dict(entry, key=key)
+
+    def invalidate(self, section, key):
+        with self._lock:
+            if self._entries[section].pop(key, None) is not None:
+                self._dirty = True
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            for section in self._entries.values():
+                for key in [k for k, entry in section.items() if entry["expires_at"] - self.safety_margin <= now]:
+                    del section[key]
+
+    def report(self):
+        if self.hit_count or self.upload_count:
+            print(f"  [上传缓存] 复用远程文件 {self.hit_count} 个 ({self.reused_bytes / 1024:.0f} KB 无需重新上传)，"
+                  f"新上传 {self.upload_count} 个 ({self.uploaded_bytes / 1024:.0f} KB)。")